@@ -4,6 +4,8 @@ from django.conf import settings
 
 from tornado.web import RequestHandler, StaticFileHandler, HTTPError
 
+from base import metrics
+
 
 class HelloHandler(RequestHandler):
     def head(self):
@@ -21,6 +23,23 @@ class RobotsHandler(RequestHandler):
         self.write(("User-agent: *\nDisallow: /*\nAllow: /$"))
 
 
+class MetricsHandler(RequestHandler):
+    def get(self):
+        # remote_ip is taken from the X-Real-IP and X-Forwarded-For headers,
+        # which any client can set, so the address of the socket peer is
+        # checked instead. Requests forwarded by a proxy are refused.
+        address = self.request.connection.context.address
+        if (
+            not isinstance(address, tuple)
+            or address[0] not in settings.METRICS_ALLOWED_IPS
+            or "X-Real-Ip" in self.request.headers
+            or "X-Forwarded-For" in self.request.headers
+        ):
+            raise HTTPError(403)
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics.expose())
+
+
 class DjangoStaticFilesHandler(StaticFileHandler):
     def initialize(self, default_filename=None):
         super().initialize(None, default_filename=None)
@@ -0,0 +1,179 @@
+"""
+Counters, gauges and histograms of the events in a server process. The
+metrics of all modules are collected in one registry and served in the
+Prometheus text format by base.handlers.MetricsHandler at /metrics, so
+they can be read with curl or by a Prometheus server without running any
+further service. Every process has its own metrics.
+"""
+
+import threading
+from bisect import bisect_left
+from contextlib import ContextDecorator
+from time import perf_counter
+
+registry = []
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '%s="%s"'
+            % (
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for name, value in labels
+        )
+        + "}"
+    )
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        # Metrics are updated from the IOLoop as well as from the threads of
+        # Django views and of the save scheduler.
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def samples(self):
+        # Returns (suffix, labels, value) of every sample.
+        with self.lock:
+            return [
+                ("", labels, value) for labels, value in self.values.items()
+            ]
+
+    def expose(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{format_labels(labels)} "
+                f"{format_value(value)}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that is read by calling function when the metrics are served.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, function):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def samples(self):
+        return [("", (), self.function())]
+
+
+class Timer(ContextDecorator):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def _recreate_cm(self):
+        # A decorated function can run in several threads at the same time,
+        # so every call needs its own start time.
+        return Timer(self.histogram, self.labels)
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                # Counts per bucket, sum and count
+                self.values[key] = [[0] * len(self.buckets), 0, 0]
+            counts = self.values[key]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def time(self, **labels):
+        # Observes the duration of a with block or of calls to a decorated
+        # function.
+        return Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append(
+                        ("_bucket", labels + (("le", bound),), cumulative)
+                    )
+                samples.append(("_bucket", labels + (("le", "+Inf"),), count))
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, count))
+        return samples
+
+
+def expose():
+    lines = []
+    for metric in registry:
+        lines += metric.expose()
+    return "\n".join(lines) + "\n"
@@ -1,9 +1,66 @@
 # Source: https://github.com/plter/tornado_asgi_handler plter (MIT)
 
+from time import perf_counter
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
 from tornado.web import RequestHandler
 
+from base import metrics
+
 GLOBAL_CHARSET = "utf-8"
 
+requests = metrics.Counter(
+    "fiduswriter_http_requests_total",
+    "HTTP requests handled by Django by method and status.",
+)
+request_seconds = metrics.Histogram(
+    "fiduswriter_http_request_seconds",
+    "Time needed by Django to handle an HTTP request.",
+)
+
+
+class DjangoAsgiHandler(ASGIHandler):
+    """
+    Django iterates over streaming responses on the event loop, where the
+    database cannot be used. The parts of streaming responses are produced
+    in the thread of the views instead, so that a view can stream the
+    results of a query while it reads them.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode("ascii")
+            if isinstance(value, str):
+                value = value.encode("latin1")
+            response_headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            response_headers.append(
+                (b"Set-Cookie", c.output(header="").encode("ascii").strip())
+            )
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": response_headers,
+            }
+        )
+        parts = iter(response)
+        next_part = sync_to_async(next, thread_sensitive=True)
+        while True:
+            part = await next_part(parts, None)
+            if part is None:
+                break
+            await send(
+                {"type": "http.response.body", "body": part, "more_body": True}
+            )
+        await send({"type": "http.response.body"})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
 
 class AsgiHandler(RequestHandler):
     def initialize(self, asgi_app) -> None:
@@ -54,12 +111,20 @@ class AsgiHandler(RequestHandler):
                 status = self.get_status()
                 if status not in (204, 304) and "body" in data:
                     self.write(data["body"])
+                    if data.get("more_body"):
+                        # Send the parts of streaming responses right away.
+                        await self.flush()
             else:
                 raise RuntimeError(
                     f"Unsupported response type \"{data['type']}\" for asgi app"
                 )
 
+        start = perf_counter()
         await self._asgi_app(scope, receive, send)
+        request_seconds.observe(
+            perf_counter() - start, method=self.request.method
+        )
+        requests.inc(method=self.request.method, status=self.get_status())
 
     async def get(self):
         await self.handle_request()
@@ -1,17 +1,29 @@
 from importlib import import_module
 
+import django
 from django.conf import settings
-from django.core.asgi import get_asgi_application
 
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
 from tornado.web import Application, StaticFileHandler
 
-from base.handlers import DjangoStaticFilesHandler, HelloHandler, RobotsHandler
+from base.handlers import (
+    DjangoStaticFilesHandler,
+    HelloHandler,
+    MetricsHandler,
+    RobotsHandler,
+)
 
 from . import asgi
 
 
+def get_asgi_application():
+    # Like django.core.asgi.get_asgi_application, with a handler that
+    # streams responses.
+    django.setup(set_prefix=False)
+    return asgi.DjangoAsgiHandler()
+
+
 def make_tornado_server():
     tornado_url_list = [
         (
@@ -22,6 +34,7 @@ def make_tornado_server():
         (r"/media/(.*)", StaticFileHandler, {"path": settings.MEDIA_ROOT}),
         ("/hello-tornado", HelloHandler),
         ("/robots.txt", RobotsHandler),
+        ("/metrics", MetricsHandler),
     ]
 
     for app in settings.INSTALLED_APPS:
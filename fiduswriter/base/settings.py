@@ -14,8 +14,58 @@ TEST_SERVER = True
 CONTACT_EMAIL = "mail@email.com"
 # If websockets is running on a non-standard port, add it here:
 WS_PORT = False
-# Interval between document saves
-DOC_SAVE_INTERVAL = 1
+# Number of unsaved versions after which a document is saved
+DOC_SAVE_INTERVAL = 50
+# Number of seconds after which changes to a document are saved
+DOC_SAVE_DELAY = 5
+# Number of seconds during which changes to the participants of a document
+# are collected before the participant list is sent
+DOC_PARTICIPANT_LIST_DELAY = 0.5
+# Number of seconds between sending the selection changes of the participants
+# of a document
+DOC_SELECTION_TICK = 0.1
+# The backend that shares collaboration sessions between processes. The
+# default keeps all participants of a document in the same process. Set it to
+# "document.session_backends.RedisSessionBackend" to run several processes or
+# servers behind a load balancer.
+DOC_SESSION_BACKEND = "document.session_backends.LocalSessionBackend"
+# The Redis server used by the RedisSessionBackend.
+DOC_SESSION_REDIS_URL = "redis://localhost:6379/0"
+# Number of threads per process for the database queries of the collaboration
+# server. The queries of a document are run one after another.
+DOC_DB_THREADS = 4
+# Number of messages per open document that can wait to be handled. Once the
+# queue of a document is full, no further messages are read from the
+# connections of its participants until there is room again.
+DOC_MESSAGE_QUEUE_SIZE = 100
+# Number of accepted diffs that are kept per document, so that clients that
+# have been offline can catch up without reloading the document.
+DOC_HISTORY_LENGTH = 1000
+# Number of seconds after which a collaboration session that has not received
+# any message is saved and removed from memory, or None to keep sessions until
+# all participants have disconnected.
+DOC_SESSION_IDLE_TIMEOUT = 3600
+# Number of seconds for which the state of the document overview that a client
+# has received is kept to answer its next request with only the changes. The
+# state is kept in the default cache, which needs to be shared by all server
+# processes (see CACHES) for this to work across processes.
+DOCUMENT_LIST_SYNC_TIMEOUT = 7 * 24 * 60 * 60
+# Addresses from which the metrics of a server process can be read at
+# /metrics. Only direct connections count; requests with an X-Real-IP or
+# X-Forwarded-For header, as set by proxies, are refused.
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+# Share of the websocket messages (between 0 and 1) whose content is included
+# in the debug log.
+WS_LOG_PAYLOAD_SAMPLE_RATE = 1
+# Maximum number of messages and bytes that are kept per websocket connection
+# to be sent again if the client has missed them. A client that misses more
+# messages has to reload the entire document.
+WS_RESEND_BUFFER_MESSAGES = 100
+WS_RESEND_BUFFER_BYTES = 1024 * 1024
+# Options of the permessage-deflate compression of websocket messages, or None
+# to disable compression. Each connection keeps a compressor whose memory use
+# grows with mem_level (1-9).
+WS_COMPRESSION_OPTIONS = {"compression_level": 6, "mem_level": 5}
 
 ADMINS = (("Your Name", "your_email@example.com"),)
 
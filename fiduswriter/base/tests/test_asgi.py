@@ -0,0 +1,83 @@
+import threading
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import SimpleTestCase
+
+from base.servers.asgi import DjangoAsgiHandler
+
+
+class Parts:
+    # The parts of a streaming response. Records the threads in which they
+    # are produced and whether the response has been closed.
+    def __init__(self, parts):
+        self.parts = iter(parts)
+        self.threads = set()
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.threads.add(threading.get_ident())
+        return next(self.parts)
+
+    def close(self):
+        self.closed = True
+
+
+class DjangoAsgiHandlerTest(SimpleTestCase):
+    async def send_response(self, response):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await DjangoAsgiHandler().send_response(response, send)
+        return messages
+
+    async def test_streaming_response(self):
+        parts = Parts([b'{"id": 1}\n', b'{"id": 2}\n'])
+        response = StreamingHttpResponse(
+            parts, content_type="application/x-ndjson"
+        )
+        response.set_cookie("yeti", "snow")
+        messages = await self.send_response(response)
+        self.assertEqual(messages[0]["type"], "http.response.start")
+        self.assertEqual(messages[0]["status"], 200)
+        headers = dict(messages[0]["headers"])
+        self.assertEqual(headers[b"Content-Type"], b"application/x-ndjson")
+        self.assertIn(b"yeti=snow", headers[b"Set-Cookie"])
+        # Every part is sent on its own.
+        self.assertEqual(
+            messages[1:],
+            [
+                {
+                    "type": "http.response.body",
+                    "body": b'{"id": 1}\n',
+                    "more_body": True,
+                },
+                {
+                    "type": "http.response.body",
+                    "body": b'{"id": 2}\n',
+                    "more_body": True,
+                },
+                {"type": "http.response.body"},
+            ],
+        )
+        self.assertTrue(parts.closed)
+        # The parts are produced in the thread in which the views run, not
+        # on the event loop.
+        views_thread = await sync_to_async(
+            threading.get_ident, thread_sensitive=True
+        )()
+        self.assertEqual(parts.threads, {views_thread})
+        self.assertNotEqual(views_thread, threading.get_ident())
+
+    async def test_response(self):
+        messages = await self.send_response(HttpResponse(b"Yeti"))
+        self.assertEqual(messages[0]["status"], 200)
+        self.assertEqual(
+            b"".join(message.get("body", b"") for message in messages[1:]),
+            b"Yeti",
+        )
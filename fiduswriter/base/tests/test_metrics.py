@@ -0,0 +1,75 @@
+import threading
+from time import sleep
+
+from django.test import SimpleTestCase
+
+from base import metrics
+
+
+class MetricsTest(SimpleTestCase):
+    def setUp(self):
+        self.registry = metrics.registry[:]
+
+    def tearDown(self):
+        metrics.registry[:] = self.registry
+
+    def test_counter(self):
+        counter = metrics.Counter("test_total", "Test counter.")
+        counter.inc(app="document")
+        counter.inc(2, app="document")
+        counter.inc(app='"base"')
+        self.assertEqual(
+            counter.expose(),
+            [
+                "# HELP test_total Test counter.",
+                "# TYPE test_total counter",
+                'test_total{app="document"} 3',
+                'test_total{app="\\"base\\""} 1',
+            ],
+        )
+
+    def test_histogram(self):
+        histogram = metrics.Histogram(
+            "test_seconds", "Test histogram.", buckets=[0.1, 1]
+        )
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        with histogram.time():
+            pass
+        lines = histogram.expose()
+        self.assertEqual(
+            lines[2:5],
+            [
+                'test_seconds_bucket{le="0.1"} 2',
+                'test_seconds_bucket{le="1"} 3',
+                'test_seconds_bucket{le="+Inf"} 4',
+            ],
+        )
+        self.assertTrue(lines[5].startswith("test_seconds_sum 5.55"))
+        self.assertEqual(lines[6], "test_seconds_count 4")
+        self.assertIn("# TYPE test_seconds histogram", metrics.expose())
+
+    def test_concurrent_timer(self):
+        histogram = metrics.Histogram(
+            "test_concurrent_seconds", "Test histogram.", buckets=[0.05]
+        )
+
+        @histogram.time()
+        def wait(seconds):
+            sleep(seconds)
+
+        threads = [
+            threading.Thread(target=wait, args=(0.1,)),
+            threading.Thread(target=wait, args=(0.01,)),
+        ]
+        threads[0].start()
+        sleep(0.02)
+        threads[1].start()
+        for thread in threads:
+            thread.join()
+        counts, total, count = histogram.values[()]
+        # One call below and one above 0.05 seconds.
+        self.assertEqual(counts, [1])
+        self.assertEqual(count, 2)
+        self.assertGreaterEqual(total, 0.11)
@@ -0,0 +1,121 @@
+import json
+from unittest import skipUnless
+from unittest.mock import MagicMock
+
+from django.test import SimpleTestCase, override_settings
+
+from base.ws_handler import (
+    BaseWebSocketHandler,
+    ResendBuffer,
+    encode_message,
+    msgpack,
+)
+
+
+class EncodedMessageTest(SimpleTestCase):
+    def test_json_counters(self):
+        encoded_message = encode_message({"type": "diff", "c": 3, "s": 4})
+        self.assertEqual(
+            json.loads(encoded_message.with_counters("json", 1, 2)),
+            {"type": "diff", "c": 1, "s": 2},
+        )
+        self.assertEqual(
+            json.loads(encode_message({}).with_counters("json", 1, 2)),
+            {"c": 1, "s": 2},
+        )
+
+    @skipUnless(msgpack, "msgpack is not installed")
+    def test_msgpack_counters(self):
+        for size in [0, 1, 13, 14, 20, 70000]:
+            message = {str(key): key for key in range(size)}
+            encoded_message = encode_message(message)
+            self.assertEqual(
+                msgpack.unpackb(
+                    encoded_message.with_counters("msgpack", 5, 300)
+                ),
+                dict(message, c=5, s=300),
+            )
+
+
+class ResendBufferTest(SimpleTestCase):
+    def handler(self):
+        handler = BaseWebSocketHandler.__new__(BaseWebSocketHandler)
+        handler.id = 0
+        handler.app_name = "test"
+        handler.endpoint = "test/1"
+        handler.user = MagicMock(id=1)
+        handler.encoding = "json"
+        handler.messages = {"server": 0, "client": 0, "sent": ResendBuffer()}
+        handler.send = MagicMock()
+        handler.unfixable = MagicMock()
+        return handler
+
+    def sent_numbers(self, handler):
+        return [
+            json.loads(call.args[0])["number"]
+            for call in handler.send.call_args_list
+        ]
+
+    @override_settings(
+        WS_RESEND_BUFFER_MESSAGES=3, WS_RESEND_BUFFER_BYTES=1000
+    )
+    def test_message_cap(self):
+        buffer = ResendBuffer()
+        for number in range(5):
+            buffer.append({"number": number}, None, 10)
+        self.assertEqual(
+            list(buffer), [{"number": 2}, {"number": 3}, {"number": 4}]
+        )
+        self.assertEqual(buffer.size, 30)
+
+    @override_settings(WS_RESEND_BUFFER_MESSAGES=10, WS_RESEND_BUFFER_BYTES=25)
+    def test_byte_cap(self):
+        buffer = ResendBuffer()
+        for number in range(5):
+            buffer.append({"number": number}, None, 10)
+        self.assertEqual(list(buffer), [{"number": 3}, {"number": 4}])
+        # The most recent message is kept even if it exceeds the cap.
+        buffer.append({"number": 5}, None, 100)
+        self.assertEqual(list(buffer), [{"number": 5}])
+        self.assertEqual(buffer.size, 100)
+
+    @override_settings(
+        WS_RESEND_BUFFER_MESSAGES=10, WS_RESEND_BUFFER_BYTES=100000
+    )
+    def test_resend_from_index(self):
+        handler = self.handler()
+        for number in range(5):
+            handler.send_message({"type": "test", "number": number})
+        handler.send.reset_mock()
+        handler.resend_messages(2)
+        self.assertEqual(self.sent_numbers(handler), [2, 3, 4])
+        # The resent messages keep their server counters.
+        self.assertEqual(
+            [
+                json.loads(call.args[0])["s"]
+                for call in handler.send.call_args_list
+            ],
+            [3, 4, 5],
+        )
+        self.assertEqual(handler.messages["server"], 5)
+        # Nothing is missing.
+        handler.send.reset_mock()
+        handler.resend_messages(5)
+        handler.send.assert_not_called()
+        handler.unfixable.assert_not_called()
+
+    @override_settings(
+        WS_RESEND_BUFFER_MESSAGES=3, WS_RESEND_BUFFER_BYTES=100000
+    )
+    def test_resend_out_of_range(self):
+        handler = self.handler()
+        for number in range(5):
+            handler.send_message({"type": "test", "number": number})
+        handler.send.reset_mock()
+        # The first two messages have been dropped from the buffer.
+        handler.resend_messages(1)
+        handler.send.assert_not_called()
+        handler.unfixable.assert_called_once()
+        handler.messages["server"] = 5
+        handler.resend_messages(2)
+        self.assertEqual(self.sent_numbers(handler), [2, 3, 4])
@@ -1,4 +1,6 @@
 import json
+import random
+from collections import deque
 
 from urllib.parse import urlparse
 from tornado.websocket import WebSocketHandler
@@ -6,14 +8,166 @@ from tornado.websocket import WebSocketClosedError
 from tornado.iostream import StreamClosedError
 import tornado
 from django.db import connection
+from django.conf import settings
 import logging
 from logging import info, debug
 from tornado.ioloop import IOLoop
 
+from . import metrics
 from .django_handler_mixin import DjangoHandlerMixin
 
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 logger = logging.getLogger(__name__)
 
+connections_opened = metrics.Counter(
+    "fiduswriter_ws_connections_opened_total", "Websocket connections opened."
+)
+messages_received = metrics.Counter(
+    "fiduswriter_ws_messages_received_total",
+    "Websocket messages received from clients.",
+)
+messages_sent = metrics.Counter(
+    "fiduswriter_ws_messages_sent_total",
+    "Websocket messages sent to clients, including resent messages.",
+)
+bytes_sent = metrics.Counter(
+    "fiduswriter_ws_bytes_sent_total",
+    "Bytes of websocket messages sent to clients before compression.",
+)
+messages_resent = metrics.Counter(
+    "fiduswriter_ws_messages_resent_total",
+    "Websocket messages sent again because a client had missed them.",
+)
+resend_requests = metrics.Counter(
+    "fiduswriter_ws_resend_requests_total",
+    "Requests to clients to send messages again that the server missed.",
+)
+unfixable_fallbacks = metrics.Counter(
+    "fiduswriter_ws_unfixable_total",
+    "Times a client could not be brought back in sync and had to reload.",
+)
+
+
+def encode_message(message):
+    # Encodes a message without the per-connection message counters so that
+    # the result can be shared by all connections the message is sent to.
+    return EncodedMessage(message)
+
+
+class EncodedMessage:
+    """
+    A message without the per-connection message counters in the encodings
+    used by the connections it is sent to. Every encoding is only created
+    when the first connection that uses it sends the message. with_counters
+    adds the counters of a connection without encoding the message again.
+    """
+
+    __slots__ = ("message", "encodings")
+
+    def __init__(self, message):
+        self.message = {
+            key: value
+            for key, value in message.items()
+            if key not in ("c", "s")
+        }
+        self.encodings = {}
+
+    def get(self, encoding):
+        if encoding not in self.encodings:
+            if encoding == "msgpack":
+                # The map header is left out so that a header that includes
+                # the counters can be added in front of the entries.
+                entries = msgpack.packb(self.message)
+                header_length = {0xDE: 3, 0xDF: 5}.get(entries[0], 1)
+                self.encodings[encoding] = entries[header_length:]
+            else:
+                self.encodings[encoding] = json.dumps(self.message).encode(
+                    "utf-8"
+                )
+        return self.encodings[encoding]
+
+    def with_counters(self, encoding, client, server):
+        encoded_message = self.get(encoding)
+        if encoding == "msgpack":
+            size = len(self.message) + 2
+            if size < 16:
+                header = bytes([0x80 | size])
+            elif size < 0x10000:
+                header = b"\xde" + size.to_bytes(2, "big")
+            else:
+                header = b"\xdf" + size.to_bytes(4, "big")
+            return (
+                header
+                + encoded_message
+                + msgpack.packb("c")
+                + msgpack.packb(client)
+                + msgpack.packb("s")
+                + msgpack.packb(server)
+            )
+        if encoded_message == b"{}":
+            return b'{"c":%d,"s":%d}' % (client, server)
+        return encoded_message[:-1] + b',"c":%d,"s":%d}' % (client, server)
+
+
+class LogPayload:
+    # Wraps a message that is logged for every message that is handled. The
+    # message is only serialized if the log record is emitted and then only
+    # for the share of records given by WS_LOG_PAYLOAD_SAMPLE_RATE.
+    __slots__ = ("message",)
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        if random.random() >= settings.WS_LOG_PAYLOAD_SAMPLE_RATE:
+            return "(not sampled)"
+        return json.dumps(self.message)
+
+
+class ResendBuffer:
+    """
+    The most recent messages sent to a client, kept so that they can be sent
+    again if the client missed them. Messages are stored together with their
+    EncodedMessage so that they do not have to be encoded again. The oldest
+    messages are dropped once the buffer holds more than
+    WS_RESEND_BUFFER_MESSAGES messages or WS_RESEND_BUFFER_BYTES bytes. The
+    most recent message is always kept.
+    """
+
+    def __init__(self):
+        self.entries = deque()
+        self.size = 0
+
+    def append(self, message, encoded_message, size):
+        # size is the number of bytes of the message as it has been sent.
+        self.entries.append((message, encoded_message, size))
+        self.size += size
+        while len(self.entries) > 1 and (
+            len(self.entries) > settings.WS_RESEND_BUFFER_MESSAGES
+            or self.size > settings.WS_RESEND_BUFFER_BYTES
+        ):
+            self.size -= self.entries.popleft()[2]
+
+    def last(self, number):
+        # Returns the last number messages with their EncodedMessage.
+        if number <= 0:
+            return []
+        return [
+            (message, encoded_message)
+            for message, encoded_message, size in list(self.entries)[-number:]
+        ]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (message for message, encoded_message, size in self.entries)
+
 
 class BaseWebSocketHandler(DjangoHandlerMixin, WebSocketHandler):
     def initialize(self, app_name):
@@ -26,7 +180,11 @@ class BaseWebSocketHandler(DjangoHandlerMixin, WebSocketHandler):
         self.user = self.get_current_user()
         self.endpoint = self.app_name + "/" + arg
         self.args = arg.split("/")
-        self.messages = {"server": 0, "client": 0, "last_ten": []}
+        connections_opened.inc(app=self.app_name)
+        self.messages = {"server": 0, "client": 0, "sent": ResendBuffer()}
+        # The encoding of the messages sent in binary frames, see
+        # negotiate_encoding. Text frames always contain JSON.
+        self.encoding = "json"
         if not self.user.is_authenticated:
             self.access_denied()
             return
@@ -48,8 +206,26 @@ class BaseWebSocketHandler(DjangoHandlerMixin, WebSocketHandler):
     def do_close(self):
         self.close()
 
+    def get_compression_options(self):
+        # Enables the permessage-deflate extension if the client offers it.
+        return settings.WS_COMPRESSION_OPTIONS
+
+    def negotiate_encoding(self, message):
+        # Switches to the first encoding in the list of encodings the client
+        # supports that is also supported by the server. MessagePack requires
+        # the msgpack package.
+        for encoding in message.get("encodings", []):
+            if encoding == "json" or (encoding == "msgpack" and msgpack):
+                self.encoding = encoding
+                return
+
     def on_message(self, data):
-        message = json.loads(data)
+        if isinstance(data, bytes) and msgpack:
+            # Binary frame
+            message = msgpack.unpackb(data, strict_map_key=False)
+        else:
+            message = json.loads(data)
+        messages_received.inc(app=self.app_name)
         if message["type"] == "request_resend":
             self.resend_messages(message["from"])
             return
@@ -57,13 +233,20 @@ class BaseWebSocketHandler(DjangoHandlerMixin, WebSocketHandler):
             self.send({"type": "access_denied"})
             # Message doesn't contain needed client/server info. Ignore.
             return
+        # The log messages of every message are only formatted if debug
+        # logging is enabled.
         logger.debug(
-            f"Action:Message received URL:{self.endpoint} "
-            f"User:{self.user.id} ParticipantID:{self.id} "
-            f"Type:{message['type']} "
-            f"S count client:{message['s']} C count client:{message['c']} "
-            f"S count server:{self.messages['server']} "
-            f"C count server:{self.messages['client']}"
+            "Action:Message received URL:%s User:%s ParticipantID:%s "
+            "Type:%s S count client:%s C count client:%s "
+            "S count server:%s C count server:%s",
+            self.endpoint,
+            self.user.id,
+            self.id,
+            message["type"],
+            message["s"],
+            message["c"],
+            self.messages["server"],
+            self.messages["client"],
         )
 
         if message["c"] < (self.messages["client"] + 1):
@@ -77,6 +260,7 @@ class BaseWebSocketHandler(DjangoHandlerMixin, WebSocketHandler):
                 f"ParticipantID:{self.id} from:{self.messages['client']}"
             )
 
+            resend_requests.inc(app=self.app_name)
             self.send(
                 {"type": "request_resend", "from": self.messages["client"]}
             )
@@ -97,7 +281,9 @@ class BaseWebSocketHandler(DjangoHandlerMixin, WebSocketHandler):
             return
         # Message order is correct. We continue processing the data.
         self.messages["client"] += 1
-        self.handle_message(message)
+        # handle_message can return an awaitable, in which case Tornado only
+        # passes on the next message of the connection once it is done.
+        return self.handle_message(message)
 
     def handle_message(message):
         pass
@@ -105,28 +291,42 @@ class BaseWebSocketHandler(DjangoHandlerMixin, WebSocketHandler):
     def reject_message(message):
         pass
 
-    def send_message(self, message):
+    def send_message(self, message, encoded_message=None):
+        # encoded_message can be handed in if the message has already been
+        # encoded with encode_message for another connection.
         self.messages["server"] += 1
-        message["c"] = self.messages["client"]
-        message["s"] = self.messages["server"]
-        self.messages["last_ten"].append(message)
-        self.messages["last_ten"] = self.messages["last_ten"][-10:]
+        if encoded_message is None:
+            encoded_message = encode_message(message)
+        data = encoded_message.with_counters(
+            self.encoding, self.messages["client"], self.messages["server"]
+        )
+        self.messages["sent"].append(message, encoded_message, len(data))
+        messages_sent.inc(app=self.app_name)
+        bytes_sent.inc(len(data), app=self.app_name)
         logger.debug(
-            f"Action:Sending Message. URL:{self.endpoint} User:{self.user.id} "
-            f"ParticipantID:{self.id} Type:{message['type']} "
-            f"S count server:{message['s']} C count server:{message['c']}"
+            "Action:Sending Message. URL:%s User:%s ParticipantID:%s Type:%s "
+            "S count server:%s C count server:%s",
+            self.endpoint,
+            self.user.id,
+            self.id,
+            message["type"],
+            self.messages["server"],
+            self.messages["client"],
         )
-        self.send(message)
+        self.send(data)
 
     @tornado.gen.coroutine
     def send(self, message):
         try:
-            yield self.write_message(message)
+            yield self.write_message(
+                message,
+                binary=self.encoding != "json" and isinstance(message, bytes),
+            )
         except (WebSocketClosedError, StreamClosedError):
             pass
 
     def unfixable(self):
-        pass
+        unfixable_fallbacks.inc(app=self.app_name)
 
     def resend_messages(self, from_no):
         to_send = self.messages["server"] - from_no
@@ -137,7 +337,7 @@ class BaseWebSocketHandler(DjangoHandlerMixin, WebSocketHandler):
             f"S count server:{self.messages['server']} from:{from_no}"
         )
         self.messages["server"] -= to_send
-        if to_send > len(self.messages["last_ten"]):
+        if to_send > len(self.messages["sent"]):
             # Too many messages requested. We have to abort.
             logger.debug(
                 f"Action:Lot of messages requested. URL:{self.endpoint} "
@@ -146,8 +346,9 @@ class BaseWebSocketHandler(DjangoHandlerMixin, WebSocketHandler):
             )
             self.unfixable()
             return
-        for message in self.messages["last_ten"][0 - to_send :]:
-            self.send_message(message)
+        messages_resent.inc(to_send, app=self.app_name)
+        for message, encoded_message in self.messages["sent"].last(to_send):
+            self.send_message(message, encoded_message)
 
     def check_origin(self, origin):
         parsed_origin = urlparse(origin)
@@ -1,4 +1,4 @@
-from .ws_handler import BaseWebSocketHandler
+from .ws_handler import BaseWebSocketHandler, encode_message
 
 
 class WebSocket(BaseWebSocketHandler):
@@ -48,13 +48,15 @@ class WebSocket(BaseWebSocketHandler):
 
     @classmethod
     def send_message_to_users(cls, message):
+        encoded_message = encode_message(message)
         for waiter in list(cls.sessions.values()):
-            waiter.send_message(message)
+            waiter.send_message(message, encoded_message)
 
     @classmethod
     def send_message_to_admins(cls, message):
+        encoded_message = encode_message(message)
         for waiter in list(cls.admin_sessions.values()):
-            waiter.send_message(message)
+            waiter.send_message(message, encoded_message)
 
     def on_close(self):
         if not hasattr(self, "type"):
@@ -12,7 +12,11 @@ class DocumentAdmin(admin.ModelAdmin):
             path(
                 "maintenance/",
                 self.admin_site.admin_view(self.maintenance_view),
-            )
+            ),
+            path(
+                "sessions/",
+                self.admin_site.admin_view(self.sessions_view),
+            ),
         ]
         urls = extra_urls + urls
         return urls
@@ -21,6 +25,15 @@ class DocumentAdmin(admin.ModelAdmin):
         response = {}
         return render(request, "admin/document/maintenance.html", response)
 
+    def sessions_view(self, request):
+        from .ws_views import WebSocket
+
+        response = {"sessions": WebSocket.get_session_report()}
+        response["size"] = sum(
+            session["size"] for session in response["sessions"]
+        )
+        return render(request, "admin/document/sessions.html", response)
+
 
 admin.site.register(models.Document, DocumentAdmin)
 
@@ -0,0 +1,68 @@
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+
+from user.models import UserInvite
+
+
+def get_holder_models():
+    return {"user": get_user_model(), "userinvite": UserInvite}
+
+
+def group_holder_ids(holders):
+    # Groups holders given as dicts with type and id by their type.
+    holder_models = get_holder_models()
+    ids = {}
+    for holder in holders:
+        if holder["type"] in holder_models:
+            ids.setdefault(holder["type"], set()).add(int(holder["id"]))
+    return ids
+
+
+def get_holders(holders):
+    # Returns the users and user invites of the holders given as dicts with
+    # type and id by (type, id), with one query per type.
+    holder_models = get_holder_models()
+    holder_objects = {}
+    for type, ids in group_holder_ids(holders).items():
+        for holder_object in holder_models[type].objects.filter(id__in=ids):
+            holder_objects[(type, holder_object.id)] = holder_object
+    return holder_objects
+
+
+def holders_query(holders):
+    # Returns a Q object for the access rights of any of the holders given
+    # as dicts with type and id.
+    holder_models = get_holder_models()
+    query = Q(pk__in=[])
+    for type, ids in group_holder_ids(holders).items():
+        query |= Q(
+            holder_type=ContentType.objects.get_for_model(holder_models[type]),
+            holder_id__in=ids,
+        )
+    return query
+
+
+def resolve_holders(access_rights):
+    # Sets the holders of access rights with one query per holder type
+    # instead of one query per access right. Returns the access rights whose
+    # holder exists.
+    access_rights = list(access_rights)
+    holders = [
+        {
+            "type": ContentType.objects.get_for_id(
+                access_right.holder_type_id
+            ).model,
+            "id": access_right.holder_id,
+        }
+        for access_right in access_rights
+    ]
+    holder_objects = get_holders(holders)
+    resolved = []
+    for access_right, holder in zip(access_rights, holders):
+        holder_object = holder_objects.get((holder["type"], holder["id"]))
+        if holder_object is None:
+            continue
+        access_right.holder_obj = holder_object
+        resolved.append(access_right)
+    return resolved
@@ -0,0 +1,84 @@
+from jsonpatch import apply_patch, JsonPatchConflict
+from jsonpointer import JsonPointer, JsonPointerException
+
+
+def apply_patch_with_rollback(doc, patch):
+    """
+    Applies a JSON patch to doc in place. If one of the operations fails,
+    the operations that have already been applied are undone and the
+    JsonPatchConflict or JsonPointerException is raised. Instead of copying
+    the entire document beforehand, the inverse of each operation is recorded
+    while the patch is being applied, so the cost depends on the size of the
+    patch rather than on the size of the document.
+    """
+    inverse_operations = []
+    try:
+        for patch_operation in patch:
+            for operation in split_operation(doc, patch_operation):
+                inverse_operation = get_inverse_operation(doc, operation)
+                apply_patch(doc, [operation], True)
+                if inverse_operation:
+                    inverse_operations.append(inverse_operation)
+    except (JsonPatchConflict, JsonPointerException):
+        if inverse_operations:
+            apply_patch(doc, list(reversed(inverse_operations)), True)
+        raise
+
+
+def split_operation(doc, operation):
+    # A move is applied as a remove followed by an add, so that it can be
+    # undone also if the add fails after the value has been removed.
+    from_path = operation.get("from")
+    path = operation.get("path")
+    if (
+        operation.get("op") != "move"
+        or None in [from_path, path]
+        or from_path == path
+    ):
+        return [operation]
+    from_pointer = JsonPointer(from_path)
+    if isinstance(from_pointer.to_last(doc)[0], dict) and JsonPointer(
+        path
+    ).contains(from_pointer):
+        raise JsonPatchConflict("Cannot move values into their own children")
+    return [
+        {"op": "remove", "path": from_path},
+        {
+            "op": "add",
+            "path": path,
+            "value": from_pointer.resolve(doc),
+        },
+    ]
+
+
+def get_inverse_operation(doc, operation):
+    # Returns the operation that undoes the given operation. Values that are
+    # removed or replaced are not copied as the patch only detaches them
+    # from the document. Operations on the root cannot be applied in place,
+    # so they do not need to be undone.
+    op = operation.get("op")
+    path = operation.get("path")
+    if not path:
+        return None
+    if op in ["add", "copy"]:
+        parent, part = JsonPointer(path).to_last(doc)
+        if isinstance(parent, list):
+            if part == "-":
+                path = f"{path[:-2]}/{len(parent)}"
+            return {"op": "remove", "path": path}
+        if isinstance(parent, dict) and part in parent:
+            return {"op": "replace", "path": path, "value": parent[part]}
+        return {"op": "remove", "path": path}
+    elif op == "remove":
+        return {
+            "op": "add",
+            "path": path,
+            "value": JsonPointer(path).resolve(doc),
+        }
+    elif op == "replace":
+        return {
+            "op": "replace",
+            "path": path,
+            "value": JsonPointer(path).resolve(doc),
+        }
+    return None
@@ -21,9 +21,9 @@ class SessionUserInfo:
     def create_doc(self, template_id):
         template = DocumentTemplate.objects.filter(id=int(template_id)).first()
         if template:
-            document = Document.objects.create(
-                owner_id=self.user.id, template=template
-            )
+            document = Document(owner_id=self.user.id, template=template)
+            document.set_template_content()
+            document.save()
         else:
             document = Document.objects.create(owner_id=self.user.id)
         return document
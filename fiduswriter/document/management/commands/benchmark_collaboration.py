@@ -0,0 +1,555 @@
+import asyncio
+import io
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager, redirect_stdout
+from statistics import quantiles
+from tempfile import mkdtemp
+from time import perf_counter, thread_time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import Client
+from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.websocket import websocket_connect
+
+from base.management import BaseCommand
+from base.servers.tornado_django_hybrid import make_tornado_server
+from document import prosemirror
+from document.models import AccessRight, Document, DocumentTemplate
+from document.ws_views import WebSocket
+
+# Diffs that have not been confirmed or rejected after this number of
+# seconds are given up.
+DIFF_TIMEOUT = 10
+# The loggers of the websocket connections, which log every message at the
+# DEBUG level.
+WS_LOGGERS = ["base.ws_handler", "document.ws_views"]
+
+
+class Statistics:
+    def __init__(self):
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.conflicts = 0
+        self.timeouts = 0
+        self.errors = 0
+
+
+class BenchmarkClient:
+    """
+    A simulated editor of a document. It sends diffs, selection changes and
+    chat messages in the way the JavaScript client does, keeps track of the
+    message counters and the document version and measures how long it
+    takes until a diff is confirmed.
+    """
+
+    def __init__(self, url, user_id, cookie, statistics, options):
+        self.url = url
+        self.user_id = user_id
+        self.cookie = cookie
+        self.statistics = statistics
+        self.options = options
+        self.ws = None
+        self.client = 0
+        self.server = 0
+        self.version = None
+        self.position = None
+        self.session_id = None
+        self.rid = 0
+        # The diff that has not been confirmed yet and the time at which it
+        # was first sent.
+        self.pending = None
+        self.pending_since = None
+        self.resend_scheduled = False
+        self.subscribed = asyncio.Event()
+
+    async def connect(self):
+        self.ws = await websocket_connect(
+            HTTPRequest(self.url, headers={"Cookie": self.cookie})
+        )
+        asyncio.get_running_loop().create_task(self.receive())
+        await self.subscribed.wait()
+
+    def send(self, message):
+        self.client += 1
+        message["c"] = self.client
+        message["s"] = self.server
+        self.statistics.sent += 1
+        self.ws.write_message(json.dumps(message))
+
+    async def receive(self):
+        while True:
+            data = await self.ws.read_message()
+            if data is None:
+                return
+            self.statistics.received += 1
+            message = json.loads(data)
+            if "s" not in message:
+                # request_resend or access_denied
+                self.statistics.errors += 1
+                continue
+            if message["s"] <= self.server:
+                # Message sent again by the server.
+                continue
+            if message["s"] > self.server + 1:
+                self.statistics.errors += 1
+            self.server = message["s"]
+            self.handle_message(message)
+
+    def handle_message(self, message):
+        if message["type"] == "welcome":
+            self.send({"type": "subscribe"})
+        elif message["type"] == "doc_data":
+            self.set_document(message)
+        elif message["type"] == "confirm_diff":
+            if self.pending and message["rid"] == self.pending["rid"]:
+                self.statistics.latencies.append(
+                    perf_counter() - self.pending_since
+                )
+                self.pending = None
+                self.version += 1
+        elif message["type"] == "reject_diff":
+            if self.pending and message["rid"] == self.pending["rid"]:
+                self.statistics.conflicts += 1
+                self.schedule_resend()
+        elif message["type"] == "diff":
+            if message["v"] == self.version:
+                self.version += 1
+            if "server_fix" in message and self.pending:
+                # The server has not applied the pending diff as it was
+                # based on an older version.
+                self.statistics.conflicts += 1
+                self.schedule_resend()
+
+    def set_document(self, message):
+        self.version = message["doc"]["v"]
+        self.session_id = message["doc_info"]["session_id"]
+        node = prosemirror.from_json(
+            {"type": "doc", "content": [message["doc"]["content"]]}
+        )
+
+        # Type into the last text block, usually a paragraph of the body.
+        def find_text_block(child, pos, parent, index):
+            if child.is_text_block:
+                self.position = pos + 1
+                return False
+
+        node.descendants(find_text_block)
+        self.subscribed.set()
+
+    def schedule_resend(self):
+        # Several messages can show that a diff has not been applied, so it
+        # is sent again after they have been received.
+        if not self.resend_scheduled:
+            self.resend_scheduled = True
+            asyncio.get_running_loop().call_later(0.01, self.resend_diff)
+
+    def resend_diff(self):
+        self.resend_scheduled = False
+        if self.pending:
+            self.send_diff(self.pending["ds"])
+
+    def send_diff(self, steps):
+        self.rid += 1
+        self.pending = {
+            "type": "diff",
+            "v": self.version,
+            "rid": self.rid,
+            "cid": self.session_id,
+            "ds": steps,
+        }
+        self.send(dict(self.pending))
+
+    def create_steps(self):
+        # A few characters typed one after another.
+        return [
+            {
+                "stepType": "replace",
+                "from": self.position + index,
+                "to": self.position + index,
+                "slice": {
+                    "content": [
+                        {"type": "text", "text": random.choice("abcdef ")}
+                    ]
+                },
+            }
+            for index in range(random.randint(1, self.options["steps"]))
+        ]
+
+    async def run(self, end):
+        interval = 1 / self.options["rate"]
+        while perf_counter() < end:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * interval)
+            if self.pending:
+                if perf_counter() - self.pending_since > DIFF_TIMEOUT:
+                    self.statistics.timeouts += 1
+                    self.pending = None
+                else:
+                    # Only one diff can be waiting for confirmation.
+                    continue
+            action = random.random()
+            if action < self.options["diff_share"]:
+                self.pending_since = perf_counter()
+                self.send_diff(self.create_steps())
+            elif action < 0.95:
+                self.send(
+                    {
+                        "type": "selection_change",
+                        "id": self.user_id,
+                        "v": self.version,
+                        "session_id": self.session_id,
+                        "anchor": self.position,
+                        "head": self.position,
+                        "editor": "main",
+                    }
+                )
+            else:
+                self.send({"type": "chat", "body": "Lorem ipsum dolor sit."})
+
+    def close(self):
+        self.ws.close()
+
+
+class FormattingHandler(logging.Handler):
+    # Formats log records like a real handler but does not write them.
+    def emit(self, record):
+        self.format(record)
+
+
+class ServerThread(threading.Thread):
+    # Runs the Tornado server in its own IOLoop so that its CPU time can be
+    # measured separately from the clients.
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.ready = threading.Event()
+
+    def run(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.io_loop = IOLoop.current()
+        sockets = bind_sockets(0, "127.0.0.1")
+        self.port = sockets[0].getsockname()[1]
+        self.server = make_tornado_server()
+        self.server.add_sockets(sockets)
+        self.ready.set()
+        self.io_loop.start()
+
+    def call(self, function):
+        # Calls function on the IOLoop of the server and returns its result.
+        future = Future()
+
+        def call_function():
+            try:
+                future.set_result(function())
+            except Exception as e:
+                future.set_exception(e)
+
+        self.io_loop.add_callback(call_function)
+        return future.result(timeout=30)
+
+    def stop(self):
+        self.call(self.server.stop)
+        self.io_loop.add_callback(self.io_loop.stop)
+        self.join()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure how many concurrent editors the collaboration server can "
+        "handle. The server is started with a temporary test database and "
+        "is connected to by simulated editors."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--documents",
+            type=int,
+            default=4,
+            help="Number of documents that are edited.",
+        )
+        parser.add_argument(
+            "--clients",
+            type=int,
+            default=5,
+            help="Number of editors per document.",
+        )
+        parser.add_argument(
+            "--duration",
+            type=float,
+            default=20,
+            help="Number of seconds to send messages for.",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=5,
+            help="Number of messages per second and editor.",
+        )
+        parser.add_argument(
+            "--diff-share",
+            type=float,
+            default=0.6,
+            help="Share of the messages that are diffs. Most of the others "
+            "are selection changes, the rest chat messages.",
+        )
+        parser.add_argument(
+            "--steps",
+            type=int,
+            default=5,
+            help="Maximum number of steps per diff.",
+        )
+        parser.add_argument(
+            "--log-level",
+            choices=["INFO", "DEBUG"],
+            help="Log the messages of the server at this level. The records "
+            "are formatted, including the diffs sampled according to "
+            "WS_LOG_PAYLOAD_SAMPLE_RATE, but not written. At DEBUG, every "
+            "message is formatted, as all of them were before debug log "
+            "messages were formatted lazily. Compare the CPU time of both "
+            "levels to see the cost of logging per message.",
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            help="Output the results as JSON.",
+        )
+        parser.add_argument(
+            "--max-p99",
+            type=float,
+            help="Fail if the 99th percentile of the time until a diff is "
+            "confirmed is higher than this number of milliseconds.",
+        )
+        parser.add_argument(
+            "--min-throughput",
+            type=float,
+            help="Fail if fewer diffs than this are confirmed per second.",
+        )
+
+    def handle(self, *args, **options):
+        database_dir = None
+        if connection.vendor == "sqlite":
+            # A file, as the in-memory database cannot be shared with the
+            # threads of the server.
+            database_dir = mkdtemp()
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(
+                database_dir, "benchmark.sqlite3"
+            )
+        # Some migrations print to stdout, which would break the JSON output.
+        with redirect_stdout(io.StringIO()):
+            old_name = connection.creation.create_test_db(
+                verbosity=0, autoclobber=True, serialize=False
+            )
+        try:
+            call_command(
+                "loaddata",
+                "initial_documenttemplates.json",
+                "initial_styles.json",
+                verbosity=0,
+            )
+            with self.ws_logging(options["log_level"]):
+                results = self.run_benchmark(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if database_dir:
+                shutil.rmtree(database_dir, ignore_errors=True)
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.write_results(results)
+        failures = []
+        if options["max_p99"] is not None and (
+            results["latency_p99_ms"] is None
+            or results["latency_p99_ms"] > options["max_p99"]
+        ):
+            failures.append(
+                f"p99 latency {results['latency_p99_ms']} ms is higher than "
+                f"{options['max_p99']} ms"
+            )
+        if (
+            options["min_throughput"] is not None
+            and results["diffs_per_second"] < options["min_throughput"]
+        ):
+            failures.append(
+                f"{results['diffs_per_second']} diffs per second are fewer "
+                f"than {options['min_throughput']}"
+            )
+        if failures:
+            raise CommandError("; ".join(failures))
+
+    @contextmanager
+    def ws_logging(self, level):
+        if level is None:
+            yield
+            return
+        handler = FormattingHandler()
+        loggers = [logging.getLogger(name) for name in WS_LOGGERS]
+        previous = [(logger.level, logger.propagate) for logger in loggers]
+        for logger in loggers:
+            logger.setLevel(level)
+            logger.propagate = False
+            logger.addHandler(handler)
+        try:
+            yield
+        finally:
+            for logger, (level, propagate) in zip(loggers, previous):
+                logger.removeHandler(handler)
+                logger.setLevel(level)
+                logger.propagate = propagate
+
+    def create_cookies(self, count):
+        cookies = []
+        User = get_user_model()
+        for number in range(count):
+            user = User.objects.create_user(
+                f"benchmark{number}",
+                f"benchmark{number}@example.com",
+                "benchmark",
+            )
+            client = Client()
+            client.force_login(user)
+            session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+            cookies.append(
+                (user, f"{settings.SESSION_COOKIE_NAME}={session_key}")
+            )
+        return cookies
+
+    def run_benchmark(self, options):
+        template = DocumentTemplate.objects.first()
+        users = self.create_cookies(options["clients"])
+        owner = users[0][0]
+        documents = []
+        for number in range(options["documents"]):
+            document = Document.objects.create(
+                owner=owner, template=template, title=f"Benchmark {number}"
+            )
+            for user, cookie in users[1:]:
+                AccessRight.objects.create(
+                    holder_obj=user, document=document, rights="write"
+                )
+            documents.append(document)
+        server = ServerThread()
+        server.start()
+        server.ready.wait()
+        statistics = Statistics()
+        clients = [
+            BenchmarkClient(
+                f"ws://127.0.0.1:{server.port}/ws/document/{document.id}/",
+                user.id,
+                cookie,
+                statistics,
+                options,
+            )
+            for document in documents
+            for user, cookie in users
+        ]
+        cpu_start = server.call(thread_time)
+        duration, cpu_end, sessions = asyncio.run(
+            self.run_clients(server, clients, options)
+        )
+        cpu = cpu_end - cpu_start
+        server.stop()
+        latencies = sorted(statistics.latencies)
+        percentiles = [None] * 99
+        if len(latencies) > 1:
+            percentiles = [
+                round(latency * 1000, 1)
+                for latency in quantiles(latencies, n=100, method="inclusive")
+            ]
+        return {
+            "documents": options["documents"],
+            "clients": len(clients),
+            "log_level": options["log_level"],
+            "duration": round(duration, 1),
+            "messages_sent": statistics.sent,
+            "messages_received": statistics.received,
+            "diffs_confirmed": len(latencies),
+            "diffs_per_second": round(len(latencies) / duration, 1),
+            "messages_per_second": round(
+                (statistics.sent + statistics.received) / duration, 1
+            ),
+            "latency_p50_ms": percentiles[49],
+            "latency_p99_ms": percentiles[98],
+            "latency_max_ms": (
+                round(latencies[-1] * 1000, 1) if latencies else None
+            ),
+            "conflicts": statistics.conflicts,
+            "timeouts": statistics.timeouts,
+            "errors": statistics.errors,
+            "server_cpu_seconds": round(cpu, 2),
+            "server_cpu_percent": round(cpu / duration * 100, 1),
+            # Per message received or sent by the server.
+            "server_cpu_us_per_message": round(
+                cpu / max(statistics.sent + statistics.received, 1) * 1000000,
+                1,
+            ),
+            # Includes the clients, as they run in the same process.
+            "max_rss_mb": round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+            ),
+            "session_size_mb": round(
+                sum(session["size"] for session in sessions) / 1024 / 1024, 2
+            ),
+        }
+
+    async def run_clients(self, server, clients, options):
+        await asyncio.gather(*[client.connect() for client in clients])
+        start = perf_counter()
+        end = start + options["duration"]
+        await asyncio.gather(*[client.run(end) for client in clients])
+        # Wait for the last diffs to be confirmed.
+        while (
+            any(client.pending for client in clients)
+            and perf_counter() < end + DIFF_TIMEOUT
+        ):
+            await asyncio.sleep(0.05)
+        duration = perf_counter() - start
+        cpu_end = server.call(thread_time)
+        sessions = server.call(WebSocket.create_session_report)
+        for client in clients:
+            client.close()
+        # Wait for the server to save the documents and close the sessions.
+        while WebSocket.sessions and perf_counter() < start + 30:
+            await asyncio.sleep(0.05)
+        return duration, cpu_end, sessions
+
+    def write_results(self, results):
+        self.stdout.write(
+            f"{results['clients']} editors of {results['documents']} "
+            f"documents during {results['duration']} seconds"
+        )
+        if results["log_level"]:
+            self.stdout.write(f"Log level: {results['log_level']}")
+        self.stdout.write(
+            f"Messages: {results['messages_sent']} sent, "
+            f"{results['messages_received']} received, "
+            f"{results['messages_per_second']} per second"
+        )
+        self.stdout.write(
+            f"Diffs: {results['diffs_confirmed']} confirmed, "
+            f"{results['diffs_per_second']} per second, "
+            f"{results['conflicts']} conflicts, {results['timeouts']} "
+            f"timeouts, {results['errors']} errors"
+        )
+        self.stdout.write(
+            f"Confirmation latency: p50 {results['latency_p50_ms']} ms, "
+            f"p99 {results['latency_p99_ms']} ms, "
+            f"max {results['latency_max_ms']} ms"
+        )
+        self.stdout.write(
+            f"Server: {results['server_cpu_percent']}% CPU of the IOLoop "
+            f"thread, {results['server_cpu_us_per_message']} µs CPU per "
+            f"message, {results['session_size_mb']} MB in sessions, "
+            f"{results['max_rss_mb']} MB maximum resident memory"
+        )
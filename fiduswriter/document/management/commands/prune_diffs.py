@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.db.models import Max
+
+from base.management import BaseCommand
+from document.models import DocumentDiff
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete stored document diffs that are older than the history "
+        "length of the collaboration server (DOC_HISTORY_LENGTH)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--keep",
+            type=int,
+            dest="keep",
+            default=settings.DOC_HISTORY_LENGTH,
+            help="Number of diffs to keep per document",
+        )
+
+    def handle(self, *args, **options):
+        documents = (
+            DocumentDiff.objects.values("document_id")
+            .order_by()
+            .annotate(last_version=Max("version"))
+        )
+        deleted = 0
+        for document in documents.iterator():
+            count, _ = DocumentDiff.objects.filter(
+                document_id=document["document_id"],
+                version__lte=document["last_version"] - options["keep"],
+            ).delete()
+            deleted += count
+        self.stdout.write(f"Deleted {deleted} document diffs")
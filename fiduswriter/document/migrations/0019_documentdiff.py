@@ -0,0 +1,79 @@
+# Generated by Django 4.1.9 on 2026-10-18 18:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def diffs_to_rows(apps, schema_editor):
+    Document = apps.get_model("document", "Document")
+    DocumentDiff = apps.get_model("document", "DocumentDiff")
+    documents = Document.objects.only("id", "diffs").iterator()
+    for document in documents:
+        if not document.diffs:
+            continue
+        DocumentDiff.objects.bulk_create(
+            [
+                DocumentDiff(
+                    document_id=document.id, version=diff["v"], diff=diff
+                )
+                for diff in document.diffs
+                if "v" in diff
+            ],
+            ignore_conflicts=True,
+        )
+        # Using update() so that the updated field is not changed.
+        Document.objects.filter(id=document.id).update(diffs=[])
+
+
+def rows_to_diffs(apps, schema_editor):
+    Document = apps.get_model("document", "Document")
+    DocumentDiff = apps.get_model("document", "DocumentDiff")
+    document_ids = (
+        DocumentDiff.objects.values_list("document_id", flat=True)
+        .order_by()
+        .distinct()
+    )
+    for document_id in document_ids:
+        diffs = list(
+            DocumentDiff.objects.filter(document_id=document_id)
+            .order_by("version")
+            .values_list("diff", flat=True)
+        )
+        Document.objects.filter(id=document_id).update(diffs=diffs)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("document", "0018_fidus_3_4"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DocumentDiff",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("version", models.PositiveIntegerField()),
+                ("diff", models.JSONField(default=dict)),
+                (
+                    "document",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="document.document",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["version"],
+                "unique_together": {("document", "version")},
+            },
+        ),
+        migrations.RunPython(diffs_to_rows, rows_to_diffs),
+    ]
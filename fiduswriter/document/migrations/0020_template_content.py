@@ -0,0 +1,32 @@
+from copy import deepcopy
+
+from django.db import migrations
+
+
+def set_template_content(apps, schema_editor):
+    # Documents that have never been opened have no content. They used to be
+    # filled in from their template whenever their content was requested.
+    Document = apps.get_model("document", "Document")
+    documents = (
+        Document.objects.exclude(content__has_key="type")
+        .select_related("template")
+        .only("id", "content", "template__content")
+    )
+    for document in documents.iterator(chunk_size=100):
+        content = deepcopy(document.template.content)
+        if "type" not in content:
+            content["type"] = "article"
+        if "content" not in content:
+            content["content"] = [{"type": "title"}]
+        # Using update() so that the updated field is not changed.
+        Document.objects.filter(id=document.id).update(content=content)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("document", "0019_documentdiff"),
+    ]
+
+    operations = [
+        migrations.RunPython(set_template_content, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,6 @@
 from builtins import str
 from builtins import object
+from copy import deepcopy
 
 from django.db import models
 from django.db.utils import OperationalError, ProgrammingError
@@ -94,9 +95,8 @@ class Document(models.Model):
     # and is therefore not handed to the editor or document overview page.
     version = models.PositiveIntegerField(default=0)
     diffs = models.JSONField(default=list, blank=True)
-    # The last few diffs that were received and approved. The number of stored
-    # diffs should always be equivalent to or more than all the diffs since the
-    # last full save of the document.
+    # Only used when upgrading documents. The diffs that were received and
+    # approved are stored as DocumentDiff objects.
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         related_name="owner",
@@ -136,6 +136,17 @@ class Document(models.Model):
     def get_absolute_url(self):
         return "/document/%i/" % self.id
 
+    def set_template_content(self):
+        # Gives a new document the content of its template. New documents
+        # receive it when they are created and imported documents when their
+        # content is uploaded. Older documents have been filled in by
+        # migration 0020.
+        self.content = deepcopy(self.template.content)
+        if "type" not in self.content:
+            self.content["type"] = "article"
+        if "content" not in self.content:
+            self.content["content"] = [{"type": "title"}]
+
     def is_deletable(self):
         reverse_relations = [
             f
@@ -149,6 +160,7 @@ class Document(models.Model):
                 "accessrightinvite",
                 "documentrevision",
                 "documentimage",
+                "documentdiff",
             ]
         ]
 
@@ -187,6 +199,27 @@ class Document(models.Model):
             return []
 
 
+class DocumentDiff(models.Model):
+    # The last few diffs that were received and approved. Each diff is stored
+    # separately so that accepting a diff does not require the document to be
+    # rewritten. The number of stored diffs should always be equivalent to or
+    # more than all the diffs since the last full save of the document.
+    document = models.ForeignKey(Document, on_delete=models.deletion.CASCADE)
+    version = models.PositiveIntegerField()
+    # The version of the document that the diff was applied to.
+    diff = models.JSONField(default=dict)
+
+    class Meta(object):
+        unique_together = (("document", "version"),)
+        ordering = ["version"]
+
+    def __str__(self):
+        return "%(version)d of %(doc_id)d" % {
+            "version": self.version,
+            "doc_id": self.document_id,
+        }
+
+
 RIGHTS_CHOICES = (
     ("write", "Writer"),
     # Can write content and can read+write comments.
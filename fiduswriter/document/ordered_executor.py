@@ -0,0 +1,81 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import sleep
+
+from django.conf import settings
+from django.db import close_old_connections
+
+
+class OrderedExecutor:
+    """
+    Runs blocking database work of the collaboration server in a bounded
+    pool of threads so that a slow query does not block the IOLoop and with
+    it all other connections. Tasks with the same key, the id of the
+    document they belong to, run one after another in the order in which
+    they were submitted. Tasks of different documents run in parallel.
+    """
+
+    def __init__(self, max_workers, thread_name_prefix):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self.executor = None
+        self.lock = threading.Lock()
+        # The tasks waiting for the running task of each key.
+        self.queues = {}
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix=self.thread_name_prefix,
+            )
+        return self.executor
+
+    def submit(self, key, function, *args, **kwargs):
+        # Returns a concurrent.futures.Future with the result of function.
+        future = Future()
+        if settings.TESTING:
+            # The test server shares its database connection with the tests,
+            # which a worker thread cannot use.
+            self.run_task(future, function, args, kwargs)
+            return future
+        with self.lock:
+            if key in self.queues:
+                self.queues[key].append((future, function, args, kwargs))
+                return future
+            self.queues[key] = deque()
+        self.get_executor().submit(
+            self.run, key, future, function, args, kwargs
+        )
+        return future
+
+    def run(self, key, future, function, args, kwargs):
+        while future:
+            close_old_connections()
+            self.run_task(future, function, args, kwargs)
+            with self.lock:
+                if self.queues[key]:
+                    future, function, args, kwargs = self.queues[key].popleft()
+                else:
+                    del self.queues[key]
+                    future = None
+
+    def run_task(self, future, function, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(function(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def shutdown(self):
+        # Waits until all submitted tasks have run.
+        while True:
+            with self.lock:
+                if not self.queues:
+                    break
+            sleep(0.01)
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
@@ -1,44 +1,222 @@
 import os
 import json
+import stat
+import pickle
+import hashlib
 from copy import deepcopy
+from functools import lru_cache
+from importlib.metadata import version
+from tempfile import gettempdir, mkstemp
+from time import monotonic
 
-from prosemirror.model import Node, Schema
+from prosemirror.model import ContentMatch, Fragment, Mark, Node, Schema, Slice
 from prosemirror.transform import Step
 
 from django.conf import settings
 
-schema_json_path = os.path.join(
-    settings.PROJECT_PATH, "static-libs/json/schema.json"
-)
 
-if os.path.exists(schema_json_path):
-    with open(schema_json_path) as schema_file:
-        schema = Schema(json.loads(schema_file.read()))
-else:
-    schema = None
+class StepSchema(Schema):
+    # Marks are immutable, so the marks of all steps that have the same type
+    # and attributes can share one Mark object instead of creating a new one
+    # for every step.
+    def __init__(self, spec):
+        super().__init__(spec)
+        self.create_mark_cache()
+
+    def create_mark_cache(self):
+        self.cached_mark_from_json = lru_cache(maxsize=1024)(
+            lambda mark_json: Mark.from_json(self, json.loads(mark_json))
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["cached_mark_from_json"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.create_mark_cache()
+
+    def mark_from_json(self, json_data):
+        if isinstance(json_data, str):
+            return self.cached_mark_from_json(json_data)
+        return self.cached_mark_from_json(
+            json.dumps(json_data, sort_keys=True)
+        )
+
+
+# Empty values that prosemirror-py compares by identity. They are pickled as
+# references so that the unpickled schema uses the same objects.
+SHARED_OBJECTS = {
+    "content_match": ContentMatch.empty,
+    "fragment": Fragment.empty,
+    "marks": Mark.none,
+    "slice": Slice.empty,
+}
+
+
+class SchemaPickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        for name, shared_object in SHARED_OBJECTS.items():
+            if obj is shared_object:
+                return name
+        return None
+
+
+class SchemaUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return SHARED_OBJECTS[pid]
+
+
+# The schema is only loaded once it is used and is loaded again if the schema
+# file has changed since. The file is checked at most every
+# SCHEMA_CHECK_INTERVAL seconds.
+SCHEMA_CHECK_INTERVAL = 10
+schema = None
+schema_file_stat = None
+schema_checked = None
+
+
+def get_schema():
+    global schema, schema_file_stat, schema_checked
+    now = monotonic()
+    if schema is not None and now - schema_checked < SCHEMA_CHECK_INTERVAL:
+        return schema
+    schema_checked = now
+    schema_json_path = os.path.join(
+        settings.PROJECT_PATH, "static-libs/json/schema.json"
+    )
+    try:
+        file_stat = os.stat(schema_json_path)
+    except FileNotFoundError:
+        return None
+    if (
+        schema is None
+        or (file_stat.st_mtime_ns, file_stat.st_size) != schema_file_stat
+    ):
+        schema = load_schema(schema_json_path)
+        schema_file_stat = (file_stat.st_mtime_ns, file_stat.st_size)
+    return schema
+
+
+def get_cache_dir():
+    # The pickled schema is kept in a directory of the temporary directory
+    # that only the user running Fidus Writer can access, as unpickling a
+    # file that someone else has written could run their code.
+    cache_dir = os.path.join(gettempdir(), f"fiduswriter-{os.getuid()}")
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    dir_stat = os.lstat(cache_dir)
+    if (
+        not stat.S_ISDIR(dir_stat.st_mode)
+        or dir_stat.st_uid != os.getuid()
+        or dir_stat.st_mode & 0o077
+    ):
+        raise PermissionError(f"{cache_dir} is not private.")
+    return cache_dir
+
+
+def load_schema(schema_json_path):
+    # Building the schema takes longer than unpickling it, so the built schema
+    # is cached together with a key made from the hash of the schema file and
+    # the version of the prosemirror-py package.
+    with open(schema_json_path, "rb") as schema_file:
+        schema_json = schema_file.read()
+    key = (
+        hashlib.sha256(schema_json).hexdigest(),
+        version("prosemirror-py"),
+    )
+    try:
+        schema_pickle_path = os.path.join(get_cache_dir(), "schema.pickle")
+    except OSError:
+        return StepSchema(json.loads(schema_json))
+    try:
+        with open(schema_pickle_path, "rb") as pickle_file:
+            pickle_key, pickled_schema = SchemaUnpickler(pickle_file).load()
+        if pickle_key == key:
+            return pickled_schema
+    except Exception:
+        # A missing or broken pickle file is replaced below.
+        pass
+    loaded_schema = StepSchema(json.loads(schema_json))
+    pickle_file_path = None
+    try:
+        # Other processes may read the pickle file at the same time, so it
+        # is written to a temporary file first.
+        pickle_file, pickle_file_path = mkstemp(
+            dir=os.path.dirname(schema_pickle_path)
+        )
+        with open(pickle_file, "wb") as f:
+            SchemaPickler(f).dump((key, loaded_schema))
+        os.replace(pickle_file_path, schema_pickle_path)
+    except Exception:
+        # The schema is built again next time.
+        if pickle_file_path and os.path.exists(pickle_file_path):
+            os.unlink(pickle_file_path)
+    return loaded_schema
 
 
 def from_json(json):
-    return Node.from_json(schema, json)
+    return Node.from_json(get_schema(), json)
 
 
 def apply(steps, node):
-    for step_obj in steps:
-        step = Step.from_json(schema, step_obj)
-        step_result = step.apply(node)
-        if step_result.ok:
-            node = step_result.doc
-        else:
-            return False
+    node, failure = apply_batch([steps], node)
+    if failure:
+        return False
     return node
 
 
-def to_mini_json(node):
+def apply_batch(step_lists, node):
+    # Applies several lists of steps, for example those of consecutive diffs,
+    # in one pass. Returns the node after the last list that could be applied
+    # completely and either None or, if a step could not be parsed or
+    # applied, a tuple with the index of its list and its index within that
+    # list.
+    schema = get_schema()
+    for list_index, steps in enumerate(step_lists):
+        updated_node = node
+        for step_index, step_obj in enumerate(steps):
+            try:
+                step_result = Step.from_json(schema, step_obj).apply(
+                    updated_node
+                )
+            except (ValueError, KeyError, TypeError):
+                step_result = None
+            if step_result is None or step_result.failed is not None:
+                return node, (list_index, step_index)
+            updated_node = step_result.doc
+        node = updated_node
+    return node, None
+
+
+def to_mini_json(node, cache=None):
     # Similar to the ProseMirror internal toJSON function,
     # but leaving out attributes that have default values and dealing with
     # attributes that are objects.
     # Adapted from https://github.com/ProseMirror/prosemirror-model/blob/
     # 6d970507cd0da48653d3b72f2731a71a144a364b/src/node.js#L340-L351
+    #
+    # If a cache dict is given, the JSON of nodes that were serialized during
+    # the previous call with the same cache is reused. Nodes are immutable and
+    # applying steps only replaces the nodes along the changed path, so most
+    # of a document does not have to be serialized again. Afterwards, the
+    # cache only contains the nodes that were visited. The returned JSON
+    # shares objects with the cache and must not be modified.
+    if cache is None:
+        return _to_mini_json(node, None, None)
+    previous = dict(cache)
+    cache.clear()
+    return _to_mini_json(node, previous, cache)
+
+
+def _to_mini_json(node, previous, cache):
+    if previous is not None:
+        # Nodes are stored along with their JSON so that the id cannot have
+        # been reused by another node.
+        cached = previous.get(id(node))
+        if cached and cached[0] is node:
+            cache[id(node)] = cached
+            return cached[1]
     obj = {"type": node.type.name}
 
     for attr in node.attrs:
@@ -47,11 +225,16 @@ def to_mini_json(node):
                 obj["attrs"] = {}
             obj["attrs"][attr] = deepcopy(node.attrs[attr])
     if getattr(node.content, "size", None):
-        obj["content"] = list(map(to_mini_json, node.content.content))
+        obj["content"] = [
+            _to_mini_json(child, previous, cache)
+            for child in node.content.content
+        ]
     if len(node.marks):
         obj["marks"] = list(map(to_mini_mark_json, node.marks))
     if hasattr(node, "text"):
         obj["text"] = node.text
+    if cache is not None:
+        cache[id(node)] = (node, obj)
     return obj
 
 
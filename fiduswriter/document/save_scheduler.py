@@ -0,0 +1,111 @@
+import logging
+from copy import copy, deepcopy
+
+from tornado.ioloop import IOLoop
+from django.conf import settings
+
+from base import metrics
+
+logger = logging.getLogger(__name__)
+
+save_errors = metrics.Counter(
+    "fiduswriter_document_save_errors_total",
+    "Documents that could not be saved in the background.",
+)
+
+
+class SaveScheduler:
+    """
+    Saves the documents of collaboration sessions in the threads of an
+    OrderedExecutor so that the IOLoop is not blocked by the database. The
+    saves of a document are written in order. A document is saved once
+    DOC_SAVE_INTERVAL versions are unsaved or DOC_SAVE_DELAY seconds after
+    it was changed, whichever comes first. Changes that arrive while a
+    document is being saved are combined into a single save.
+    """
+
+    def __init__(self, sessions, write, prepare, executor):
+        self.sessions = sessions
+        # write(doc) saves a document to the database.
+        self.write = write
+        # prepare(session) brings the document of a session up to date
+        # before it is saved.
+        self.prepare = prepare
+        self.executor = executor
+        self.timers = {}
+        self.saving = set()
+        self.pending = set()
+
+    def mark_dirty(self, document_id):
+        session = self.sessions[document_id]
+        unsaved = session["doc"].version - session["last_saved_version"]
+        if unsaved >= settings.DOC_SAVE_INTERVAL:
+            self.flush(document_id)
+        elif document_id not in self.timers:
+            self.timers[document_id] = IOLoop.current().call_later(
+                settings.DOC_SAVE_DELAY, self.flush, document_id
+            )
+
+    def flush(self, document_id, force=False):
+        # Saves the current state of a document. Unless force is set, the
+        # save is postponed if the document is already being saved.
+        if document_id in self.timers:
+            IOLoop.current().remove_timeout(self.timers.pop(document_id))
+        session = self.sessions.get(document_id)
+        if (
+            not session
+            or session["doc"].version == session["last_saved_version"]
+        ):
+            return
+        if document_id in self.saving and not force:
+            self.pending.add(document_id)
+            return
+        self.pending.discard(document_id)
+        self.prepare(session)
+        doc = self.snapshot(session["doc"])
+        self.saving.add(document_id)
+        future = self.executor.submit(document_id, self.write, doc)
+        IOLoop.current().add_future(
+            future, lambda future: self.saved(document_id, doc, future)
+        )
+
+    def snapshot(self, doc):
+        # The session keeps changing the document while it is being saved,
+        # so the worker thread receives a copy. The session replaces the
+        # content, comments and bibliography instead of changing them in
+        # place, so the copy can share them. Only json diffs are applied to
+        # the content in place.
+        doc = copy(doc)
+        if settings.JSONPATCH:
+            doc.content = deepcopy(doc.content)
+        return doc
+
+    def saved(self, document_id, doc, future):
+        self.saving.discard(document_id)
+        if future.exception():
+            save_errors.inc()
+            logger.error(
+                f"Action:Saving document failed. DocumentID:{document_id} "
+                f"Doc version:{doc.version}",
+                exc_info=future.exception(),
+            )
+        elif document_id in self.sessions:
+            session = self.sessions[document_id]
+            session["last_saved_version"] = max(
+                session["last_saved_version"], doc.version
+            )
+        if document_id in self.pending:
+            self.flush(document_id)
+
+    def shutdown(self):
+        # Waits for running saves and then saves all remaining changes. Can
+        # be called when the IOLoop is no longer running.
+        for timer in self.timers.values():
+            IOLoop.current().remove_timeout(timer)
+        self.timers = {}
+        self.executor.shutdown()
+        for session in self.sessions.values():
+            if session["doc"].version != session["last_saved_version"]:
+                self.prepare(session)
+                self.write(session["doc"])
+                session["last_saved_version"] = session["doc"].version
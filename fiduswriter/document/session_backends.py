@@ -0,0 +1,277 @@
+import json
+import uuid
+import asyncio
+import logging
+
+from tornado.ioloop import PeriodicCallback
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LocalSessionBackend:
+    """
+    Session backend for a single process. All participants of a document
+    are connected to the same process, so there is nothing to coordinate.
+    The methods that need an answer from the other processes are coroutines.
+    """
+
+    def __init__(self, receiver):
+        # receiver(document_id, event) is called for events that were
+        # published by other processes.
+        self.receiver = receiver
+
+    async def new_participant_id(self, document_id, participants):
+        if len(participants) == 0:
+            return 0
+        return max(participants) + 1
+
+    async def claim_version(self, document_id, version):
+        # Reserve the given document version for a diff that is about to be
+        # applied. Returns False if another process has already taken it.
+        return True
+
+    def release_version(self, document_id, version):
+        pass
+
+    async def get_participant_list(self, document_id, participant_list):
+        return participant_list
+
+    def join(self, document_id):
+        pass
+
+    def leave(self, document_id):
+        pass
+
+    def publish(self, document_id, event):
+        pass
+
+    @classmethod
+    def notify(cls, event, origin=None):
+        # Publishes an event that does not belong to a document. Can be called
+        # from any thread and also in processes without websockets, such as
+        # management commands.
+        pass
+
+
+class RedisSessionBackend(LocalSessionBackend):
+    """
+    Session backend that lets participants of the same document connect to
+    several processes or servers. Version numbers are reserved atomically and
+    all other events are distributed through pub/sub, with one channel per
+    document that a process only subscribes to while it holds a session of
+    the document. Accepted diffs are stored as DocumentDiff objects, so
+    processes that open the document later can catch up from the database.
+    Any client with the API of redis.asyncio.Redis that decodes responses can
+    be handed in, otherwise a client is created from DOC_SESSION_REDIS_URL.
+    """
+
+    prefix = "fw:"
+    expiry = 24 * 60 * 60  # Keys of inactive documents expire after a day
+    # A claim only has to last until the diff has reached the other
+    # processes.
+    claim_expiry = 60
+    # Processes that have not renewed their heartbeat for heartbeat_expiry
+    # seconds are considered to be stopped and are removed from the
+    # documents they had open.
+    heartbeat_interval = 10
+    heartbeat_expiry = 30
+    # Events that do not belong to a document, such as changes to templates,
+    # are sent to all processes.
+    channel = f"{prefix}events"
+    # The synchronous client used by notify.
+    sync_client = None
+
+    def __init__(self, receiver, client=None):
+        super().__init__(receiver)
+        if client is None:
+            import redis.asyncio
+
+            client = redis.asyncio.Redis.from_url(
+                settings.DOC_SESSION_REDIS_URL, decode_responses=True
+            )
+        self.client = client
+        self.node_id = uuid.uuid4().hex
+        self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        # Commands whose result is not needed are sent one after another, so
+        # that the events of a document reach the other processes in the
+        # order in which they were published.
+        self.commands = asyncio.Queue()
+        self.beat()
+        self.heartbeat = PeriodicCallback(
+            self.beat, self.heartbeat_interval * 1000
+        )
+        self.heartbeat.start()
+        self.tasks = [
+            asyncio.ensure_future(self.send_commands()),
+            asyncio.ensure_future(self.listen()),
+        ]
+
+    def close(self):
+        self.heartbeat.stop()
+        for task in self.tasks:
+            task.cancel()
+
+    def key(self, document_id, name):
+        return f"{self.prefix}doc:{document_id}:{name}"
+
+    def node_key(self, node_id):
+        return f"{self.prefix}node:{node_id}"
+
+    def document_channel(self, document_id):
+        return self.key(document_id, "events")
+
+    def run(self, command, *args, **kwargs):
+        self.commands.put_nowait((command, args, kwargs))
+
+    async def send_commands(self):
+        while True:
+            command, args, kwargs = await self.commands.get()
+            try:
+                await command(*args, **kwargs)
+            except Exception:
+                logger.exception("Action:Redis command failed.")
+            self.commands.task_done()
+
+    def beat(self):
+        self.run(
+            self.client.set,
+            self.node_key(self.node_id),
+            1,
+            ex=self.heartbeat_expiry,
+        )
+
+    async def listen(self):
+        await self.pubsub.subscribe(self.channel)
+        async for item in self.pubsub.listen():
+            if item["type"] == "message":
+                self.handle_pubsub_message(item)
+
+    def handle_pubsub_message(self, item):
+        data = json.loads(item["data"])
+        if data["origin"] == self.node_id:
+            return
+        self.receiver(data["document_id"], data["event"])
+
+    async def new_participant_id(self, document_id, participants):
+        key = self.key(document_id, "participant_counter")
+        participant_id = await self.client.incr(key) - 1
+        self.run(self.client.expire, key, self.expiry)
+        return participant_id
+
+    async def claim_version(self, document_id, version):
+        # Every claim is a key of its own, so that it expires on its own.
+        claimed = await self.client.set(
+            self.key(document_id, f"claim:{version}"),
+            self.node_id,
+            nx=True,
+            ex=self.claim_expiry,
+        )
+        return bool(claimed)
+
+    def release_version(self, document_id, version):
+        self.run(self.client.delete, self.key(document_id, f"claim:{version}"))
+
+    async def get_other_nodes(self, document_id):
+        # The other processes that have the document open. Processes that
+        # have stopped without leaving the document are removed.
+        key = self.key(document_id, "nodes")
+        node_ids = [
+            node_id
+            for node_id in await self.client.smembers(key)
+            if node_id != self.node_id
+        ]
+        if not node_ids:
+            return []
+        heartbeats = await self.client.mget(
+            [self.node_key(node_id) for node_id in node_ids]
+        )
+        stopped_node_ids = [
+            node_id
+            for node_id, heartbeat in zip(node_ids, heartbeats)
+            if heartbeat is None
+        ]
+        if stopped_node_ids:
+            logger.info(
+                f"Action:Removing stopped processes from document. "
+                f"DocumentID:{document_id} Processes:{len(stopped_node_ids)}"
+            )
+            await self.client.srem(key, *stopped_node_ids)
+            await self.client.hdel(
+                self.key(document_id, "participants"), *stopped_node_ids
+            )
+        return [
+            node_id for node_id in node_ids if node_id not in stopped_node_ids
+        ]
+
+    async def get_participant_list(self, document_id, participant_list):
+        key = self.key(document_id, "participants")
+        await self.client.hset(key, self.node_id, json.dumps(participant_list))
+        self.run(self.client.expire, key, self.expiry)
+        node_ids = [self.node_id] + await self.get_other_nodes(document_id)
+        participant_list = []
+        for node_id, node_list in (await self.client.hgetall(key)).items():
+            if node_id in node_ids:
+                participant_list += json.loads(node_list)
+        return sorted(
+            participant_list, key=lambda participant: participant["session_id"]
+        )
+
+    def join(self, document_id):
+        key = self.key(document_id, "nodes")
+        self.run(self.client.sadd, key, self.node_id)
+        self.run(self.client.expire, key, self.expiry)
+        self.run(self.pubsub.subscribe, self.document_channel(document_id))
+
+    def leave(self, document_id):
+        self.run(self.pubsub.unsubscribe, self.document_channel(document_id))
+        self.run(self.remove_node, document_id)
+
+    async def remove_node(self, document_id):
+        key = self.key(document_id, "nodes")
+        await self.client.srem(key, self.node_id)
+        await self.client.hdel(
+            self.key(document_id, "participants"), self.node_id
+        )
+        if not await self.get_other_nodes(document_id):
+            # The document is no longer open anywhere and has been saved.
+            await self.client.delete(
+                key, self.key(document_id, "participants")
+            )
+        else:
+            self.publish(document_id, {"type": "participants"})
+
+    def publish(self, document_id, event):
+        if document_id is None:
+            channel = self.channel
+        else:
+            channel = self.document_channel(document_id)
+        self.run(
+            self.client.publish,
+            channel,
+            json.dumps(
+                {
+                    "origin": self.node_id,
+                    "document_id": document_id,
+                    "event": event,
+                }
+            ),
+        )
+
+    @classmethod
+    def notify(cls, event, origin=None):
+        if cls.sync_client is None:
+            import redis
+
+            cls.sync_client = redis.Redis.from_url(
+                settings.DOC_SESSION_REDIS_URL
+            )
+        try:
+            cls.sync_client.publish(
+                cls.channel,
+                json.dumps(
+                    {"origin": origin, "document_id": None, "event": event}
+                ),
+            )
+        except Exception:
+            logger.exception("Action:Publishing event failed.")
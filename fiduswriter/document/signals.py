@@ -1,6 +1,14 @@
-from .models import Document
-from django.db.models.signals import post_delete
+from .models import Document, DocumentTemplate
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from avatar.signals import avatar_updated
+
+from user.models import User, UserInvite
+from style.models import DocumentStyle, DocumentStyleFile, ExportTemplate
 
 
 @receiver(post_delete, sender=Document)
@@ -12,3 +20,81 @@ def delete_unused_template(sender, instance, **kwargs):
     ):
         # User's document template no longer used.
         instance.template.delete()
+
+
+def clear_cache(method, *args):
+    # Open documents cache data that is sent to every participant who joins
+    # and styles messages are cached for each template and user. The caches
+    # are only cleared once the change has been committed, as a participant
+    # who joins before could otherwise cache the old data again. Signals can
+    # be sent from other threads than the one of the websockets, so the
+    # caches of this process are cleared from the IOLoop, if any websocket
+    # has been opened. Signals can also be sent in processes without
+    # websockets, so the other processes are always informed through the
+    # session backend.
+    from document.ws_views import WebSocket
+
+    def clear():
+        import_string(settings.DOC_SESSION_BACKEND).notify(
+            {"type": "clear_cache", "method": method, "args": args},
+            origin=getattr(WebSocket.session_backend, "node_id", None),
+        )
+        if WebSocket.io_loop:
+            WebSocket.io_loop.add_callback(getattr(WebSocket, method), *args)
+
+    transaction.on_commit(clear)
+
+
+@receiver(m2m_changed, sender=User.contacts.through)
+def contacts_changed(sender, instance, action, pk_set, **kwargs):
+    if action not in ["post_add", "post_remove", "post_clear"]:
+        return
+    clear_cache("clear_owner_data", instance.id)
+    for user_id in pk_set or []:
+        clear_cache("clear_owner_data", user_id)
+
+
+@receiver(post_save, sender=UserInvite)
+@receiver(post_delete, sender=UserInvite)
+def invites_changed(sender, instance, **kwargs):
+    clear_cache("clear_owner_data", instance.by_id)
+
+
+@receiver(avatar_updated)
+def avatar_changed(sender, user, **kwargs):
+    clear_cache("clear_avatar", user.id)
+    clear_cache("clear_owner_data", user.id)
+    for contact in user.contacts.all():
+        clear_cache("clear_owner_data", contact.id)
+
+
+@receiver(post_save, sender=DocumentTemplate)
+@receiver(post_delete, sender=DocumentTemplate)
+def template_changed(sender, instance, **kwargs):
+    clear_cache("clear_template_data", instance.id)
+    # The styles message lists the templates of the user and the templates
+    # without user, which all users can see.
+    if instance.user_id:
+        clear_cache("clear_styles", instance.id, instance.user_id)
+    else:
+        clear_cache("clear_styles")
+
+
+@receiver(post_save, sender=DocumentStyle)
+@receiver(post_delete, sender=DocumentStyle)
+@receiver(post_save, sender=ExportTemplate)
+@receiver(post_delete, sender=ExportTemplate)
+def styles_changed(sender, instance, **kwargs):
+    clear_cache("clear_styles", instance.document_template_id)
+
+
+@receiver(post_save, sender=DocumentStyleFile)
+@receiver(post_delete, sender=DocumentStyleFile)
+def style_files_changed(sender, instance, **kwargs):
+    template_id = (
+        DocumentStyle.objects.filter(id=instance.style_id)
+        .values_list("document_template_id", flat=True)
+        .first()
+    )
+    if template_id:
+        clear_cache("clear_styles", template_id)
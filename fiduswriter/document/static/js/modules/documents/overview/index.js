@@ -19,6 +19,8 @@ import {
 * Helper functions for the document overview page.
 */
 
+const DOCUMENT_LIST_PAGE_SIZE = 500
+
 export class DocumentOverview {
 
     constructor({app, user}, path = "/") {
@@ -184,13 +186,23 @@ export class DocumentOverview {
         if (this.app.isOffline()) {
             return cachedPromise
         }
-        return postJson(
-            "/api/document/documentlist/"
-        ).then(
-            ({json}) => {
+        return cachedPromise.then(oldJson => {
+            if (oldJson && oldJson.sync_token) {
+                return this.loadDocumentListChanges(oldJson)
+            }
+            return this.loadDocumentList(cachedPromise)
+        }).then(
+            json => {
                 return cachedPromise.then(oldJson => {
-                    if (!deepEqual(json, oldJson)) {
+                    // The sync token changes with every request.
+                    const changed = !deepEqual(
+                        Object.assign({}, json, {sync_token: false}),
+                        Object.assign({}, oldJson, {sync_token: false})
+                    )
+                    if (changed || json.sync_token !== oldJson.sync_token) {
                         this.updateIndexedDB(json)
+                    }
+                    if (changed) {
                         this.initializeView(json)
                     }
                 })
@@ -207,6 +219,75 @@ export class DocumentOverview {
         )
     }
 
+    loadDocumentList(cachedPromise, cursor = false, json = false) {
+        // Load the document list in pages, so that users with many documents
+        // see the first documents early on.
+        const params = {limit: DOCUMENT_LIST_PAGE_SIZE}
+        if (cursor) {
+            params.cursor = cursor
+            if (json.sync_token) {
+                params.sync_token = json.sync_token
+            }
+        }
+        return postJson(
+            "/api/document/documentlist/",
+            params
+        ).then(({json: page}) => {
+            if (json) {
+                json.documents = json.documents.concat(page.documents)
+                if (!page.sync_token) {
+                    // The server has lost track of the pages sent so far.
+                    delete json.sync_token
+                }
+            } else {
+                json = page
+            }
+            const nextCursor = page.next_cursor
+            delete json.next_cursor
+            if (!nextCursor) {
+                return json
+            }
+            return cachedPromise.then(oldJson => {
+                if (!oldJson) {
+                    // Nothing has been shown from the cache.
+                    this.initializeView(json)
+                    deactivateWait()
+                }
+                return this.loadDocumentList(cachedPromise, nextCursor, json)
+            })
+        })
+    }
+
+    loadDocumentListChanges(oldJson) {
+        // Only load the changes since the cached document list was loaded.
+        return postJson(
+            "/api/document/documentlist/",
+            {sync_token: oldJson.sync_token}
+        ).then(({json: changes}) => {
+            delete changes.next_cursor
+            if (!changes.delta) {
+                // The server does not know the cached state anymore and has
+                // sent the entire list.
+                return changes
+            }
+            const removed = new Set(changes.removed_documents)
+            changes.documents.forEach(doc => removed.add(doc.id))
+            const json = Object.assign({}, oldJson, {sync_token: changes.sync_token})
+            json.documents = oldJson.documents.filter(
+                doc => !removed.has(doc.id)
+            ).concat(changes.documents).sort(
+                (docA, docB) => docB.updated - docA.updated
+            )
+            const extraKeys = ["contacts", "document_styles", "document_templates"]
+            extraKeys.forEach(key => {
+                if (key in changes) {
+                    json[key] = changes[key]
+                }
+            })
+            return json
+        })
+    }
+
     showCached() {
         return this.loaddatafromIndexedDB().then(json => {
             if (!json) {
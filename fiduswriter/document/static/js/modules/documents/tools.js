@@ -1,7 +1,34 @@
-import {addAlert, postJson} from "../common"
+import {addAlert, post} from "../common"
 import {getSettings} from "../schema/convert"
 import {acceptAllNoInsertions} from "../editor/track"
 
+const readLines = function(response, onLine) {
+    // Call onLine with every line of a newline delimited response as soon as
+    // it has been received.
+    const reader = response.body.getReader()
+    const decoder = new TextDecoder()
+    let buffer = ""
+    const read = () => reader.read().then(({done, value}) => {
+        if (done) {
+            buffer += decoder.decode()
+            if (buffer.length) {
+                onLine(buffer)
+            }
+            return
+        }
+        buffer += decoder.decode(value, {stream: true})
+        const lines = buffer.split("\n")
+        buffer = lines.pop()
+        lines.forEach(line => {
+            if (line.length) {
+                onLine(line)
+            }
+        })
+        return read()
+    })
+    return read()
+}
+
 export const getMissingDocumentListData = function(ids, documentList, schema, rawContent = false) {
     // get extra data for the documents identified by the ids and updates the
     // documentList correspondingly.
@@ -16,15 +43,17 @@ export const getMissingDocumentListData = function(ids, documentList, schema, ra
     })
 
     if (incompleteIds.length > 0) {
-        return postJson(
+        return post(
             "/api/document/documentlist/extra/",
             {
                 ids: incompleteIds.join(",")
             }
         ).then(
-            ({json}) => {
-                json.documents.forEach(
-                    extraValues => {
+            response => {
+                return readLines(
+                    response,
+                    line => {
+                        const extraValues = JSON.parse(line)
                         const doc = documentList.find(entry => entry.id === extraValues.id)
                         if (rawContent) {
                             doc.rawContent = JSON.parse(JSON.stringify(extraValues.content))
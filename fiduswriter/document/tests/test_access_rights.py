@@ -0,0 +1,220 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.test import TestCase
+from django.urls import reverse
+
+from document.models import AccessRight, Document, DocumentTemplate
+from user.models import UserInvite
+
+
+class SaveAccessRightsTest(TestCase):
+    fixtures = [
+        "initial_documenttemplates.json",
+    ]
+
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create(
+            username="Yeti", email="yeti@snowman.com"
+        )
+        self.collaborators = [
+            User.objects.create(
+                username=f"Yeti{number}",
+                email=f"yeti{number}@snowman.com",
+            )
+            for number in [2, 3]
+        ]
+        self.invite = UserInvite.objects.create(
+            username="yeti4@snowman.com",
+            email="yeti4@snowman.com",
+            by=self.owner,
+        )
+        template = DocumentTemplate.objects.first()
+        self.docs = [
+            Document.objects.create(
+                owner=self.owner, template=template, title=title
+            )
+            for title in ["First", "Second"]
+        ]
+        self.client.force_login(self.owner)
+
+    def save_access_rights(self, access_rights):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("save_access_rights"),
+                {
+                    "document_ids": json.dumps([doc.id for doc in self.docs]),
+                    "access_rights": json.dumps(access_rights),
+                },
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+            )
+        self.assertEqual(response.status_code, 201)
+
+    def user_right(self, user, rights):
+        return {"holder": {"type": "user", "id": user.id}, "rights": rights}
+
+    def get_rights(self):
+        return {
+            (ar.document_id, ar.holder_id, ar.holder_type.model): ar.rights
+            for ar in AccessRight.objects.all()
+        }
+
+    def test_create(self):
+        self.save_access_rights(
+            [
+                self.user_right(self.collaborators[0], "write"),
+                self.user_right(self.collaborators[1], "read"),
+                {
+                    "holder": {"type": "userinvite", "id": self.invite.id},
+                    "rights": "read",
+                },
+            ]
+        )
+        rights = self.get_rights()
+        self.assertEqual(len(rights), 6)
+        for doc in self.docs:
+            self.assertEqual(
+                rights[(doc.id, self.collaborators[0].id, "user")], "write"
+            )
+            self.assertEqual(
+                rights[(doc.id, self.invite.id, "userinvite")], "read"
+            )
+        # The invited person is informed by the invitation instead.
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(
+            sorted((email.to[0], email.subject) for email in mail.outbox),
+            [
+                ("yeti2@snowman.com", "Document shared: First"),
+                ("yeti2@snowman.com", "Document shared: Second"),
+                ("yeti3@snowman.com", "Document shared: First"),
+                ("yeti3@snowman.com", "Document shared: Second"),
+            ],
+        )
+        self.assertIn("has shared the document", mail.outbox[0].body)
+
+    def test_update(self):
+        self.save_access_rights(
+            [
+                self.user_right(self.collaborators[0], "write"),
+                self.user_right(self.collaborators[1], "read"),
+            ]
+        )
+        mail.outbox = []
+        self.save_access_rights(
+            [
+                self.user_right(self.collaborators[0], "read"),
+                self.user_right(self.collaborators[1], "read"),
+            ]
+        )
+        rights = self.get_rights()
+        for doc in self.docs:
+            self.assertEqual(
+                rights[(doc.id, self.collaborators[0].id, "user")], "read"
+            )
+        # Only the holder whose rights have changed is informed.
+        self.assertEqual(
+            [email.to[0] for email in mail.outbox], ["yeti2@snowman.com"] * 2
+        )
+        self.assertIn("has changed your access rights", mail.outbox[0].body)
+
+    def test_delete(self):
+        self.save_access_rights(
+            [
+                self.user_right(self.collaborators[0], "write"),
+                self.user_right(self.collaborators[1], "read"),
+            ]
+        )
+        mail.outbox = []
+        self.save_access_rights(
+            [self.user_right(self.collaborators[0], "delete")]
+        )
+        self.assertEqual(
+            set(self.get_rights()),
+            {(doc.id, self.collaborators[1].id, "user") for doc in self.docs},
+        )
+        self.assertEqual(mail.outbox, [])
+
+    def test_only_own_documents(self):
+        other_doc = Document.objects.create(
+            owner=self.collaborators[0],
+            template=DocumentTemplate.objects.first(),
+        )
+        self.docs.append(other_doc)
+        self.save_access_rights(
+            [self.user_right(self.collaborators[1], "read")]
+        )
+        self.assertFalse(
+            AccessRight.objects.filter(document=other_doc).exists()
+        )
+        self.assertEqual(len(mail.outbox), 2)
+
+
+class GetAccessRightsTest(TestCase):
+    fixtures = [
+        "initial_documenttemplates.json",
+    ]
+
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create(
+            username="Yeti", email="yeti@snowman.com"
+        )
+        self.template = DocumentTemplate.objects.first()
+        self.client.force_login(self.owner)
+
+    def share_documents(self, number):
+        # Shares number documents with number users and number user invites
+        # each.
+        User = get_user_model()
+        for index in range(number):
+            doc = Document.objects.create(
+                owner=self.owner, template=self.template
+            )
+            user = User.objects.create(
+                username=f"Yeti{number}-{index}",
+                email=f"yeti{number}-{index}@snowman.com",
+            )
+            invite = UserInvite.objects.create(
+                username=f"invite{number}-{index}@snowman.com",
+                email=f"invite{number}-{index}@snowman.com",
+                by=self.owner,
+            )
+            AccessRight.objects.create(
+                document=doc, holder_obj=user, rights="write"
+            )
+            AccessRight.objects.create(
+                document=doc, holder_obj=invite, rights="read"
+            )
+
+    def get_access_rights(self):
+        response = self.client.post(
+            reverse("get_access_rights"),
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()["access_rights"]
+
+    def test_constant_number_of_queries(self):
+        # Session, user, access rights, users, user invites and avatars.
+        self.share_documents(2)
+        with self.assertNumQueries(6):
+            self.assertEqual(len(self.get_access_rights()), 4)
+        self.share_documents(20)
+        with self.assertNumQueries(6):
+            access_rights = self.get_access_rights()
+        self.assertEqual(len(access_rights), 44)
+        self.assertEqual(
+            {
+                (access_right["holder"]["type"], access_right["rights"])
+                for access_right in access_rights
+            },
+            {("user", "write"), ("userinvite", "read")},
+        )
+        self.assertTrue(
+            all(
+                access_right["holder"]["name"]
+                for access_right in access_rights
+            )
+        )
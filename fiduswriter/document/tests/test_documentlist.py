@@ -0,0 +1,217 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+
+from document.models import AccessRight, Document, DocumentTemplate
+
+UPDATED = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+
+class DocumentListTestCase(TestCase):
+    fixtures = [
+        "initial_documenttemplates.json",
+    ]
+
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.user = User.objects.create(
+            username="Yeti", email="yeti@snowman.com"
+        )
+        self.other_user = User.objects.create(
+            username="Yeti2", email="yeti2@snowman.com"
+        )
+        self.template = DocumentTemplate.objects.first()
+        # Documents 0 and 1 as well as 2 and 3 have been updated at the same
+        # time.
+        self.docs = [
+            self.create_doc(f"Doc {number}", UPDATED + timedelta(minutes=tick))
+            for number, tick in enumerate([1, 1, 2, 2, 3])
+        ]
+        self.client.force_login(self.user)
+
+    def create_doc(self, title, updated, owner=None):
+        doc = Document.objects.create(
+            owner=owner or self.user, template=self.template, title=title
+        )
+        Document.objects.filter(id=doc.id).update(updated=updated)
+        return doc
+
+    def get_documentlist(self, **data):
+        response = self.client.post(
+            reverse("get_documentlist"),
+            data,
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        return response
+
+    def titles(self, response):
+        return [document["title"] for document in response["documents"]]
+
+
+class DocumentListTest(DocumentListTestCase):
+    def test_full_list(self):
+        response = self.get_documentlist()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.titles(response.json()),
+            ["Doc 4", "Doc 3", "Doc 2", "Doc 1", "Doc 0"],
+        )
+        self.assertIsNone(response.json()["next_cursor"])
+        self.assertIn("contacts", response.json())
+
+    def test_pages(self):
+        # The page boundaries fall between documents with the same update
+        # time.
+        response = self.get_documentlist(limit=2)
+        self.assertEqual(self.titles(response.json()), ["Doc 4", "Doc 3"])
+        self.assertIn("document_templates", response.json())
+        cursor = response.json()["next_cursor"]
+        response = self.get_documentlist(limit=2, cursor=cursor)
+        self.assertEqual(self.titles(response.json()), ["Doc 2", "Doc 1"])
+        # Following pages only contain documents.
+        self.assertNotIn("document_templates", response.json())
+        cursor = response.json()["next_cursor"]
+        response = self.get_documentlist(limit=2, cursor=cursor)
+        self.assertEqual(self.titles(response.json()), ["Doc 0"])
+        self.assertIsNone(response.json()["next_cursor"])
+
+    def test_final_cursor(self):
+        # A page that ends with the last document has no next_cursor.
+        response = self.get_documentlist(limit=5)
+        self.assertEqual(len(self.titles(response.json())), 5)
+        self.assertIsNone(response.json()["next_cursor"])
+        response = self.get_documentlist(limit=4)
+        cursor = response.json()["next_cursor"]
+        self.assertIsNotNone(cursor)
+        response = self.get_documentlist(limit=1, cursor=cursor)
+        self.assertEqual(self.titles(response.json()), ["Doc 0"])
+        self.assertIsNone(response.json()["next_cursor"])
+
+    def test_updated_since(self):
+        response = self.get_documentlist(
+            updated_since=time.mktime(
+                (UPDATED + timedelta(minutes=2)).utctimetuple()
+            )
+        )
+        self.assertEqual(
+            self.titles(response.json()), ["Doc 4", "Doc 3", "Doc 2"]
+        )
+
+    def test_shared_documents(self):
+        shared_doc = self.create_doc("Shared", UPDATED, owner=self.other_user)
+        self.create_doc("Not shared", UPDATED, owner=self.other_user)
+        AccessRight.objects.create(
+            document=shared_doc,
+            holder_obj=self.user,
+            rights="read",
+            path="/Folder/Shared",
+        )
+        response = self.get_documentlist(limit=5)
+        cursor = response.json()["next_cursor"]
+        response = self.get_documentlist(limit=5, cursor=cursor)
+        self.assertEqual(
+            response.json()["documents"][0],
+            dict(
+                response.json()["documents"][0],
+                title="Shared",
+                is_owner=False,
+                rights="read",
+                path="/Folder/Shared",
+            ),
+        )
+        self.assertEqual(len(response.json()["documents"]), 1)
+
+    def test_invalid_limit(self):
+        response = self.get_documentlist(limit="many")
+        self.assertEqual(response.status_code, 400)
+
+
+class DocumentListSyncTest(DocumentListTestCase):
+    def sync(self, sync_token):
+        response = self.get_documentlist(sync_token=sync_token)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_unchanged(self):
+        sync_token = self.get_documentlist().json()["sync_token"]
+        response = self.sync(sync_token)
+        self.assertTrue(response["delta"])
+        self.assertEqual(response["documents"], [])
+        self.assertEqual(response["removed_documents"], [])
+        self.assertNotIn("contacts", response)
+        self.assertNotIn("document_templates", response)
+        self.assertNotEqual(response["sync_token"], sync_token)
+
+    def test_delta(self):
+        sync_token = self.get_documentlist().json()["sync_token"]
+        Document.objects.filter(id=self.docs[0].id).update(title="Renamed")
+        shared_doc = self.create_doc("Shared", UPDATED, owner=self.other_user)
+        access_right = AccessRight.objects.create(
+            document=shared_doc, holder_obj=self.user, rights="read"
+        )
+        response = self.sync(sync_token)
+        self.assertTrue(response["delta"])
+        self.assertEqual(sorted(self.titles(response)), ["Renamed", "Shared"])
+        # Changed access rights count as changes of the document.
+        access_right.rights = "write"
+        access_right.save()
+        response = self.sync(response["sync_token"])
+        self.assertEqual(self.titles(response), ["Shared"])
+        self.assertEqual(response["documents"][0]["rights"], "write")
+
+    def test_removed_documents(self):
+        shared_doc = self.create_doc("Shared", UPDATED, owner=self.other_user)
+        access_right = AccessRight.objects.create(
+            document=shared_doc, holder_obj=self.user, rights="read"
+        )
+        sync_token = self.get_documentlist().json()["sync_token"]
+        removed_id = self.docs[0].id
+        self.docs[0].delete()
+        access_right.delete()
+        response = self.sync(sync_token)
+        self.assertEqual(response["documents"], [])
+        self.assertEqual(
+            sorted(response["removed_documents"]),
+            sorted([removed_id, shared_doc.id]),
+        )
+
+    def test_changed_extras(self):
+        sync_token = self.get_documentlist().json()["sync_token"]
+        self.user.contacts.add(self.other_user)
+        response = self.sync(sync_token)
+        self.assertEqual(
+            [contact["id"] for contact in response["contacts"]],
+            [self.other_user.id],
+        )
+        self.assertNotIn("document_templates", response)
+
+    def test_pages_add_to_token(self):
+        response = self.get_documentlist(limit=3).json()
+        sync_token = response["sync_token"]
+        self.get_documentlist(
+            limit=3, cursor=response["next_cursor"], sync_token=sync_token
+        )
+        Document.objects.filter(id=self.docs[0].id).update(title="Renamed")
+        response = self.sync(sync_token)
+        self.assertEqual(self.titles(response), ["Renamed"])
+        self.assertEqual(response["removed_documents"], [])
+
+    def test_unknown_token(self):
+        response = self.sync("unknown")
+        self.assertNotIn("delta", response)
+        self.assertEqual(len(response["documents"]), 5)
+        self.assertIn("contacts", response)
+
+    def test_expired_token(self):
+        sync_token = self.get_documentlist().json()["sync_token"]
+        cache.clear()
+        response = self.sync(sync_token)
+        self.assertNotIn("delta", response)
+        self.assertEqual(len(response["documents"]), 5)
+        # The new token can be used again.
+        self.assertTrue(self.sync(response["sync_token"])["delta"])
@@ -0,0 +1,182 @@
+import json
+from datetime import datetime, timezone
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from document.models import AccessRight, Document, DocumentTemplate
+from usermedia.models import DocumentImage, Image
+
+CONTENT = {
+    "type": "article",
+    "content": [{"type": "title", "content": [{"type": "text", "text": "A"}]}],
+}
+UPDATED = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+
+class DocumentListExtraTest(TestCase):
+    fixtures = [
+        "initial_documenttemplates.json",
+    ]
+
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create(
+            username="Yeti", email="yeti@snowman.com"
+        )
+        self.other_user = User.objects.create(
+            username="Yeti2", email="yeti2@snowman.com"
+        )
+        self.template = DocumentTemplate.objects.first()
+        self.own_doc = self.create_doc(self.user, CONTENT)
+        self.shared_doc = self.create_doc(self.other_user, CONTENT)
+        AccessRight.objects.create(
+            document=self.shared_doc, holder_obj=self.user, rights="read"
+        )
+        self.other_doc = self.create_doc(self.other_user, CONTENT)
+        self.client.force_login(self.user)
+
+    def create_doc(self, owner, content):
+        doc = Document.objects.create(
+            owner=owner, template=self.template, content=content
+        )
+        Document.objects.filter(id=doc.id).update(updated=UPDATED)
+        return doc
+
+    def get_documentlist_extra(self, docs):
+        response = self.client.post(
+            reverse("get_documentlist_extra"),
+            {"ids": ",".join(str(doc.id) for doc in docs)},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        return [json.loads(line) for line in lines]
+
+    def test_one_line_per_document(self):
+        documents = self.get_documentlist_extra(
+            [self.own_doc, self.shared_doc]
+        )
+        self.assertEqual(
+            sorted(document["id"] for document in documents),
+            sorted([self.own_doc.id, self.shared_doc.id]),
+        )
+        for document in documents:
+            self.assertEqual(document["content"], CONTENT)
+            self.assertEqual(
+                set(document),
+                {"id", "content", "comments", "bibliography", "images"},
+            )
+
+    def test_only_accessible_documents(self):
+        documents = self.get_documentlist_extra([self.own_doc, self.other_doc])
+        self.assertEqual(
+            [document["id"] for document in documents], [self.own_doc.id]
+        )
+
+    def test_images(self):
+        # Saving an Image requires the file, so the rows are created
+        # directly.
+        image = Image.objects.bulk_create(
+            [
+                Image(
+                    uploader=self.user,
+                    image="images/yeti.png",
+                    file_type="image/png",
+                    width=20,
+                    height=10,
+                    checksum=123,
+                )
+            ]
+        )[0]
+        DocumentImage.objects.create(
+            document=self.own_doc, image=image, title="Yeti"
+        )
+        documents = self.get_documentlist_extra([self.own_doc])
+        self.assertEqual(
+            documents[0]["images"][str(image.id)],
+            dict(
+                documents[0]["images"][str(image.id)],
+                id=image.id,
+                title="Yeti",
+                checksum=123,
+                file_type="image/png",
+                width=20,
+                height=10,
+            ),
+        )
+        self.assertTrue(
+            documents[0]["images"][str(image.id)]["image"].endswith(
+                "images/yeti.png"
+            )
+        )
+
+    def test_no_documents_saved(self):
+        # A document that has been created without content and never been
+        # opened receives the content of its template in the response only.
+        empty_doc = self.create_doc(self.user, {})
+        with CaptureQueriesContext(connection) as queries:
+            documents = self.get_documentlist_extra([empty_doc])
+        self.assertEqual(documents[0]["content"]["type"], "article")
+        self.assertFalse(
+            [
+                query
+                for query in queries
+                if query["sql"].startswith(("UPDATE", "INSERT"))
+                and "django_session" not in query["sql"]
+            ]
+        )
+        empty_doc.refresh_from_db()
+        self.assertEqual(empty_doc.content, {})
+        self.assertEqual(empty_doc.updated, UPDATED)
+
+
+class TemplateContentMigrationTest(TransactionTestCase):
+    migrate_from = ("document", "0019_documentdiff")
+    migrate_to = ("document", "0020_template_content")
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate([self.migrate_from])
+        self.apps = executor.loader.project_state(self.migrate_from).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_content_filled_in(self):
+        User = self.apps.get_model("user", "User")
+        DocumentTemplate = self.apps.get_model("document", "DocumentTemplate")
+        Document = self.apps.get_model("document", "Document")
+        user = User.objects.create(username="Yeti", email="yeti@snowman.com")
+        template = DocumentTemplate.objects.create(
+            title="Template",
+            import_id="template",
+            content={"type": "article", "content": [{"type": "title"}]},
+        )
+        empty_doc = Document.objects.create(
+            owner=user, template=template, content={}
+        )
+        opened_doc = Document.objects.create(
+            owner=user, template=template, content=CONTENT
+        )
+        Document.objects.update(updated=UPDATED)
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([self.migrate_to])
+        Document = executor.loader.project_state(
+            self.migrate_to
+        ).apps.get_model("document", "Document")
+        empty_doc = Document.objects.get(id=empty_doc.id)
+        self.assertEqual(empty_doc.content, template.content)
+        self.assertEqual(empty_doc.updated, UPDATED)
+        opened_doc = Document.objects.get(id=opened_doc.id)
+        self.assertEqual(opened_doc.content, CONTENT)
+        self.assertEqual(opened_doc.updated, UPDATED)
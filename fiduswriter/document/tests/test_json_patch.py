@@ -0,0 +1,74 @@
+from copy import deepcopy
+
+from django.test import SimpleTestCase
+from jsonpatch import JsonPatchConflict, JsonPointerException
+
+from document.helpers.json_patch import apply_patch_with_rollback
+
+
+class ApplyPatchWithRollbackTest(SimpleTestCase):
+    def setUp(self):
+        self.doc = {
+            "type": "article",
+            "content": [
+                {"type": "title", "content": [{"type": "text", "text": "A"}]},
+                {"type": "body", "content": []},
+            ],
+            "attrs": {"language": "en-US"},
+        }
+        self.original = deepcopy(self.doc)
+
+    def test_patch_is_applied(self):
+        apply_patch_with_rollback(
+            self.doc,
+            [
+                {
+                    "op": "replace",
+                    "path": "/content/0/content/0/text",
+                    "value": "B",
+                },
+                {
+                    "op": "add",
+                    "path": "/content/1/content/-",
+                    "value": {"type": "p"},
+                },
+                {"op": "move", "from": "/attrs/language", "path": "/lang"},
+            ],
+        )
+        self.assertEqual(self.doc["content"][0]["content"][0]["text"], "B")
+        self.assertEqual(self.doc["content"][1]["content"], [{"type": "p"}])
+        self.assertEqual(self.doc["attrs"], {})
+        self.assertEqual(self.doc["lang"], "en-US")
+
+    def test_failed_patch_is_rolled_back(self):
+        with self.assertRaises(JsonPatchConflict):
+            apply_patch_with_rollback(
+                self.doc,
+                [
+                    {
+                        "op": "add",
+                        "path": "/content/-",
+                        "value": {"type": "p"},
+                    },
+                    {"op": "remove", "path": "/content/0"},
+                    {
+                        "op": "replace",
+                        "path": "/attrs/language",
+                        "value": "de",
+                    },
+                    {"op": "move", "from": "/content/0", "path": "/content/9"},
+                ],
+            )
+        self.assertEqual(self.doc, self.original)
+
+    def test_failed_pointer_is_rolled_back(self):
+        with self.assertRaises(JsonPointerException):
+            apply_patch_with_rollback(
+                self.doc,
+                [
+                    {"op": "add", "path": "/attrs/language", "value": "de"},
+                    {"op": "copy", "from": "/content/1", "path": "/body"},
+                    {"op": "add", "path": "/missing/member", "value": 1},
+                ],
+            )
+        self.assertEqual(self.doc, self.original)
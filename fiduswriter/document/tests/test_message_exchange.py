@@ -79,7 +79,7 @@ class SimpleMessageExchangeTests(LiveTornadoTestCase, EditorHelper):
         # Check the Socket object to verify that server isn't going in a loop.
         doc_message_count = 0
         doc_data = None
-        for message in socket_object.messages["last_ten"]:
+        for message in socket_object.messages["sent"]:
             if "type" in message.keys():
                 if message["type"] == "doc_data":
                     doc_message_count += 1
@@ -140,7 +140,7 @@ class SimpleMessageExchangeTests(LiveTornadoTestCase, EditorHelper):
             logging.disable(logging.NOTSET)
         doc_data = False
         patch_error = 0
-        for message in socket_object.messages["last_ten"]:
+        for message in socket_object.messages["sent"]:
             if message["type"] == "doc_data":
                 doc_data = message["doc"]["content"]
             elif message["type"] == "patch_error":
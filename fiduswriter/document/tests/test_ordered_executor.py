@@ -0,0 +1,49 @@
+import threading
+
+from django.test import SimpleTestCase, override_settings
+
+from document.ordered_executor import OrderedExecutor
+
+
+@override_settings(TESTING=False)
+class OrderedExecutorTest(SimpleTestCase):
+    def setUp(self):
+        self.executor = OrderedExecutor(4, thread_name_prefix="test")
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_same_key_in_order(self):
+        first_started = threading.Event()
+        release = threading.Event()
+        finished = []
+
+        def first():
+            first_started.set()
+            release.wait(5)
+            finished.append("first")
+
+        first_future = self.executor.submit(1, first)
+        second_future = self.executor.submit(1, finished.append, "second")
+        self.assertTrue(first_started.wait(5))
+        # The second task waits for the first one, even though there are
+        # idle threads.
+        self.assertFalse(second_future.done())
+        release.set()
+        second_future.result(5)
+        self.assertTrue(first_future.done())
+        self.assertEqual(finished, ["first", "second"])
+
+    def test_different_keys_concurrently(self):
+        release = threading.Event()
+        # The task of the first document only finishes once the task of the
+        # second document has run.
+        blocked_future = self.executor.submit(1, release.wait, 5)
+        self.executor.submit(2, release.set).result(5)
+        self.assertTrue(blocked_future.result(5))
+
+    def test_exception(self):
+        future = self.executor.submit(1, int, "x")
+        self.assertRaises(ValueError, future.result, 5)
+        # The key can be used again after a failed task.
+        self.assertEqual(self.executor.submit(1, int, "2").result(5), 2)
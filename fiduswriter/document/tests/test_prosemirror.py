@@ -0,0 +1,110 @@
+from unittest.mock import MagicMock, patch
+
+from django.test import SimpleTestCase, override_settings
+from prosemirror.model import Node
+
+from document import prosemirror
+from document.ws_views import WebSocket
+
+SCHEMA = prosemirror.StepSchema(
+    {
+        "nodes": {
+            "doc": {"content": "paragraph+"},
+            "paragraph": {"content": "text*"},
+            "text": {},
+        },
+        "marks": {},
+    }
+)
+
+GOOD_STEP = {
+    "stepType": "replace",
+    "from": 1,
+    "to": 1,
+    "slice": {"content": [{"type": "text", "text": "x"}]},
+}
+# A paragraph cannot be placed inside a paragraph.
+FAILING_STEP = {
+    "stepType": "replace",
+    "from": 1,
+    "to": 1,
+    "slice": {"content": [{"type": "paragraph"}]},
+}
+# The position is outside of the document.
+INVALID_STEP = {"stepType": "replace", "from": 1, "to": 99}
+
+
+@patch.object(prosemirror, "get_schema", lambda: SCHEMA)
+class ApplyStepsTest(SimpleTestCase):
+    def setUp(self):
+        self.node = Node.from_json(
+            SCHEMA,
+            {
+                "type": "doc",
+                "content": [
+                    {
+                        "type": "paragraph",
+                        "content": [{"type": "text", "text": "ab"}],
+                    }
+                ],
+            },
+        )
+
+    def text(self, node):
+        return node.text_content
+
+    def test_apply(self):
+        self.assertEqual(
+            self.text(prosemirror.apply([GOOD_STEP, GOOD_STEP], self.node)),
+            "xxab",
+        )
+        for steps in [
+            [FAILING_STEP, GOOD_STEP, GOOD_STEP],
+            [GOOD_STEP, FAILING_STEP, GOOD_STEP],
+            [GOOD_STEP, GOOD_STEP, FAILING_STEP],
+            [GOOD_STEP, INVALID_STEP],
+        ]:
+            self.assertIs(prosemirror.apply(steps, self.node), False)
+
+    def test_apply_batch(self):
+        node, failure = prosemirror.apply_batch(
+            [[GOOD_STEP], [GOOD_STEP, GOOD_STEP]], self.node
+        )
+        self.assertEqual(self.text(node), "xxxab")
+        self.assertIsNone(failure)
+        for step_lists, applied_text, expected_failure in [
+            ([[FAILING_STEP], [GOOD_STEP]], "ab", (0, 0)),
+            (
+                [[GOOD_STEP], [GOOD_STEP, FAILING_STEP, GOOD_STEP]],
+                "xab",
+                (1, 1),
+            ),
+            (
+                [[GOOD_STEP], [GOOD_STEP], [GOOD_STEP, FAILING_STEP]],
+                "xxab",
+                (2, 1),
+            ),
+            ([[GOOD_STEP, INVALID_STEP]], "ab", (0, 1)),
+        ]:
+            node, failure = prosemirror.apply_batch(step_lists, self.node)
+            # The node of the last completely applied list is returned.
+            self.assertEqual(self.text(node), applied_text)
+            self.assertEqual(failure, expected_failure)
+
+    @override_settings(JSONPATCH=False)
+    def test_session_node_is_kept(self):
+        participant = WebSocket.__new__(WebSocket)
+        participant.id = 0
+        participant.endpoint = "/ws/document/test"
+        participant.user = MagicMock(id=1)
+        participant.session = {"node": self.node}
+        for steps in [
+            [FAILING_STEP, GOOD_STEP],
+            [GOOD_STEP, FAILING_STEP, GOOD_STEP],
+            [GOOD_STEP, FAILING_STEP],
+        ]:
+            with self.assertLogs("document.ws_views", "ERROR"):
+                self.assertFalse(participant.apply_diff_content({"ds": steps}))
+            self.assertIs(participant.session["node"], self.node)
+        self.assertTrue(participant.apply_diff_content({"ds": [GOOD_STEP]}))
+        self.assertEqual(self.text(participant.session["node"]), "xab")
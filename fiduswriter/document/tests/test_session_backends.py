@@ -0,0 +1,220 @@
+import asyncio
+from collections import defaultdict
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from document.session_backends import RedisSessionBackend
+
+
+class LocalRedis:
+    """
+    In-memory stand-in for the parts of the redis.asyncio.Redis API that are
+    used by the RedisSessionBackend. Published messages are collected so that
+    the tests can deliver them to the nodes that subscribed to their channel.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.hashes = defaultdict(dict)
+        self.sets = defaultdict(set)
+        self.expiries = {}
+        self.published = []
+
+    def pubsub(self, **kwargs):
+        return LocalPubSub()
+
+    async def publish(self, channel, data):
+        self.published.append(
+            {"type": "message", "channel": channel, "data": data}
+        )
+
+    async def incr(self, key):
+        self.values[key] = self.values.get(key, 0) + 1
+        return self.values[key]
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = str(value)
+        self.expiries[key] = ex
+        return True
+
+    async def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    async def expire(self, key, seconds):
+        self.expiries[key] = seconds
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+            self.hashes.pop(key, None)
+            self.sets.pop(key, None)
+
+    async def hset(self, key, field, value):
+        self.hashes[key][str(field)] = value
+
+    async def hdel(self, key, *fields):
+        for field in fields:
+            self.hashes[key].pop(str(field), None)
+
+    async def hgetall(self, key):
+        return dict(self.hashes[key])
+
+    async def sadd(self, key, value):
+        self.sets[key].add(value)
+
+    async def srem(self, key, *values):
+        for value in values:
+            self.sets[key].discard(value)
+
+    async def smembers(self, key):
+        return set(self.sets[key])
+
+
+class LocalSyncRedis:
+    # Stand-in for the synchronous client used by notify.
+    def __init__(self, client):
+        self.client = client
+
+    def publish(self, channel, data):
+        self.client.published.append(
+            {"type": "message", "channel": channel, "data": data}
+        )
+
+
+class LocalPubSub:
+    def __init__(self):
+        self.channels = set()
+
+    async def subscribe(self, channel):
+        self.channels.add(channel)
+
+    async def unsubscribe(self, channel):
+        self.channels.discard(channel)
+
+    async def listen(self):
+        await asyncio.Event().wait()
+        yield
+
+
+class RedisSessionBackendTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = LocalRedis()
+        self.events = {"a": [], "b": []}
+        self.node_a = RedisSessionBackend(
+            lambda document_id, event: self.events["a"].append(event),
+            client=self.client,
+        )
+        self.node_b = RedisSessionBackend(
+            lambda document_id, event: self.events["b"].append(event),
+            client=self.client,
+        )
+        await self.send_commands()
+
+    async def asyncTearDown(self):
+        self.node_a.close()
+        self.node_b.close()
+
+    async def send_commands(self):
+        for node in [self.node_a, self.node_b]:
+            await asyncio.wait_for(node.commands.join(), 1)
+
+    async def deliver(self):
+        await self.send_commands()
+        for item in self.client.published:
+            for node in [self.node_a, self.node_b]:
+                if item["channel"] in node.pubsub.channels:
+                    node.handle_pubsub_message(item)
+        self.client.published = []
+
+    async def test_participant_ids_are_unique(self):
+        self.assertEqual(await self.node_a.new_participant_id(1, {}), 0)
+        self.assertEqual(await self.node_b.new_participant_id(1, {}), 1)
+        self.assertEqual(await self.node_a.new_participant_id(1, {0: 0}), 2)
+
+    async def test_version_can_only_be_claimed_once(self):
+        self.assertTrue(await self.node_a.claim_version(1, 5))
+        self.assertFalse(await self.node_b.claim_version(1, 5))
+        self.node_a.release_version(1, 5)
+        await self.send_commands()
+        self.assertTrue(await self.node_b.claim_version(1, 5))
+        # Claims expire on their own.
+        self.assertEqual(
+            self.client.expiries[self.node_b.key(1, "claim:5")],
+            RedisSessionBackend.claim_expiry,
+        )
+
+    async def test_events_reach_nodes_of_document_only(self):
+        self.node_a.join(1)
+        self.node_b.join(1)
+        self.node_a.publish(1, {"type": "participants"})
+        await self.deliver()
+        self.assertEqual(self.events["a"], [])
+        self.assertEqual(self.events["b"], [{"type": "participants"}])
+        self.node_a.publish(2, {"type": "participants"})
+        await self.deliver()
+        self.assertEqual(self.events["b"], [{"type": "participants"}])
+        # Events without document reach all nodes.
+        self.node_a.publish(None, {"type": "styles"})
+        await self.deliver()
+        self.assertEqual(self.events["b"][-1], {"type": "styles"})
+
+    async def test_participant_lists_are_merged(self):
+        self.node_a.join(1)
+        self.node_b.join(1)
+        await self.send_commands()
+        await self.node_a.get_participant_list(1, [{"session_id": 0}])
+        participant_list = await self.node_b.get_participant_list(
+            1, [{"session_id": 1}]
+        )
+        self.assertEqual(
+            participant_list, [{"session_id": 0}, {"session_id": 1}]
+        )
+        self.node_a.leave(1)
+        await self.deliver()
+        self.assertEqual(self.events["b"], [{"type": "participants"}])
+        self.assertEqual(
+            await self.node_b.get_participant_list(1, [{"session_id": 1}]),
+            [{"session_id": 1}],
+        )
+
+    async def test_stopped_node_is_removed(self):
+        self.node_a.join(1)
+        self.node_b.join(1)
+        await self.send_commands()
+        await self.node_a.get_participant_list(1, [{"session_id": 0}])
+        await self.send_commands()
+        # Node a stops without leaving and its heartbeat expires.
+        self.node_a.close()
+        del self.client.values[self.node_a.node_key(self.node_a.node_id)]
+        self.assertEqual(
+            await self.node_b.get_participant_list(1, [{"session_id": 1}]),
+            [{"session_id": 1}],
+        )
+        self.node_b.leave(1)
+        await self.send_commands()
+        self.assertNotIn(self.node_b.key(1, "nodes"), self.client.sets)
+        self.assertNotIn(
+            self.node_b.key(1, "participants"), self.client.hashes
+        )
+
+    async def test_last_node_leaving_clears_document(self):
+        self.node_a.join(1)
+        self.node_a.leave(1)
+        await self.send_commands()
+        self.assertEqual(self.node_a.pubsub.channels, {self.node_a.channel})
+        self.assertNotIn(self.node_a.key(1, "nodes"), self.client.sets)
+
+    async def test_notify_reaches_other_nodes(self):
+        event = {"type": "clear_cache", "method": "clear_styles", "args": []}
+        with patch.object(
+            RedisSessionBackend, "sync_client", LocalSyncRedis(self.client)
+        ):
+            # Sent from a thread or process without session backend.
+            RedisSessionBackend.notify(event)
+            # Sent from the process of node a.
+            RedisSessionBackend.notify(event, origin=self.node_a.node_id)
+        await self.deliver()
+        self.assertEqual(self.events["a"], [event])
+        self.assertEqual(self.events["b"], [event, event])
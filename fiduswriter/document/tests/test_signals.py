@@ -0,0 +1,70 @@
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from document.models import DocumentTemplate
+from document.session_backends import LocalSessionBackend
+from document.ws_views import WebSocket
+
+
+class RunningIOLoop:
+    # Runs callbacks right away instead of on the IOLoop.
+    def add_callback(self, callback, *args):
+        callback(*args)
+
+
+@patch.object(WebSocket, "io_loop", RunningIOLoop())
+@patch.object(WebSocket, "sessions", {})
+@patch.object(LocalSessionBackend, "notify")
+class ClearCacheTest(TestCase):
+    fixtures = [
+        "initial_documenttemplates.json",
+    ]
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(
+            username="Yeti", email="yeti@snowman.com"
+        )
+        self.template = DocumentTemplate.objects.first()
+        self.template.user = self.user
+        self.template.save()
+        self.key = (self.template.id, self.user.id)
+
+    def test_cleared_after_commit(self, notify):
+        with patch.dict(WebSocket.styles_cache, {self.key: "old"}):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.template.title = "New title"
+                self.template.save()
+                # Nothing is cleared before the change has been committed.
+                self.assertIn(self.key, WebSocket.styles_cache)
+                notify.assert_not_called()
+                # A participant joins and caches the old data again.
+                WebSocket.styles_cache[self.key] = "old"
+            self.assertNotIn(self.key, WebSocket.styles_cache)
+        notify.assert_any_call(
+            {
+                "type": "clear_cache",
+                "method": "clear_styles",
+                "args": (self.template.id, self.user.id),
+            },
+            origin=None,
+        )
+
+    def test_other_processes_informed(self, notify):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.contacts.add(
+                get_user_model().objects.create(
+                    username="Yeti2", email="yeti2@snowman.com"
+                )
+            )
+            notify.assert_not_called()
+        self.assertEqual(notify.call_count, 2)
+        self.assertEqual(
+            notify.call_args_list[0].args[0],
+            {
+                "type": "clear_cache",
+                "method": "clear_owner_data",
+                "args": (self.user.id,),
+            },
+        )
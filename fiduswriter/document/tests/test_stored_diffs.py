@@ -0,0 +1,140 @@
+from copy import deepcopy
+from unittest.mock import MagicMock, patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from document.models import Document, DocumentDiff, DocumentTemplate
+from document.session_backends import LocalSessionBackend
+from document.ws_views import WebSocket
+
+CONTENT = {
+    "type": "article",
+    "content": [
+        {"type": "title", "content": [{"type": "text", "text": "A"}]},
+    ],
+}
+
+
+# Database work of the collaboration server runs in the test thread.
+@override_settings(TESTING=True)
+class StoredDiffTest(TestCase):
+    fixtures = [
+        "initial_documenttemplates.json",
+    ]
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(
+            username="Yeti", email="yeti@snowman.com"
+        )
+        self.doc = Document.objects.create(
+            owner=self.user,
+            template=DocumentTemplate.objects.first(),
+            content=deepcopy(CONTENT),
+        )
+
+    def participant(self, doc):
+        participant = WebSocket.__new__(WebSocket)
+        participant.id = 0
+        participant.sessionument_id = doc.id
+        participant.endpoint = "/ws/document/test"
+        participant.user = self.user
+        participant.user_info = MagicMock(
+            access_rights="write", document_id=doc.id, user=self.user
+        )
+        participant.send_message = MagicMock()
+        participant.session = {
+            "doc": doc,
+            "participants": {0: participant},
+        }
+        return participant
+
+    @override_settings(JSONPATCH=True)
+    @patch.object(WebSocket, "save_scheduler", MagicMock())
+    @patch.object(WebSocket, "session_backend", LocalSessionBackend(None))
+    def test_replay_json_diff(self):
+        participant = self.participant(Document.objects.get(id=self.doc.id))
+        message = {
+            "type": "diff",
+            "v": 0,
+            "rid": 1,
+            "ds": [],
+            "jd": [
+                {
+                    "op": "replace",
+                    "path": "/content/0/content/0/text",
+                    "value": "B",
+                }
+            ],
+        }
+        with patch.dict(
+            WebSocket.sessions, {self.doc.id: participant.session}
+        ):
+            participant.apply_diff(message)
+        self.assertEqual(participant.session["doc"].version, 1)
+        stored_diff = DocumentDiff.objects.get(document=self.doc).diff
+        self.assertIn("jd", stored_diff)
+        # Another process opens the unsaved document and replays the diff.
+        doc = Document.objects.get(id=self.doc.id)
+        replaying_participant = self.participant(doc)
+        replaying_participant.apply_unsaved_diffs(
+            WebSocket.get_unsaved_diffs(doc)
+        )
+        self.assertEqual(doc.version, 1)
+        self.assertEqual(doc.content, participant.session["doc"].content)
+        self.assertEqual(doc.content["content"][0]["content"][0]["text"], "B")
+        # The copies sent to clients do not contain the json diff.
+        self.assertNotIn("jd", replaying_participant.get_stored_diffs(0)[0])
+
+    @override_settings(JSONPATCH=True)
+    @patch.object(WebSocket, "send_updates", MagicMock())
+    def test_remote_diff_is_saved(self):
+        participant = self.participant(Document.objects.get(id=self.doc.id))
+        participant.session["closing"] = False
+        message = {
+            "type": "diff",
+            "v": 0,
+            "rid": 1,
+            "ds": [],
+            "jd": [
+                {
+                    "op": "replace",
+                    "path": "/content/0/content/0/text",
+                    "value": "B",
+                }
+            ],
+        }
+        save_scheduler = MagicMock()
+        with patch.dict(
+            WebSocket.sessions, {self.doc.id: participant.session}
+        ), patch.object(WebSocket, "save_scheduler", save_scheduler):
+            # The diff has been accepted by another process.
+            WebSocket.receive_session_event(
+                self.doc.id,
+                {
+                    "type": "diff",
+                    "message": message,
+                    "sender_id": 1,
+                    "user_id": self.user.id,
+                },
+            )
+        self.assertEqual(participant.session["doc"].version, 1)
+        save_scheduler.mark_dirty.assert_called_once_with(self.doc.id)
+
+    def test_upgrade_removes_stored_diffs(self):
+        DocumentDiff.objects.create(
+            document=self.doc, version=1, diff={"type": "diff", "v": 0}
+        )
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse("save_doc"),
+            {"id": self.doc.id, "content": "{}"},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(
+            DocumentDiff.objects.filter(document=self.doc).exists()
+        )
@@ -1,24 +1,34 @@
 import time
 import os
+import hashlib
+import uuid
+from datetime import datetime, timezone
 import bleach
 import json
-from copy import deepcopy
 
 from django.core import serializers
-from django.http import HttpResponse, JsonResponse, HttpRequest
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import (
+    HttpResponse,
+    HttpRequest,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_POST
 from django.db import transaction
 from django.core.files import File
 from django.utils.translation import gettext as _
 from django.conf import settings
-from django.db.models import F, Q
+from django.db.models import F, Q, OuterRef, Prefetch, Subquery
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import get_user_model
 
 from document.models import (
     Document,
     AccessRight,
+    DocumentDiff,
     DocumentRevision,
     DocumentTemplate,
     CAN_UPDATE_DOCUMENT,
@@ -27,11 +37,15 @@ from document.models import (
 )
 from usermedia.models import DocumentImage, Image
 from bibliography.models import Entry
+from document.helpers.access_rights import (
+    get_holders,
+    holders_query,
+    resolve_holders,
+)
 from document.helpers.serializers import PythonWithURLSerializer
 from bibliography.views import serializer
 from style.models import DocumentStyle, DocumentStyleFile, ExportTemplate
 from base.decorators import ajax_required
-from user.models import UserInvite
 from . import emails
 from user.helpers import Avatars
 
@@ -40,89 +54,139 @@ from user.helpers import Avatars
 @ajax_required
 @require_POST
 def get_documentlist_extra(request):
-    response = {}
-    status = 200
+    # Streams the documents as newline delimited JSON, one document per line,
+    # so that the memory used does not grow with the number of documents.
     ids = request.POST["ids"].split(",")
     docs = (
         Document.objects.filter(
-            Q(owner=request.user) | Q(accessright__user=request.user)
+            Q(owner=request.user)
+            | Q(
+                id__in=AccessRight.objects.filter(user=request.user).values(
+                    "document_id"
+                )
+            )
         )
         .filter(id__in=ids)
-        .prefetch_related("documentimage_set")
-    )
-    response["documents"] = []
-    for doc in docs:
-        images = {}
-        for image in doc.documentimage_set.all():
-            images[image.image.id] = {
-                "added": image.image.added,
-                "checksum": image.image.checksum,
-                "file_type": image.image.file_type,
-                "height": image.image.height,
-                "id": image.image.id,
-                "image": image.image.image.url,
-                "title": image.title,
-                "copyright": image.copyright,
-                "width": image.image.width,
-            }
-            if image.image.thumbnail:
-                images[image.image.id]["thumbnail"] = image.image.thumbnail.url
-        if "type" not in doc.content:
-            doc.content = deepcopy(doc.template.content)
-            if "type" not in doc.content:
-                doc.content["type"] = "article"
-            if "content" not in doc.content:
-                doc.content["content"] = [{type: "title"}]
-            doc.save()
-        response["documents"].append(
-            {
-                "images": images,
-                "content": doc.content,
-                "comments": doc.comments,
-                "bibliography": doc.bibliography,
-                "id": doc.id,
-            }
+        .only("id", "content", "comments", "bibliography", "template_id")
+        .prefetch_related(
+            Prefetch(
+                "documentimage_set",
+                queryset=DocumentImage.objects.select_related("image"),
+            )
         )
-    return JsonResponse(response, status=status)
+    )
+    return StreamingHttpResponse(
+        (
+            json.dumps(document_extra(doc), cls=DjangoJSONEncoder) + "\n"
+            for doc in docs.iterator(chunk_size=100)
+        ),
+        content_type="application/x-ndjson",
+    )
+
+
+def document_extra(doc):
+    images = {}
+    for image in doc.documentimage_set.all():
+        images[image.image.id] = {
+            "added": image.image.added,
+            "checksum": image.image.checksum,
+            "file_type": image.image.file_type,
+            "height": image.image.height,
+            "id": image.image.id,
+            "image": image.image.image.url,
+            "title": image.title,
+            "copyright": image.copyright,
+            "width": image.image.width,
+        }
+        if image.image.thumbnail:
+            images[image.image.id]["thumbnail"] = image.image.thumbnail.url
+    if "type" not in doc.content:
+        # The document has been created without content and not been
+        # opened since.
+        doc.set_template_content()
+    return {
+        "images": images,
+        "content": doc.content,
+        "comments": doc.comments,
+        "bibliography": doc.bibliography,
+        "id": doc.id,
+    }
 
 
-def documents_list(request):
+def timestamp_to_datetime(timestamp):
+    # Reverses time.mktime(date.utctimetuple()), with which the dates of the
+    # document list are given to the client.
+    return datetime(*time.localtime(float(timestamp))[:6], tzinfo=timezone.utc)
+
+
+def documents_list(request, limit=None, cursor=None, updated_since=None):
+    # Returns the documents of the overview, most recently updated first,
+    # and the cursor from which to continue if limit has been reached.
+    # cursor is the cursor of a previous page and updated_since the update
+    # time of the most recently updated document the client already has.
     avatars = Avatars()
+    own_access_right = AccessRight.objects.filter(
+        document=OuterRef("pk"), user=request.user
+    )
     documents = (
         Document.objects.filter(
-            Q(owner=request.user) | Q(accessright__user=request.user),
+            Q(owner=request.user)
+            | Q(
+                id__in=AccessRight.objects.filter(user=request.user).values(
+                    "document_id"
+                )
+            ),
             listed=True,
         )
         .defer("content", "comments", "bibliography", "doc_version", "diffs")
         .select_related("owner")
+        .annotate(
+            access_rights=Subquery(own_access_right.values("rights")[:1]),
+            access_path=Subquery(own_access_right.values("path")[:1]),
+        )
         .prefetch_related(
-            "accessright_set",
-            "documentrevision_set",
+            Prefetch(
+                "documentrevision_set",
+                queryset=DocumentRevision.objects.only(
+                    "id", "document_id", "date", "note", "file_name"
+                ),
+            )
         )
-        .distinct()
-        .order_by("-updated")
+        .order_by("-updated", "-id")
     )
+    if updated_since is not None:
+        documents = documents.filter(
+            updated__gte=timestamp_to_datetime(updated_since)
+        )
+    if cursor:
+        updated, id = cursor.rsplit("_", 1)
+        updated = datetime.fromisoformat(updated)
+        documents = documents.filter(
+            Q(updated__lt=updated) | Q(updated=updated, id__lt=int(id))
+        )
+    next_cursor = None
+    if limit is not None:
+        documents = list(documents[: limit + 1])
+        if len(documents) > limit:
+            documents = documents[:limit]
+            next_cursor = (
+                f"{documents[-1].updated.isoformat()}_{documents[-1].id}"
+            )
     output_list = []
     for document in documents:
-        if document.owner == request.user:
+        if document.owner_id == request.user.id:
             access_right = "write"
             path = document.path
         else:
-            access_object = document.accessright_set.filter(
-                user=request.user
-            ).first()
-            access_right = access_object.rights
-            path = access_object.path
+            access_right = document.access_rights
+            path = document.access_path
         if (
             request.user.is_staff
-            or document.owner == request.user
-            or document.accessright_set.filter(
-                user=request.user, rights__in=CAN_COMMUNICATE
-            ).first()
+            or document.owner_id == request.user.id
+            or access_right in CAN_COMMUNICATE
         ):
-            revisions = document.documentrevision_set.all()
             revision_list = []
-            for revision in revisions:
+            for revision in document.documentrevision_set.all():
                 revision_list.append(
                     {
                         "date": time.mktime(revision.date.utctimetuple()),
@@ -136,7 +200,7 @@ def documents_list(request):
         added = time.mktime(document.added.utctimetuple())
         updated = time.mktime(document.updated.utctimetuple())
         is_owner = False
-        if document.owner == request.user:
+        if document.owner_id == request.user.id:
             is_owner = True
         output_list.append(
             {
@@ -155,7 +219,7 @@ def documents_list(request):
                 "revisions": revision_list,
             }
         )
-    return output_list
+    return output_list, next_cursor
 
 
 @login_required
@@ -169,15 +233,19 @@ def get_access_rights(request):
     doc_ids = request.POST.getlist("document_ids[]")
     if len(doc_ids) > 0:
         ar_qs = ar_qs.filter(document_id__in=doc_ids)
+    ar_list = resolve_holders(ar_qs)
+    avatars.prefetch(
+        [ar.holder_obj for ar in ar_list if ar.holder_type.model == "user"]
+    )
     access_rights = []
-    for ar in ar_qs:
+    for ar in ar_list:
         if ar.holder_type.model == "user":
             avatar = avatars.get_url(ar.holder_obj)
         else:
             avatar = None
         access_rights.append(
             {
-                "document_id": ar.document.id,
+                "document_id": ar.document_id,
                 "rights": ar.rights,
                 "holder": {
                     "id": ar.holder_id,
@@ -196,105 +264,107 @@ def get_access_rights(request):
 @require_POST
 @transaction.atomic
 def save_access_rights(request):
-    User = get_user_model()
+    # Sets the access rights of the holders to each of the documents. The
+    # access rights are compared to the existing ones and written with one
+    # query each for deleting, updating and creating access rights.
     response = {}
     doc_ids = json.loads(request.POST["document_ids"])
-    rights = json.loads(request.POST["access_rights"])
-    for doc_id in doc_ids:
-        doc = Document.objects.filter(pk=doc_id, owner=request.user).first()
-        if not doc:
-            continue
+    # The last given access right of each holder counts.
+    rights = list(
+        {
+            (right["holder"]["type"], int(right["holder"]["id"])): right
+            for right in json.loads(request.POST["access_rights"])
+        }.values()
+    )
+    documents = Document.objects.filter(
+        id__in=doc_ids, owner=request.user
+    ).only("id", "title", "path")
+    holders = get_holders(
+        right["holder"] for right in rights if right["rights"] != "delete"
+    )
+    existing_access_rights = {
+        (
+            access_right.document_id,
+            access_right.holder_type.model,
+            access_right.holder_id,
+        ): access_right
+        for access_right in AccessRight.objects.filter(
+            holders_query(right["holder"] for right in rights),
+            document__in=documents,
+        ).select_related("holder_type")
+    }
+    deleted_ids = []
+    updated_access_rights = []
+    new_access_rights = []
+    notifications = []
+    for doc in documents:
         for right in rights:
-            holder_selector = "%(type)s__id" % {
-                "type": right["holder"]["type"]
-            }
+            holder_key = (right["holder"]["type"], int(right["holder"]["id"]))
+            access_right = existing_access_rights.get((doc.id,) + holder_key)
             if right["rights"] == "delete":
                 # Status 'delete' means the access right is marked for
                 # deletion.
-                AccessRight.objects.filter(
-                    **{
-                        "document_id": doc_id,
-                        holder_selector: right["holder"]["id"],
-                    }
-                ).delete()
-            else:
-                owner = request.user.readable_name
-                link = HttpRequest.build_absolute_uri(
-                    request, doc.get_absolute_url()
-                )
-                access_right = AccessRight.objects.filter(
-                    **{
-                        "document_id": doc_id,
-                        holder_selector: right["holder"]["id"],
-                    }
-                ).first()
-                document_title = doc.title
                 if access_right:
-                    if access_right.rights != right["rights"]:
-                        access_right.rights = right["rights"]
-                        if right["holder"]["type"] == "user":
-                            collaborator = User.objects.get(
-                                id=right["holder"]["id"]
-                            )
-                            collaborator_name = collaborator.readable_name
-                            collaborator_email = collaborator.email
-                            emails.send_share_notification(
-                                document_title,
-                                owner,
-                                link,
-                                collaborator_name,
-                                collaborator_email,
-                                right["rights"],
-                                True,
-                            )
-                else:
-                    # Make the shared path "/filename" or ""
-                    path = "/%(last_path_part)s" % {
-                        "last_path_part": doc.path.split("/").pop()
-                    }
-                    if len(path) == 1:
-                        path = ""
-                    if right["holder"]["type"] == "userinvite":
-                        holder = UserInvite.objects.filter(
-                            id=right["holder"]["id"]
-                        ).first()
-                    else:
-                        holder = User.objects.filter(
-                            id=right["holder"]["id"]
-                        ).first()
-                    if not holder:
-                        continue
-                    access_right = AccessRight.objects.create(
-                        document_id=doc_id,
+                    deleted_ids.append(access_right.id)
+            elif access_right:
+                if access_right.rights == right["rights"]:
+                    continue
+                access_right.rights = right["rights"]
+                updated_access_rights.append(access_right)
+                collaborator = holders.get(holder_key)
+                if right["holder"]["type"] == "user" and collaborator:
+                    notifications.append(
+                        (doc, collaborator, right["rights"], True)
+                    )
+            else:
+                holder = holders.get(holder_key)
+                if not holder:
+                    continue
+                # Make the shared path "/filename" or ""
+                path = "/%(last_path_part)s" % {
+                    "last_path_part": doc.path.split("/").pop()
+                }
+                if len(path) == 1:
+                    path = ""
+                new_access_rights.append(
+                    AccessRight(
+                        document_id=doc.id,
                         holder_obj=holder,
                         rights=right["rights"],
                         path=path,
                     )
-                    if right["holder"]["id"] == "user":
-                        collaborator_name = holder.readable_name
-                        collaborator_email = holder.email
-                        emails.send_share_notification(
-                            document_title,
-                            owner,
-                            link,
-                            collaborator_name,
-                            collaborator_email,
-                            right["rights"],
-                            False,
-                        )
-                access_right.save()
+                )
+                if right["holder"]["type"] == "user":
+                    notifications.append((doc, holder, right["rights"], False))
+    AccessRight.objects.filter(id__in=deleted_ids).delete()
+    AccessRight.objects.bulk_update(updated_access_rights, ["rights"])
+    AccessRight.objects.bulk_create(new_access_rights)
+    owner = request.user.readable_name
+
+    def send_notifications():
+        for doc, collaborator, rights, change in notifications:
+            emails.send_share_notification(
+                doc.title,
+                owner,
+                HttpRequest.build_absolute_uri(
+                    request, doc.get_absolute_url()
+                ),
+                collaborator.readable_name,
+                collaborator.email,
+                rights,
+                change,
+            )
+
+    # The emails are only sent once the access rights have been saved.
+    transaction.on_commit(send_notifications)
     status = 201
     return JsonResponse(response, status=status)
 
 
-@login_required
-@ajax_required
-@require_POST
-def get_documentlist(request):
-    response = {}
-    status = 200
-    response["documents"] = documents_list(request)
-    response["contacts"] = []
+def documentlist_extras(request):
+    # The parts of the overview besides the documents.
+    extras = {}
+    extras["contacts"] = []
     avatars = Avatars()
     for contact in request.user.contacts.all():
         contact_object = {
@@ -304,7 +374,7 @@ def get_documentlist(request):
             "avatar": avatars.get_url(contact),
             "type": "user",
         }
-        response["contacts"].append(contact_object)
+        extras["contacts"].append(contact_object)
     for contact in request.user.invites_by.all():
         contact_object = {
             "id": contact.id,
@@ -313,7 +383,7 @@ def get_documentlist(request):
             "avatar": None,
             "type": "userinvite",
         }
-        response["contacts"].append(contact_object)
+        extras["contacts"].append(contact_object)
     serializer = PythonWithURLSerializer()
     doc_styles = serializer.serialize(
         DocumentStyle.objects.filter(
@@ -323,16 +393,107 @@ def get_documentlist(request):
         use_natural_foreign_keys=True,
         fields=["title", "slug", "contents", "documentstylefile_set"],
     )
-    response["document_styles"] = [obj["fields"] for obj in doc_styles]
+    extras["document_styles"] = [obj["fields"] for obj in doc_styles]
     doc_templates = DocumentTemplate.objects.filter(
         Q(user=request.user) | Q(user=None)
     ).order_by(F("user").desc(nulls_first=True))
-    response["document_templates"] = {}
+    extras["document_templates"] = {}
     for obj in doc_templates:
-        response["document_templates"][obj.import_id] = {
+        extras["document_templates"][obj.import_id] = {
             "title": obj.title,
             "id": obj.id,
         }
+    return extras
+
+
+def fingerprint(value):
+    return hashlib.sha1(
+        json.dumps(value, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def sync_cache_key(user, sync_token):
+    return f"documentlist-sync-{user.id}-{sync_token}"
+
+
+@login_required
+@ajax_required
+@require_POST
+def get_documentlist(request):
+    # Without a limit, all documents are returned at once. With a limit, the
+    # following pages are requested with the returned next_cursor and the
+    # sync_token of the first page and only contain documents. With
+    # updated_since, only the documents that have been updated since then
+    # are returned.
+    #
+    # The returned sync_token refers to the fingerprints of the returned
+    # data, which are kept in the cache. A client that sends the sync_token
+    # of its complete list back without a cursor receives a delta instead:
+    # the documents that are new or have changed (including their access
+    # rights and revisions), the ids of the documents that are no longer
+    # listed and only those of contacts, document_styles and
+    # document_templates that have changed.
+    response = {}
+    status = 200
+    limit = request.POST.get("limit")
+    cursor = request.POST.get("cursor")
+    updated_since = request.POST.get("updated_since")
+    sync_token = request.POST.get("sync_token")
+    versions = None
+    if sync_token:
+        versions = cache.get(sync_cache_key(request.user, sync_token))
+    delta = versions is not None and not cursor and updated_since is None
+    if delta:
+        limit = None
+    try:
+        if limit is not None:
+            limit = max(int(limit), 1)
+        documents, response["next_cursor"] = documents_list(
+            request, limit, cursor, updated_since
+        )
+    except ValueError:
+        return JsonResponse(response, status=400)
+    document_versions = {
+        document["id"]: fingerprint(document) for document in documents
+    }
+    if cursor:
+        # A following page of a list that is loaded in pages.
+        response["documents"] = documents
+        if versions is not None:
+            versions["documents"].update(document_versions)
+            cache.set(
+                sync_cache_key(request.user, sync_token),
+                versions,
+                settings.DOCUMENT_LIST_SYNC_TIMEOUT,
+            )
+            response["sync_token"] = sync_token
+        return JsonResponse(response, status=status)
+    extras = documentlist_extras(request)
+    extra_versions = {key: fingerprint(value) for key, value in extras.items()}
+    if delta:
+        response["delta"] = True
+        response["documents"] = [
+            document
+            for document in documents
+            if versions["documents"].get(document["id"])
+            != document_versions[document["id"]]
+        ]
+        response["removed_documents"] = [
+            id for id in versions["documents"] if id not in document_versions
+        ]
+        for key, value in extras.items():
+            if versions[key] != extra_versions[key]:
+                response[key] = value
+    else:
+        response["documents"] = documents
+        response.update(extras)
+    sync_token = uuid.uuid4().hex
+    cache.set(
+        sync_cache_key(request.user, sync_token),
+        dict(extra_versions, documents=document_versions),
+        settings.DOCUMENT_LIST_SYNC_TIMEOUT,
+    )
+    response["sync_token"] = sync_token
     return JsonResponse(response, status=status)
 
 
@@ -404,9 +565,11 @@ def create_doc(request):
     ).first()
     if not document_template:
         return JsonResponse(response, status=405)
-    document = Document.objects.create(
-        owner_id=request.user.pk, template_id=template_id, path=path
+    document = Document(
+        owner_id=request.user.pk, template=document_template, path=path
     )
+    document.set_template_content()
+    document.save()
     response["id"] = document.id
     return JsonResponse(response, status=201)
 
@@ -759,6 +922,7 @@ def get_all_old_docs(request):
 @staff_member_required
 @ajax_required
 @require_POST
+@transaction.atomic
 def save_doc(request):
     response = {}
     status = 200
@@ -782,6 +946,9 @@ def save_doc(request):
         doc.diffs = json.loads(diffs)
     doc.doc_version = FW_DOCUMENT_VERSION
     doc.save()
+    # The stored diffs contain steps in the format of the previous document
+    # version and must not be sent to clients of the upgraded document.
+    DocumentDiff.objects.filter(document=doc).delete()
     return JsonResponse(response, status=status)
 
 
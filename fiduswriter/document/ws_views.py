@@ -1,19 +1,28 @@
 import uuid
 import atexit
+import asyncio
 import logging
 import json
-from time import mktime, time
+from time import mktime, time, monotonic
 from copy import deepcopy
+from concurrent.futures import Future
 
 
+from tornado.ioloop import IOLoop, PeriodicCallback
+from django.db import close_old_connections
 from django.db.utils import DatabaseError
 from django.db.models import F, Q
 from django.conf import settings
+from django.utils.module_loading import import_string
 
 from document.helpers.session_user_info import SessionUserInfo
 from document import prosemirror
 from document.helpers.serializers import PythonWithURLSerializer
-from base.ws_handler import BaseWebSocketHandler
+from document.helpers.json_patch import apply_patch_with_rollback
+from document.ordered_executor import OrderedExecutor
+from document.save_scheduler import SaveScheduler
+from base import metrics
+from base.ws_handler import BaseWebSocketHandler, LogPayload, encode_message
 from document.models import (
     COMMENT_ONLY,
     CAN_UPDATE_DOCUMENT,
@@ -21,24 +30,80 @@ from document.models import (
     FW_DOCUMENT_VERSION,
     DocumentTemplate,
     Document,
+    DocumentDiff,
 )
 from usermedia.models import Image, DocumentImage, UserImage
 from user.helpers import Avatars
 
 # settings_JSONPATCH
-from jsonpatch import apply_patch, JsonPatchConflict, JsonPointerException
+from jsonpatch import JsonPatchConflict, JsonPointerException
 
 # end settings_JSONPATCH
 
 logger = logging.getLogger(__name__)
 
+diffs = metrics.Counter(
+    "fiduswriter_document_diffs_total",
+    "Diffs received by result: applied, rejected (based on a version that "
+    "another process has accepted a diff for), outdated (answered with the "
+    "missing diffs), unfixable, patch_error or discarded (not allowed).",
+)
+diff_seconds = metrics.Histogram(
+    "fiduswriter_document_diff_seconds",
+    "Time needed to apply an accepted diff.",
+)
+send_document_seconds = metrics.Histogram(
+    "fiduswriter_document_send_document_seconds",
+    "Time needed to send the entire document to a participant.",
+)
+save_seconds = metrics.Histogram(
+    "fiduswriter_document_save_seconds",
+    "Time needed to save a document to the database.",
+)
+resets = metrics.Counter(
+    "fiduswriter_document_resets_total",
+    "Collaboration sessions reset after a patch error.",
+)
+queue_full = metrics.Counter(
+    "fiduswriter_document_queue_full_total",
+    "Messages that had to wait for room in the message queue of their "
+    "document.",
+)
+
 
 class WebSocket(BaseWebSocketHandler):
     sessions = dict()
-    history_length = 1000  # Only keep the last 1000 diffs
+    session_backend = None
+    io_loop = None
+    idle_session_evictor = None
+    styles_cache = {}
+    styles_cache_size = 1000  # Number of cached styles messages
+    save_scheduler = None
+    db_executor = OrderedExecutor(
+        settings.DOC_DB_THREADS, thread_name_prefix="document-db"
+    )
+    history_length = settings.DOC_HISTORY_LENGTH
+    # The methods that document.signals.clear_cache can call.
+    cache_clearing_methods = [
+        "clear_owner_data",
+        "clear_avatar",
+        "clear_template_data",
+        "clear_styles",
+    ]
 
     def open(self, arg):
         super().open(arg)
+        WebSocket.io_loop = IOLoop.current()
+        if WebSocket.session_backend is None:
+            WebSocket.session_backend = import_string(
+                settings.DOC_SESSION_BACKEND
+            )(WebSocket.receive_session_event)
+            if settings.DOC_SESSION_IDLE_TIMEOUT:
+                WebSocket.idle_session_evictor = PeriodicCallback(
+                    WebSocket.evict_idle_sessions,
+                    min(settings.DOC_SESSION_IDLE_TIMEOUT, 60) * 1000,
+                )
+                WebSocket.idle_session_evictor.start()
         if len(self.args) < 2:
             self.access_denied()
             return
@@ -52,23 +117,77 @@ class WebSocket(BaseWebSocketHandler):
         response = {"type": "confirm_diff", "rid": rid}
         self.send_message(response)
 
-    def subscribe_doc(self, connection_count=0):
+    def run_db(self, function, *args, **kwargs):
+        # Runs database work in the threads of db_executor, after all
+        # database work that has been submitted for the document before.
+        return asyncio.wrap_future(
+            WebSocket.db_executor.submit(
+                self.sessionument_id, function, *args, **kwargs
+            )
+        )
+
+    @staticmethod
+    def log_db_error(future):
+        # Done callback for database work that nobody waits for.
+        if not future.cancelled() and future.exception():
+            logger.error(
+                "Action:Database work failed.", exc_info=future.exception()
+            )
+
+    @staticmethod
+    def load_document(doc_db):
+        # Fills in the content of a new document from its template and
+        # returns the diffs that are not yet part of the saved document.
+        if "type" not in doc_db.content:
+            doc_db.set_template_content()
+            doc_db.save()
+        return WebSocket.get_unsaved_diffs(doc_db)
+
+    async def subscribe_doc(self, connection_count=0):
         self.user_info = SessionUserInfo(self.user)
-        doc_db, can_access = self.user_info.init_access(self.sessionument_id)
-        if not can_access or float(doc_db.doc_version) != FW_DOCUMENT_VERSION:
-            self.access_denied()
+        while True:
+            doc_db, can_access = await self.run_db(
+                self.user_info.init_access, self.sessionument_id
+            )
+            if (
+                not can_access
+                or float(doc_db.doc_version) != FW_DOCUMENT_VERSION
+            ):
+                self.access_denied()
+                return
+            unsaved_diffs = None
+            if doc_db.id not in WebSocket.sessions:
+                unsaved_diffs = await self.run_db(
+                    WebSocket.load_document, doc_db
+                )
+            session = WebSocket.sessions.get(doc_db.id)
+            participant_id = (
+                await WebSocket.session_backend.new_participant_id(
+                    doc_db.id, session["participants"] if session else {}
+                )
+            )
+            session = WebSocket.sessions.get(doc_db.id)
+            if session is None or not session["closing"]:
+                break
+            # The document is loaded again once the session that is being
+            # closed has been saved.
+            await session["closed"].wait()
+        if self.ws_connection is None:
+            # The connection has been closed in the meantime.
             return
         if (
             doc_db.id in WebSocket.sessions
             and len(WebSocket.sessions[doc_db.id]["participants"]) > 0
         ):
+            # Also if another participant has opened the document while it
+            # was being loaded.
             logger.debug(
                 f"Action:Serving already opened document. "
                 f"URL:{self.endpoint} User:{self.user.id} "
                 f" ParticipantID:{self.id}"
             )
             self.session = WebSocket.sessions[doc_db.id]
-            self.id = max(self.session["participants"]) + 1
+            self.id = participant_id
             self.session["participants"][self.id] = self
             template = False
         else:
@@ -77,24 +196,52 @@ class WebSocket(BaseWebSocketHandler):
                 f"URL:{self.endpoint} User:{self.user.id} "
                 f"ParticipantID:{self.id}"
             )
-            self.id = 0
-            if "type" not in doc_db.content:
-                doc_db.content = deepcopy(doc_db.template.content)
-                if "type" not in doc_db.content:
-                    doc_db.content["type"] = "article"
-                if "content" not in doc_db.content:
-                    doc_db.content["content"] = [{type: "title"}]
-                doc_db.save()
+            self.id = participant_id
             node = prosemirror.from_json(
                 {"type": "doc", "content": [doc_db.content]}
             )
             self.session = {
                 "doc": doc_db,
                 "node": node,
-                "participants": {0: self},
+                # The node that doc.content has last been updated from and
+                # the cache used to do so.
+                "content_node": node,
+                "json_cache": {},
+                # Cached parts of the doc_data message, see get_doc_data.
+                "doc_data": {},
+                "avatars": Avatars(),
+                "participant_list_timer": None,
+                "publish_participant_list": False,
+                # The latest selection change of each participant that has
+                # not been sent yet, see handle_selection_change.
+                "selection_changes": {},
+                "selection_timer": None,
+                "participants": {self.id: self},
                 "last_saved_version": doc_db.version,
+                # The time of the last message received from any
+                # participant, see evict_idle_sessions.
+                "last_activity": monotonic(),
+                # The messages of all participants that wait to be handled
+                # by the worker of the session, see enqueue_message.
+                "queue": asyncio.Queue(
+                    maxsize=settings.DOC_MESSAGE_QUEUE_SIZE
+                ),
+                "worker": None,
+                # Whether the worker is handling a message.
+                "handling": False,
+                # Set once the session is to be closed, see close_session.
+                "closing": False,
+                "closed": asyncio.Event(),
             }
+            self.session["worker"] = asyncio.ensure_future(
+                WebSocket.process_queue(self.session)
+            )
             WebSocket.sessions[doc_db.id] = self.session
+            WebSocket.session_backend.join(doc_db.id)
+            if unsaved_diffs is None:
+                # A session without participants has been replaced.
+                unsaved_diffs = WebSocket.get_unsaved_diffs(doc_db)
+            self.apply_unsaved_diffs(unsaved_diffs)
             if self.user_info.access_rights == "write":
                 template = True
             else:
@@ -103,7 +250,7 @@ class WebSocket(BaseWebSocketHandler):
             f"Action:Participant ID Assigned. URL:{self.endpoint} "
             f"User:{self.user.id} ParticipantID:{self.id}"
         )
-        self.send_message({"type": "subscribed"})
+        self.send_message({"type": "subscribed", "encoding": self.encoding})
         if connection_count < 1:
             self.send_styles()
             self.send_document(False, template)
@@ -120,6 +267,17 @@ class WebSocket(BaseWebSocketHandler):
             self.handle_participant_update()
 
     def send_styles(self):
+        # The styles message only depends on the document template and the
+        # user, so it is cached for all documents with the same template.
+        key = (self.session["doc"].template_id, self.user.id)
+        if key not in WebSocket.styles_cache:
+            if len(WebSocket.styles_cache) >= WebSocket.styles_cache_size:
+                del WebSocket.styles_cache[next(iter(WebSocket.styles_cache))]
+            response = self.create_styles_message()
+            WebSocket.styles_cache[key] = (response, encode_message(response))
+        self.send_message(*WebSocket.styles_cache[key])
+
+    def create_styles_message(self):
         doc_db = self.session["doc"]
         response = dict()
         response["type"] = "styles"
@@ -147,62 +305,118 @@ class WebSocket(BaseWebSocketHandler):
             "document_styles": [obj["fields"] for obj in document_styles],
             "document_templates": document_templates,
         }
-        self.send_message(response)
+        return response
 
     def unfixable(self):
+        super().unfixable()
         self.send_document()
 
+    def get_doc_data(self, key):
+        # Returns a part of the doc_data message that is the same for all
+        # participants. The parts are cached in the session until they are
+        # cleared because they have changed.
+        doc_data = self.session["doc_data"]
+        if key not in doc_data:
+            doc_data[key] = getattr(self, f"create_{key}_data")()
+        return doc_data[key]
+
+    def create_owner_data(self):
+        doc_owner = self.session["doc"].owner
+        avatars = self.session["avatars"]
+        contacts = []
+        for contact in doc_owner.contacts.all():
+            contacts.append(
+                {
+                    "id": contact.id,
+                    "name": contact.readable_name,
+                    "username": contact.get_username(),
+                    "avatar": avatars.get_url(contact),
+                    "type": "user",
+                }
+            )
+        invites = []
+        for contact in doc_owner.invites_by.all():
+            invites.append(
+                {
+                    "id": contact.id,
+                    "name": contact.username,
+                    "username": contact.username,
+                    "avatar": None,
+                    "type": "userinvite",
+                }
+            )
+        return {
+            "id": doc_owner.id,
+            "name": doc_owner.readable_name,
+            "username": doc_owner.username,
+            "avatar": avatars.get_url(doc_owner),
+            "contacts": contacts,
+            "invites": invites,
+        }
+
+    def create_images_data(self):
+        images = {}
+        for dimage in DocumentImage.objects.filter(
+            document_id=self.session["doc"].id
+        ).select_related("image"):
+            image = dimage.image
+            field_obj = {
+                "id": image.id,
+                "title": dimage.title,
+                "copyright": dimage.copyright,
+                "image": image.image.url,
+                "file_type": image.file_type,
+                "added": mktime(image.added.timetuple()) * 1000,
+                "checksum": image.checksum,
+                "cats": [],
+            }
+            if image.thumbnail:
+                field_obj["thumbnail"] = image.thumbnail.url
+                field_obj["height"] = image.height
+                field_obj["width"] = image.width
+            images[image.id] = field_obj
+        return images
+
+    def create_template_data(self):
+        return (
+            DocumentTemplate.objects.filter(id=self.session["doc"].template_id)
+            .values("id", "content")
+            .first()
+        )
+
+    @send_document_seconds.time()
     def send_document(self, messages=False, template=False):
         response = dict()
         response["type"] = "doc_data"
-        doc_owner = self.session["doc"].owner
-        avatars = Avatars()
+        owner = self.get_doc_data("owner")
+        contacts = owner["contacts"]
+        if self.user_info.is_owner:
+            contacts = contacts + owner["invites"]
         response["doc_info"] = {
             "id": self.session["doc"].id,
             "is_owner": self.user_info.is_owner,
             "access_rights": self.user_info.access_rights,
             "path": self.user_info.path,
             "owner": {
-                "id": doc_owner.id,
-                "name": doc_owner.readable_name,
-                "username": doc_owner.username,
-                "avatar": avatars.get_url(doc_owner),
-                "contacts": [],
+                "id": owner["id"],
+                "name": owner["name"],
+                "username": owner["username"],
+                "avatar": owner["avatar"],
+                "contacts": contacts,
             },
         }
+        WebSocket.update_content(self.session)
         response["doc"] = {
             "v": self.session["doc"].version,
             "content": self.session["doc"].content,
             "bibliography": self.session["doc"].bibliography,
-            "images": {},
+            "images": self.get_doc_data("images"),
         }
         if template:
-            response["doc"]["template"] = {
-                "id": self.session["doc"].template.id,
-                "content": self.session["doc"].template.content,
-            }
+            response["doc"]["template"] = self.get_doc_data("template")
         if messages:
             response["m"] = messages
         response["time"] = int(time()) * 1000
-        for dimage in DocumentImage.objects.filter(
-            document_id=self.session["doc"].id
-        ):
-            image = dimage.image
-            field_obj = {
-                "id": image.id,
-                "title": dimage.title,
-                "copyright": dimage.copyright,
-                "image": image.image.url,
-                "file_type": image.file_type,
-                "added": mktime(image.added.timetuple()) * 1000,
-                "checksum": image.checksum,
-                "cats": [],
-            }
-            if image.thumbnail:
-                field_obj["thumbnail"] = image.thumbnail.url
-                field_obj["height"] = image.height
-                field_obj["width"] = image.width
-            response["doc"]["images"][image.id] = field_obj
         if self.user_info.access_rights == "read-without-comments":
             response["doc"]["comments"] = []
         elif self.user_info.access_rights in ["review", "review-tracked"]:
@@ -214,27 +428,6 @@ class WebSocket(BaseWebSocketHandler):
             response["doc"]["comments"] = filtered_comments
         else:
             response["doc"]["comments"] = self.session["doc"].comments
-        for contact in doc_owner.contacts.all():
-            contact_object = {
-                "id": contact.id,
-                "name": contact.readable_name,
-                "username": contact.get_username(),
-                "avatar": avatars.get_url(contact),
-                "type": "user",
-            }
-            response["doc_info"]["owner"]["contacts"].append(contact_object)
-        if self.user_info.is_owner:
-            for contact in doc_owner.invites_by.all():
-                contact_object = {
-                    "id": contact.id,
-                    "name": contact.username,
-                    "username": contact.username,
-                    "avatar": None,
-                    "type": "userinvite",
-                }
-                response["doc_info"]["owner"]["contacts"].append(
-                    contact_object
-                )
         response["doc_info"]["session_id"] = self.id
         self.send_message(response)
 
@@ -244,18 +437,67 @@ class WebSocket(BaseWebSocketHandler):
 
     def handle_message(self, message):
         if message["type"] == "subscribe":
+            self.negotiate_encoding(message)
             connection_count = 0
             if "connection" in message:
                 connection_count = message["connection"]
-            self.subscribe_doc(connection_count)
+            # The next message of the connection is only handled once the
+            # document has been loaded.
+            return self.subscribe(connection_count)
+        if not hasattr(self, "session") or self.session["closing"]:
             return
-        if self.user_info.document_id not in WebSocket.sessions:
+        return self.enqueue_message(message)
+
+    def enqueue_message(self, message):
+        # The messages of a document are handled one after another by the
+        # worker of its session, so that work that has to be waited for
+        # only holds up that document. If the queue is full, the returned
+        # awaitable makes Tornado stop reading from the connection until
+        # there is room again.
+        queue = self.session["queue"]
+        if queue.full():
+            queue_full.inc()
+            return queue.put((self, message))
+        queue.put_nowait((self, message))
+
+    @staticmethod
+    async def process_queue(session):
+        queue = session["queue"]
+        while True:
+            participant, message = await queue.get()
+            session["handling"] = True
+            try:
+                result = participant.process_message(message)
+                if result is not None:
+                    await result
+            except Exception:
+                logger.exception(
+                    f"Action:Handling message failed. "
+                    f"DocumentID:{session['doc'].id} Type:{message['type']}"
+                )
+            session["handling"] = False
+            if session["closing"] and queue.empty():
+                # All messages that were received before the session was
+                # closed have been handled.
+                WebSocket.close_session(session["doc"].id)
+            # Let the workers of other documents and the connections take
+            # turns, even if this queue is never empty.
+            await asyncio.sleep(0)
+
+    def process_message(self, message):
+        if (
+            not hasattr(self, "session")
+            or WebSocket.sessions.get(self.user_info.document_id)
+            is not self.session
+        ):
+            # The session has been closed or evicted.
             logger.debug(
                 f"Action:Receiving message for closed document. "
                 f"URL:{self.endpoint} User:{self.user.id} "
                 f"ParticipantID:{self.id}"
             )
             return
+        self.session["last_activity"] = monotonic()
         if message["type"] == "get_document":
             self.send_document()
         elif (
@@ -269,21 +511,40 @@ class WebSocket(BaseWebSocketHandler):
         elif message["type"] == "selection_change":
             self.handle_selection_change(message)
         elif message["type"] == "diff" and self.can_update_document():
-            self.handle_diff(message)
+            return self.handle_diff(message)
         elif message["type"] == "path_change":
             self.handle_path_change(message)
 
+    async def subscribe(self, connection_count):
+        await self.subscribe_doc(connection_count)
+        if hasattr(self, "session"):
+            self.session["last_activity"] = monotonic()
+
     def update_bibliography(self, bibliography_updates):
+        # The bibliography is replaced rather than changed in place, as the
+        # save scheduler may still be writing the previous one.
+        bibliography = self.session["doc"].bibliography = dict(
+            self.session["doc"].bibliography
+        )
         for bu in bibliography_updates:
             if "id" not in bu:
                 continue
             id = bu["id"]
             if bu["type"] == "update":
-                self.session["doc"].bibliography[id] = bu["reference"]
+                bibliography[id] = bu["reference"]
             elif bu["type"] == "delete":
-                del self.session["doc"].bibliography[id]
+                del bibliography[id]
 
     def update_images(self, image_updates):
+        document_id = self.session["doc"].id
+        future = self.run_db(self.write_images, image_updates)
+        future.add_done_callback(WebSocket.log_db_error)
+        future.add_done_callback(
+            lambda future: WebSocket.clear_doc_data(document_id, ["images"])
+        )
+        return future
+
+    def write_images(self, image_updates):
         for iu in image_updates:
             if "id" not in iu:
                 continue
@@ -318,13 +579,18 @@ class WebSocket(BaseWebSocketHandler):
 
     def update_comments(self, comments_updates):
         comments_updates = deepcopy(comments_updates)
+        # The comments are replaced rather than changed in place, as the save
+        # scheduler may still be writing the previous ones.
+        comments = self.session["doc"].comments = dict(
+            self.session["doc"].comments
+        )
         for cd in comments_updates:
             if "id" not in cd:
                 # ignore
                 continue
             id = cd["id"]
             if cd["type"] == "create":
-                self.session["doc"].comments[id] = {
+                comments[id] = {
                     "user": cd["user"],
                     "username": cd["username"],
                     "assignedUser": cd["assignedUser"],
@@ -335,26 +601,20 @@ class WebSocket(BaseWebSocketHandler):
                     "resolved": cd["resolved"],
                 }
             elif cd["type"] == "delete":
-                del self.session["doc"].comments[id]
+                del comments[id]
             elif cd["type"] == "update":
-                self.session["doc"].comments[id]["comment"] = cd["comment"]
+                comment = comments[id] = dict(comments[id])
+                comment["comment"] = cd["comment"]
                 if "isMajor" in cd:
-                    self.session["doc"].comments[id]["isMajor"] = cd["isMajor"]
+                    comment["isMajor"] = cd["isMajor"]
                 if "assignedUser" in cd and "assignedUsername" in cd:
-                    self.session["doc"].comments[id]["assignedUser"] = cd[
-                        "assignedUser"
-                    ]
-                    self.session["doc"].comments[id]["assignedUsername"] = cd[
-                        "assignedUsername"
-                    ]
+                    comment["assignedUser"] = cd["assignedUser"]
+                    comment["assignedUsername"] = cd["assignedUsername"]
                 if "resolved" in cd:
-                    self.session["doc"].comments[id]["resolved"] = cd[
-                        "resolved"
-                    ]
+                    comment["resolved"] = cd["resolved"]
             elif cd["type"] == "add_answer":
-                if "answers" not in self.session["doc"].comments[id]:
-                    self.session["doc"].comments[id]["answers"] = []
-                self.session["doc"].comments[id]["answers"].append(
+                comment = comments[id] = dict(comments[id])
+                comment["answers"] = comment.get("answers", []) + [
                     {
                         "id": cd["answerId"],
                         "user": cd["user"],
@@ -362,19 +622,24 @@ class WebSocket(BaseWebSocketHandler):
                         "date": cd["date"],
                         "answer": cd["answer"],
                     }
-                )
+                ]
             elif cd["type"] == "delete_answer":
                 answer_id = cd["answerId"]
-                for answer in self.session["doc"].comments[id]["answers"]:
-                    if answer["id"] == answer_id:
-                        self.session["doc"].comments[id]["answers"].remove(
-                            answer
-                        )
+                comment = comments[id] = dict(comments[id])
+                comment["answers"] = [
+                    answer
+                    for answer in comment["answers"]
+                    if answer["id"] != answer_id
+                ]
             elif cd["type"] == "update_answer":
                 answer_id = cd["answerId"]
-                for answer in self.session["doc"].comments[id]["answers"]:
-                    if answer["id"] == answer_id:
-                        answer["answer"] = cd["answer"]
+                comment = comments[id] = dict(comments[id])
+                comment["answers"] = [
+                    dict(answer, answer=cd["answer"])
+                    if answer["id"] == answer_id
+                    else answer
+                    for answer in comment["answers"]
+                ]
 
     def handle_participant_update(self):
         WebSocket.send_participant_list(self.user_info.document_id)
@@ -386,19 +651,26 @@ class WebSocket(BaseWebSocketHandler):
             "from": self.user_info.user.id,
             "type": "chat",
         }
-        WebSocket.send_updates(chat, self.user_info.document_id)
+        WebSocket.broadcast(chat, self.user_info.document_id)
 
     def handle_selection_change(self, message):
+        # Selection changes are sent to the other participants every
+        # DOC_SELECTION_TICK seconds. Only the latest selection of each
+        # participant is sent, independent of how fast it changes.
         if (
             self.user_info.document_id in WebSocket.sessions
             and message["v"] == self.session["doc"].version
         ):
-            WebSocket.send_updates(
+            self.session["selection_changes"][self.id] = (
                 message,
-                self.user_info.document_id,
-                self.id,
                 self.user_info.user.id,
             )
+            if self.session["selection_timer"] is None:
+                self.session["selection_timer"] = IOLoop.current().call_later(
+                    settings.DOC_SELECTION_TICK,
+                    WebSocket.send_selection_changes,
+                    self.user_info.document_id,
+                )
 
     def handle_path_change(self, message):
         if (
@@ -406,12 +678,10 @@ class WebSocket(BaseWebSocketHandler):
             and self.user_info.path_object
         ):
             self.user_info.path_object.path = message["path"]
-            self.user_info.path_object.save(
-                update_fields=[
-                    "path",
-                ]
-            )
-            WebSocket.send_updates(
+            self.run_db(
+                self.user_info.path_object.save, update_fields=["path"]
+            ).add_done_callback(WebSocket.log_db_error)
+            WebSocket.broadcast(
                 message,
                 self.user_info.document_id,
                 self.id,
@@ -431,13 +701,157 @@ class WebSocket(BaseWebSocketHandler):
                     only_comment = False
         return only_comment
 
+    def apply_diff_content(self, message):
+        # Applies the content changes of a diff to the session. Returns False
+        # if the diff cannot be applied.
+        if settings.JSONPATCH:
+            if "jd" in message:  # jd = json diff
+                try:
+                    # If the patch fails, the operations that have already
+                    # been applied are rolled back.
+                    apply_patch_with_rollback(
+                        self.session["doc"].content, message["jd"]
+                    )
+                except (JsonPatchConflict, JsonPointerException):
+                    logger.exception(
+                        f"Action:Cannot apply json diff. "
+                        f"URL:{self.endpoint} User:{self.user.id} "
+                        f"ParticipantID:{self.id}"
+                    )
+                    logger.error(
+                        f"Action:Patch Exception URL:{self.endpoint} "
+                        f"User:{self.user.id} ParticipantID:{self.id} "
+                        f"Message:{json.dumps(message)}"
+                    )
+                    logger.error(
+                        f"Action:Patch Exception URL:{self.endpoint} "
+                        f"User:{self.user.id} ParticipantID:{self.id} "
+                        f"Document:"
+                        f"{json.dumps(self.session['doc'].content)}"
+                    )
+                    return False
+        elif "ds" in message:  # ds = document steps
+            updated_node, failure = prosemirror.apply_batch(
+                [message["ds"]], self.session["node"]
+            )
+            if failure:
+                logger.error(
+                    f"Action:Cannot apply steps. URL:{self.endpoint} "
+                    f"User:{self.user.id} ParticipantID:{self.id} "
+                    f"Step index:{failure[1]}"
+                )
+                return False
+            # doc.content is only updated once it is needed.
+            self.session["node"] = updated_node
+        return True
+
+    @staticmethod
+    def without_json_diff(message):
+        # The json diff is only needed by the python backend which does not
+        # understand the steps. It is kept in the stored and published diffs
+        # so that they can be applied again, but removed from the copies sent
+        # to clients.
+        if "jd" not in message:
+            return message
+        return {key: value for key, value in message.items() if key != "jd"}
+
+    def apply_diff_metadata(self, message):
+        self.session["doc"].version += 1
+        if "ti" in message:  # ti = title
+            self.session["doc"].title = message["ti"][-255:]
+        if "cu" in message:  # cu = comment updates
+            self.update_comments(message["cu"])
+        if "bu" in message:  # bu = bibliography updates
+            self.update_bibliography(message["bu"])
+
+    def apply_shared_diff(self, message):
+        # Applies a diff that has been accepted by another process.
+        if message["v"] != self.session["doc"].version:
+            return False
+        if not self.apply_diff_content(message):
+            return False
+        self.apply_diff_metadata(message)
+        return True
+
+    @staticmethod
+    def get_unsaved_diffs(doc):
+        # Diffs that have been accepted but that are not yet part of the
+        # saved document, for example because they were accepted by another
+        # process or the server was stopped before the document was saved.
+        return list(
+            DocumentDiff.objects.filter(
+                document_id=doc.id,
+                version__gte=doc.version,
+            ).values_list("diff", flat=True)
+        )
+
+    def apply_unsaved_diffs(self, diffs):
+        applied = 0
+        if settings.JSONPATCH:
+            for diff in diffs:
+                if not self.apply_shared_diff(diff):
+                    break
+                applied += 1
+        else:
+            # The steps of all diffs are applied in one pass.
+            step_lists = []
+            for diff in diffs:
+                if diff["v"] != self.session["doc"].version + len(step_lists):
+                    break
+                step_lists.append(diff.get("ds", []))
+            node, failure = prosemirror.apply_batch(
+                step_lists, self.session["node"]
+            )
+            self.session["node"] = node
+            applied = failure[0] if failure else len(step_lists)
+            for diff in diffs[:applied]:
+                self.apply_diff_metadata(diff)
+            if failure:
+                logger.error(
+                    f"Action:Cannot apply unsaved diff. URL:{self.endpoint} "
+                    f"User:{self.user.id} ParticipantID:{self.id} "
+                    f"Diff version:{diffs[failure[0]]['v']} "
+                    f"Step index:{failure[1]}"
+                )
+        if applied < len(diffs):
+            # The remaining diffs do not fit the document and would block
+            # new diffs with the same version numbers.
+            self.run_db(
+                DocumentDiff.objects.filter(
+                    document_id=self.session["doc"].id,
+                    version__gte=self.session["doc"].version,
+                ).delete
+            ).add_done_callback(WebSocket.log_db_error)
+
+    def get_stored_diffs(self, from_version):
+        # Returns the diffs from the given version up to the current version
+        # or None if they are no longer all available.
+        number_diffs = self.session["doc"].version - from_version
+        if number_diffs < 0 or number_diffs > self.history_length:
+            return None
+        diffs = list(
+            DocumentDiff.objects.filter(
+                document_id=self.session["doc"].id,
+                version__gte=from_version,
+                version__lt=self.session["doc"].version,
+            ).values_list("diff", flat=True)
+        )
+        if len(diffs) != number_diffs:
+            return None
+        return [WebSocket.without_json_diff(diff) for diff in diffs]
+
     def handle_diff(self, message):
         pv = message["v"]
         dv = self.session["doc"].version
         logger.debug(
-            f"Action:Handling Diff. URL:{self.endpoint} User:{self.user.id} "
-            f"ParticipantID:{self.id} Client version:{pv} "
-            f"Server version:{dv} Message:{message}"
+            "Action:Handling Diff. URL:%s User:%s ParticipantID:%s "
+            "Client version:%s Server version:%s Message:%s",
+            self.endpoint,
+            self.user.id,
+            self.id,
+            pv,
+            dv,
+            LogPayload(message),
         )
         if (
             self.user_info.access_rights in COMMENT_ONLY
@@ -448,108 +862,22 @@ class WebSocket(BaseWebSocketHandler):
                 f"collaborator.Discarding URL:{self.endpoint} "
                 f"User:{self.user.id} ParticipantID:{self.id}"
             )
+            diffs.inc(result="discarded")
             return
         if pv == dv:
-            if settings.JSONPATCH:
-                if "jd" in message:  # jd = json diff
-                    backup = False
-                    if len(message["jd"]) > 1:
-                        # There is more than one patch operation so if the
-                        # patch fails, we might already have applied a previous
-                        # patch operation. Therefore we take a backup now so
-                        # that we can roll back if needed.
-                        backup = deepcopy(self.session["doc"].content)
-                    try:
-                        apply_patch(
-                            self.session["doc"].content, message["jd"], True
-                        )
-                    except (JsonPatchConflict, JsonPointerException):
-                        if backup:
-                            self.session["doc"].content = backup
-                        logger.exception(
-                            f"Action:Cannot apply json diff. "
-                            f"URL:{self.endpoint} User:{self.user.id} "
-                            f"ParticipantID:{self.id}"
-                        )
-                        logger.error(
-                            f"Action:Patch Exception URL:{self.endpoint} "
-                            f"User:{self.user.id} ParticipantID:{self.id} "
-                            f"Message:{json.dumps(message)}"
-                        )
-                        logger.error(
-                            f"Action:Patch Exception URL:{self.endpoint} "
-                            f"User:{self.user.id} ParticipantID:{self.id} "
-                            f"Document:"
-                            f"{json.dumps(self.session['doc'].content)}"
-                        )
-                        self.unfixable()
-                        patch_msg = {
-                            "type": "patch_error",
-                            "user_id": self.user.id,
-                        }
-                        self.send_message(patch_msg)
-                        # Reset collaboration to avoid any data loss issues.
-                        self.reset_collaboration(
-                            patch_msg, self.user_info.document_id, self.id
-                        )
-                        return
-                    # The json diff is only needed by the python backend which
-                    # does not understand the steps. It can therefore be
-                    # removed before broadcast to other clients.
-                    del message["jd"]
-            elif "ds" in message:  # ds = document steps
-                updated_node = prosemirror.apply(
-                    message["ds"], self.session["node"]
-                )
-                if updated_node:
-                    self.session["node"] = updated_node
-                else:
-                    self.unfixable()
-                    patch_msg = {
-                        "type": "patch_error",
-                        "user_id": self.user.id,
-                    }
-                    self.send_message(patch_msg)
-                    # Reset collaboration to avoid any data loss issues.
-                    self.reset_collaboration(
-                        patch_msg, self.user_info.document_id, self.id
-                    )
-                    return
-                self.session["doc"].content = prosemirror.to_mini_json(
-                    self.session["node"].first_child
-                )
-            self.session["doc"].diffs.append(message)
-            self.session["doc"].diffs = self.session["doc"].diffs[
-                -self.history_length :
-            ]
-            self.session["doc"].version += 1
-            if "ti" in message:  # ti = title
-                self.session["doc"].title = message["ti"][-255:]
-            if "cu" in message:  # cu = comment updates
-                self.update_comments(message["cu"])
-            if "bu" in message:  # bu = bibliography updates
-                self.update_bibliography(message["bu"])
-            if "iu" in message:  # iu = image updates
-                self.update_images(message["iu"])
-            if self.session["doc"].version % settings.DOC_SAVE_INTERVAL == 0:
-                WebSocket.save_document(self.user_info.document_id)
-            self.confirm_diff(message["rid"])
-            WebSocket.send_updates(
-                message,
-                self.user_info.document_id,
-                self.id,
-                self.user_info.user.id,
-            )
+            # The next message of the document is handled once the diff has
+            # been accepted or rejected.
+            return self.accept_diff(message)
         elif pv < dv:
-            if pv + len(self.session["doc"].diffs) >= dv:
+            messages = self.get_stored_diffs(pv)
+            if messages is not None:
                 # We have enough diffs stored to fix it.
-                number_diffs = pv - dv
+                diffs.inc(result="outdated")
                 logger.debug(
                     f"Action:Resending document diffs. URL:{self.endpoint} "
                     f"User:{self.user.id} ParticipantID:{self.id} "
-                    f"number of messages to be resent:{number_diffs}"
+                    f"number of messages to be resent:{len(messages)}"
                 )
-                messages = self.session["doc"].diffs[number_diffs:]
                 for message in messages:
                     new_message = message.copy()
                     new_message["server_fix"] = True
@@ -561,6 +889,7 @@ class WebSocket(BaseWebSocketHandler):
                     f"ParticipantID:{self.id}"
                 )
                 # Client has a version that is too old to be fixed
+                diffs.inc(result="unfixable")
                 self.unfixable()
                 return
         else:
@@ -571,6 +900,75 @@ class WebSocket(BaseWebSocketHandler):
                 f"ParticipantID:{self.id}"
             )
 
+    async def accept_diff(self, message):
+        document_id = self.user_info.document_id
+        if not await WebSocket.session_backend.claim_version(
+            document_id, message["v"] + 1
+        ):
+            # Another process has accepted a diff for this version that has
+            # not reached us yet. The client will have to rebase.
+            diffs.inc(result="rejected")
+            self.send_message({"type": "reject_diff", "rid": message["rid"]})
+            return
+        written = self.apply_diff(message)
+        if written:
+            await written
+
+    @diff_seconds.time()
+    def apply_diff(self, message):
+        # Applies a diff for which the next version has been claimed.
+        # Returns an awaitable for the database work or None if the diff
+        # could not be applied.
+        pv = message["v"]
+        document_id = self.user_info.document_id
+        if not self.apply_diff_content(message):
+            WebSocket.session_backend.release_version(document_id, pv + 1)
+            diffs.inc(result="patch_error")
+            self.unfixable()
+            patch_msg = {
+                "type": "patch_error",
+                "user_id": self.user.id,
+            }
+            self.send_message(patch_msg)
+            # Reset collaboration to avoid any data loss issues.
+            self.reset_collaboration(patch_msg, document_id, self.id)
+            return
+        WebSocket.session_backend.publish(
+            document_id,
+            {
+                "type": "diff",
+                "message": message,
+                "sender_id": self.id,
+                "user_id": self.user_info.user.id,
+            },
+        )
+        self.apply_diff_metadata(message)
+        # The diff is written after the database work that has been
+        # submitted for the document before, such as the removal of
+        # diffs that could not be applied.
+        diff_written = self.run_db(
+            DocumentDiff.objects.create,
+            document_id=document_id,
+            version=pv,
+            diff=message,
+        )
+        diff_written.add_done_callback(WebSocket.log_db_error)
+        written = [diff_written]
+        if "iu" in message:  # iu = image updates
+            written.append(self.update_images(message["iu"]))
+        WebSocket.save_scheduler.mark_dirty(document_id)
+        diffs.inc(result="applied")
+        self.confirm_diff(message["rid"])
+        WebSocket.send_updates(
+            WebSocket.without_json_diff(message),
+            document_id,
+            self.id,
+            self.user_info.user.id,
+        )
+        # The next message of the document is handled once the diff and
+        # the image updates have been written, so that it can read them.
+        return asyncio.gather(*written, return_exceptions=True)
+
     def check_version(self, message):
         pv = message["v"]
         dv = self.session["doc"].version
@@ -586,14 +984,13 @@ class WebSocket(BaseWebSocketHandler):
             }
             self.send_message(response)
             return
-        elif pv + len(self.session["doc"].diffs) >= dv:
-            number_diffs = pv - dv
+        messages = self.get_stored_diffs(pv)
+        if messages is not None:
             logger.debug(
                 f"Action:Resending document diffs. URL:{self.endpoint} "
                 f"User:{self.user.id} ParticipantID:{self.id}"
-                f"number of messages to be resent:{number_diffs}"
+                f"number of messages to be resent:{len(messages)}"
             )
-            messages = self.session["doc"].diffs[number_diffs:]
             self.send_document(messages)
             return
         else:
@@ -621,15 +1018,16 @@ class WebSocket(BaseWebSocketHandler):
             hasattr(self, "session")
             and hasattr(self, "user_info")
             and hasattr(self.user_info, "document_id")
-            and self.user_info.document_id in WebSocket.sessions
+            # The session may have been evicted and opened again since.
+            and WebSocket.sessions.get(self.user_info.document_id)
+            is self.session
             and hasattr(self, "id")
-            and self.id
-            in WebSocket.sessions[self.user_info.document_id]["participants"]
+            and self.id in self.session["participants"]
         ):
             del self.session["participants"][self.id]
+            self.session["selection_changes"].pop(self.id, None)
             if len(self.session["participants"]) == 0:
-                WebSocket.save_document(self.user_info.document_id)
-                del WebSocket.sessions[self.user_info.document_id]
+                WebSocket.close_session(self.user_info.document_id)
                 logger.debug(
                     f"Action:No participants for the document. "
                     f"URL:{self.endpoint} User:{self.user.id}"
@@ -638,32 +1036,184 @@ class WebSocket(BaseWebSocketHandler):
                 WebSocket.send_participant_list(self.user_info.document_id)
 
     @classmethod
-    def send_participant_list(cls, document_id):
-        if document_id in WebSocket.sessions:
-            avatars = Avatars()
-            participant_list = []
-            for session_id, waiter in list(
-                cls.sessions[document_id]["participants"].items()
-            ):
-                access_rights = waiter.user_info.access_rights
-                if access_rights not in CAN_COMMUNICATE:
-                    continue
-                participant_list.append(
-                    {
-                        "session_id": session_id,
-                        "id": waiter.user_info.user.id,
-                        "name": waiter.user_info.user.readable_name,
-                        "avatar": avatars.get_url(waiter.user_info.user),
-                    }
-                )
-            message = {
-                "participant_list": participant_list,
-                "type": "connections",
-            }
-            WebSocket.send_updates(message, document_id)
+    def close_session(cls, document_id):
+        # Saves the document of a session and removes the session. If the
+        # worker of the session is still handling messages, so that no diff
+        # is lost, the worker closes the session once it is done. No new
+        # participants join the session in the meantime.
+        session = cls.sessions[document_id]
+        session["closing"] = True
+        if session["handling"] or not session["queue"].empty():
+            return
+        session["worker"].cancel()
+        cls.save_scheduler.flush(document_id, force=True)
+        cls.db_executor.submit(
+            document_id,
+            DocumentDiff.objects.filter(
+                document_id=document_id,
+                version__lt=session["doc"].version - cls.history_length,
+            ).delete,
+        )
+        del cls.sessions[document_id]
+        cls.session_backend.leave(document_id)
+        session["closed"].set()
+
+    @classmethod
+    def evict_idle_sessions(cls):
+        # Connections that are no longer used but have not been closed, for
+        # example in forgotten browser tabs, keep a document in memory. A
+        # session that has not received any message for
+        # DOC_SESSION_IDLE_TIMEOUT seconds is therefore saved and removed and
+        # the connections of its participants are closed. Clients that are
+        # still open reconnect and load the document again.
+        idle_since = monotonic() - settings.DOC_SESSION_IDLE_TIMEOUT
+        for document_id, session in list(cls.sessions.items()):
+            if session["closing"] or session["last_activity"] > idle_since:
+                continue
+            logger.info(
+                f"Action:Evicting idle session. DocumentID:{document_id} "
+                f"Participants:{len(session['participants'])}"
+            )
+            participants = list(session["participants"].values())
+            cls.close_session(document_id)
+            for waiter in participants:
+                waiter.close(1001, "Idle session")
 
     @classmethod
-    def reset_collaboration(cls, patch_exception_msg, document_id, sender_id):
+    def get_session_report(cls):
+        # Returns the report of create_session_report. Can be called from
+        # other threads, such as those of Django views, as the report is
+        # created on the IOLoop of the websockets.
+        if cls.io_loop is None:
+            # No websocket has been opened in this process.
+            return []
+        future = Future()
+
+        def create_report():
+            try:
+                future.set_result(cls.create_session_report())
+            except Exception as e:
+                future.set_exception(e)
+
+        cls.io_loop.add_callback(create_report)
+        return future.result(timeout=10)
+
+    @classmethod
+    def create_session_report(cls):
+        # The documents held in memory by this process with their approximate
+        # size, the JSON size of the document plus the messages kept for
+        # resending to the participants.
+        report = []
+        now = monotonic()
+        for document_id, session in cls.sessions.items():
+            cls.update_content(session)
+            doc = session["doc"]
+            document_size = sum(
+                len(json.dumps(value))
+                for value in [doc.content, doc.comments, doc.bibliography]
+            )
+            resend_size = sum(
+                waiter.messages["sent"].size
+                for waiter in session["participants"].values()
+            )
+            report.append(
+                {
+                    "id": document_id,
+                    "title": doc.title,
+                    "participants": len(session["participants"]),
+                    "version": doc.version,
+                    "unsaved_versions": doc.version
+                    - session["last_saved_version"],
+                    "idle": int(now - session["last_activity"]),
+                    "document_size": document_size,
+                    "resend_size": resend_size,
+                    "size": document_size + resend_size,
+                }
+            )
+        report.sort(key=lambda session: session["size"], reverse=True)
+        return report
+
+    @classmethod
+    def send_selection_changes(cls, document_id):
+        if document_id not in cls.sessions:
+            return
+        session = cls.sessions[document_id]
+        session["selection_timer"] = None
+        selection_changes = session["selection_changes"]
+        session["selection_changes"] = {}
+        for sender_id, (message, user_id) in selection_changes.items():
+            if message["v"] != session["doc"].version:
+                # The selection refers to an outdated version.
+                continue
+            cls.broadcast(message, document_id, sender_id, user_id)
+
+    @classmethod
+    def send_participant_list(cls, document_id, publish=True):
+        # Participants often join or leave in bursts, for example at the
+        # start of a class. The list is therefore sent once
+        # DOC_PARTICIPANT_LIST_DELAY seconds after the first change, covering
+        # all changes in the meantime.
+        if document_id not in cls.sessions:
+            return
+        session = cls.sessions[document_id]
+        if publish:
+            session["publish_participant_list"] = True
+        if session["participant_list_timer"] is None:
+            session["participant_list_timer"] = IOLoop.current().call_later(
+                settings.DOC_PARTICIPANT_LIST_DELAY,
+                cls.broadcast_participant_list,
+                document_id,
+            )
+
+    @classmethod
+    async def broadcast_participant_list(cls, document_id):
+        if document_id not in cls.sessions:
+            return
+        session = cls.sessions[document_id]
+        session["participant_list_timer"] = None
+        participant_list = []
+        for session_id, waiter in list(session["participants"].items()):
+            access_rights = waiter.user_info.access_rights
+            if access_rights not in CAN_COMMUNICATE:
+                continue
+            participant_list.append(
+                {
+                    "session_id": session_id,
+                    "id": waiter.user_info.user.id,
+                    "name": waiter.user_info.user.readable_name,
+                    "avatar": session["avatars"].get_url(
+                        waiter.user_info.user
+                    ),
+                }
+            )
+        participant_list = await cls.session_backend.get_participant_list(
+            document_id, participant_list
+        )
+        if cls.sessions.get(document_id) is not session:
+            return
+        message = {
+            "participant_list": participant_list,
+            "type": "connections",
+        }
+        WebSocket.send_updates(message, document_id)
+        if session["publish_participant_list"]:
+            session["publish_participant_list"] = False
+            cls.session_backend.publish(document_id, {"type": "participants"})
+
+    @classmethod
+    def reset_collaboration(
+        cls, patch_exception_msg, document_id, sender_id, publish=True
+    ):
+        resets.inc()
+        if publish:
+            cls.session_backend.publish(
+                document_id,
+                {
+                    "type": "reset",
+                    "message": patch_exception_msg,
+                    "sender_id": sender_id,
+                },
+            )
         logger.debug(
             f"Action:Resetting collaboration. DocumentID:{document_id} "
             f"Patch conflict triggered. ParticipantID:{sender_id} "
@@ -674,25 +1224,160 @@ class WebSocket(BaseWebSocketHandler):
                 waiter.unfixable()
                 waiter.send_message(patch_exception_msg)
 
+    @classmethod
+    def broadcast(cls, message, document_id, sender_id=None, user_id=None):
+        # Sends a message to the participants of all processes.
+        cls.session_backend.publish(
+            document_id,
+            {
+                "type": "updates",
+                "message": message,
+                "sender_id": sender_id,
+                "user_id": user_id,
+            },
+        )
+        cls.send_updates(message, document_id, sender_id, user_id)
+
+    @classmethod
+    def receive_session_event(cls, document_id, event):
+        # Handles an event that was published by another process.
+        if event["type"] == "clear_cache":
+            # Sent by document.signals.clear_cache.
+            if event["method"] in cls.cache_clearing_methods:
+                getattr(cls, event["method"])(*event["args"])
+            return
+        if document_id not in cls.sessions:
+            return
+        session = cls.sessions[document_id]
+        if event["type"] == "participants":
+            cls.send_participant_list(document_id, publish=False)
+        elif event["type"] == "updates":
+            cls.send_updates(
+                event["message"],
+                document_id,
+                event["sender_id"],
+                event["user_id"],
+            )
+        elif event["type"] == "doc_data":
+            cls.clear_doc_data(document_id, event["keys"], publish=False)
+        elif event["type"] == "reset":
+            cls.reset_collaboration(
+                event["message"],
+                document_id,
+                event["sender_id"],
+                publish=False,
+            )
+        elif event["type"] == "diff":
+            message = event["message"]
+            if message["v"] < session["doc"].version or session["closing"]:
+                # Already applied or the session is being closed and the
+                # document will be loaded from the database again.
+                return
+            waiter = next(iter(session["participants"].values()))
+            if not waiter.apply_shared_diff(message):
+                logger.error(
+                    f"Action:Cannot apply diff from other process. "
+                    f"DocumentID:{document_id} "
+                    f"Diff version:{message['v']} "
+                    f"Server version:{session['doc'].version}"
+                )
+                cls.resync_session(document_id)
+                return
+            # Every process with a session of the document saves it, so that
+            # the diffs are saved even if the process that accepted them
+            # closes its session first. A save of an older version is
+            # completed by the stored diffs when the document is opened.
+            cls.save_scheduler.mark_dirty(document_id)
+            cls.send_updates(
+                cls.without_json_diff(message),
+                document_id,
+                event["sender_id"],
+                event["user_id"],
+            )
+
+    @classmethod
+    def clear_doc_data(cls, document_id, keys, publish=True):
+        # Removes parts of the cached doc_data message of a document that
+        # have changed.
+        if document_id in cls.sessions:
+            for key in keys:
+                cls.sessions[document_id]["doc_data"].pop(key, None)
+        if publish:
+            cls.session_backend.publish(
+                document_id, {"type": "doc_data", "keys": keys}
+            )
+
+    @classmethod
+    def clear_owner_data(cls, user_id):
+        # Called when the contacts of a user have changed.
+        for document_id, session in cls.sessions.items():
+            if session["doc"].owner_id == user_id:
+                cls.clear_doc_data(document_id, ["owner"], publish=False)
+
+    @classmethod
+    def clear_avatar(cls, user_id):
+        for session in cls.sessions.values():
+            session["avatars"].AVATARS.pop(user_id, None)
+
+    @classmethod
+    def clear_template_data(cls, template_id):
+        for document_id, session in cls.sessions.items():
+            if session["doc"].template_id == template_id:
+                cls.clear_doc_data(document_id, ["template"], publish=False)
+
+    @classmethod
+    def clear_styles(cls, template_id=None, user_id=None):
+        # Removes the cached styles messages of a document template and of a
+        # user. Without arguments, all cached styles messages are removed.
+        for key in list(cls.styles_cache):
+            if (
+                (template_id is None and user_id is None)
+                or key[0] == template_id
+                or key[1] == user_id
+            ):
+                del cls.styles_cache[key]
+
+    @classmethod
+    def resync_session(cls, document_id):
+        # Rebuilds the session from the database and the stored diffs after
+        # it got out of sync with the other processes.
+        session = cls.sessions[document_id]
+        session["doc"].refresh_from_db()
+        session["node"] = prosemirror.from_json(
+            {"type": "doc", "content": [session["doc"].content]}
+        )
+        session["content_node"] = session["node"]
+        session["json_cache"] = {}
+        session["doc_data"] = {}
+        session["last_saved_version"] = session["doc"].version
+        waiter = next(iter(session["participants"].values()))
+        waiter.apply_unsaved_diffs(cls.get_unsaved_diffs(session["doc"]))
+        for waiter in list(session["participants"].values()):
+            waiter.unfixable()
+
     @classmethod
     def send_updates(cls, message, document_id, sender_id=None, user_id=None):
         logger.debug(
-            f"Action:Sending message to waiters. DocumentID:{document_id} "
-            f"waiters:{len(cls.sessions[document_id]['participants'])}"
+            "Action:Sending message to waiters. DocumentID:%s waiters:%s",
+            document_id,
+            len(cls.sessions[document_id]["participants"]),
         )
+        # The message is encoded at most once per variant (with or without
+        # comments) and shared by all waiters that receive that variant.
+        encoded_messages = {}
         for waiter in list(cls.sessions[document_id]["participants"].values()):
             if waiter.id != sender_id:
                 access_rights = waiter.user_info.access_rights
+                without_comments = False
                 if "comments" in message and len(message["comments"]) > 0:
                     # Filter comments if needed
                     if access_rights == "read-without-comments":
                         # The reader should not receive the comments update, so
                         # we remove the comments from the copy of the message
-                        # sent to the reviewer. We still need to send the rest
+                        # sent to the reader. We still need to send the rest
                         # of the message as it may contain other diff
                         # information.
-                        message = deepcopy(message)
-                        message["comments"] = []
+                        without_comments = True
                     elif (
                         access_rights in ["review", "review-tracked"]
                         and user_id != waiter.user_info.user.id
@@ -703,8 +1388,7 @@ class WebSocket(BaseWebSocketHandler):
                         # that are not from them. We still need to send the
                         # rest of the message as it may contain other diff
                         # information.
-                        message = deepcopy(message)
-                        message["comments"] = []
+                        without_comments = True
                 elif (
                     message["type"] in ["chat", "connections"]
                     and access_rights not in CAN_COMMUNICATE
@@ -721,28 +1405,46 @@ class WebSocket(BaseWebSocketHandler):
                     and user_id != waiter.user_info.user.id
                 ):
                     continue
-                waiter.send_message(message)
+                if without_comments not in encoded_messages:
+                    variant = message
+                    if without_comments:
+                        variant = dict(message, comments=[])
+                    encoded_messages[without_comments] = (
+                        variant,
+                        encode_message(variant),
+                    )
+                waiter.send_message(*encoded_messages[without_comments])
 
-    @classmethod
-    def save_document(cls, document_id):
-        session = cls.sessions[document_id]
-        if session["doc"].version == session["last_saved_version"]:
+    @staticmethod
+    def update_content(session):
+        # Brings doc.content up to date with the node that steps have been
+        # applied to.
+        if session["content_node"] is session["node"]:
             return
+        session["doc"].content = prosemirror.to_mini_json(
+            session["node"].first_child, session["json_cache"]
+        )
+        session["content_node"] = session["node"]
+
+    @classmethod
+    @save_seconds.time()
+    def write_document(cls, doc):
+        # Also called from the thread of the save scheduler.
         logger.debug(
-            f"Action:Saving document to DB. DocumentID:{session['doc'].id} "
-            f"Doc version:{session['doc'].version}"
+            f"Action:Saving document to DB. DocumentID:{doc.id} "
+            f"Doc version:{doc.version}"
         )
+        close_old_connections()
         try:
             # this try block is to avoid a db exception
             # in case the doc has been deleted from the db
             # in fiduswriter the owner of a doc could delete a doc
             # while an invited writer is editing the same doc
-            session["doc"].save(
+            doc.save(
                 update_fields=[
                     "title",
                     "version",
                     "content",
-                    "diffs",
                     "comments",
                     "bibliography",
                     "updated",
@@ -752,10 +1454,9 @@ class WebSocket(BaseWebSocketHandler):
         except DatabaseError as e:
             expected_msg = "Save with update_fields did not affect any rows."
             if str(e) == expected_msg:
-                cls.__insert_document(doc=session["doc"])
+                cls.__insert_document(doc=doc)
             else:
                 raise e
-        session["last_saved_version"] = session["doc"].version
 
     @classmethod
     def __insert_document(cls, doc: Document) -> None:
@@ -785,10 +1486,23 @@ class WebSocket(BaseWebSocketHandler):
                     "raises an Integrity error: {}".format(e)
                 ) from None
 
-    @classmethod
-    def save_all_docs(cls):
-        for document_id in cls.sessions:
-            cls.save_document(document_id)
-
 
-atexit.register(WebSocket.save_all_docs)
+metrics.Gauge(
+    "fiduswriter_document_sessions",
+    "Documents held in memory for collaboration.",
+    lambda: len(WebSocket.sessions),
+)
+metrics.Gauge(
+    "fiduswriter_document_participants",
+    "Participants connected to the documents held in memory.",
+    lambda: sum(
+        len(session["participants"]) for session in WebSocket.sessions.values()
+    ),
+)
+WebSocket.save_scheduler = SaveScheduler(
+    WebSocket.sessions,
+    WebSocket.write_document,
+    WebSocket.update_content,
+    WebSocket.db_executor,
+)
+atexit.register(WebSocket.save_scheduler.shutdown)
@@ -1,4 +1,5 @@
 from django.conf import settings
+from avatar.models import Avatar
 from avatar.utils import get_username
 from avatar.providers import PrimaryAvatarProvider
 
@@ -14,3 +15,21 @@ class Avatars:
                 username, settings.AVATAR_DEFAULT_SIZE
             )
         return self.AVATARS[user.id]
+
+    def prefetch(self, users):
+        # Looks up the avatars of several users with one query, choosing the
+        # same avatar as PrimaryAvatarProvider.
+        user_ids = {user.id for user in users} - set(self.AVATARS)
+        if not user_ids:
+            return
+        size = settings.AVATAR_DEFAULT_SIZE
+        for user_id in user_ids:
+            self.AVATARS[user_id] = None
+        for avatar in Avatar.objects.filter(user_id__in=user_ids).order_by(
+            "user_id", "-primary", "-date_uploaded"
+        ):
+            if self.AVATARS[avatar.user_id] is not None:
+                continue
+            if not avatar.thumbnail_exists(size, size):
+                avatar.create_thumbnail(size, size)
+            self.AVATARS[avatar.user_id] = avatar.avatar_url(size, size)
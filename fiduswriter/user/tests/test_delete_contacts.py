@@ -0,0 +1,109 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from document.models import AccessRight, Document, DocumentTemplate
+from user.models import UserInvite
+
+
+class DeleteContactsTest(TestCase):
+    fixtures = [
+        "initial_documenttemplates.json",
+    ]
+
+    def setUp(self):
+        self.template = DocumentTemplate.objects.first()
+        self.user = self.create_user("Yeti")
+        self.client.force_login(self.user)
+        # A contact who keeps the access rights.
+        self.contact = self.create_contact("Contact")
+
+    def create_user(self, username):
+        return get_user_model().objects.create(
+            username=username, email=f"{username.lower()}@snowman.com"
+        )
+
+    def create_doc(self, owner):
+        return Document.objects.create(owner=owner, template=self.template)
+
+    def create_contact(self, username):
+        # A contact with whom the user shares a document and who shares a
+        # document with the user.
+        contact = self.create_user(username)
+        self.user.contacts.add(contact)
+        AccessRight.objects.create(
+            document=self.create_doc(self.user),
+            holder_obj=contact,
+            rights="write",
+        )
+        AccessRight.objects.create(
+            document=self.create_doc(contact),
+            holder_obj=self.user,
+            rights="read",
+        )
+        return contact
+
+    def create_invite(self, email):
+        invite = UserInvite.objects.create(
+            username=email, email=email, by=self.user
+        )
+        AccessRight.objects.create(
+            document=self.create_doc(self.user),
+            holder_obj=invite,
+            rights="read",
+        )
+        return invite
+
+    def delete_contacts(self, contacts):
+        response = self.client.post(
+            reverse("delete_contacts"),
+            {"contacts": json.dumps(contacts)},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_delete_contacts(self):
+        contact = self.create_contact("Contact2")
+        invite = self.create_invite("invite@snowman.com")
+        self.delete_contacts(
+            [
+                {"type": "user", "id": contact.id},
+                {"type": "userinvite", "id": invite.id},
+            ]
+        )
+        self.assertFalse(AccessRight.objects.filter(user=contact).exists())
+        self.assertFalse(
+            AccessRight.objects.filter(
+                user=self.user, document__owner=contact
+            ).exists()
+        )
+        self.assertFalse(
+            AccessRight.objects.filter(userinvite=invite).exists()
+        )
+        self.assertFalse(UserInvite.objects.filter(id=invite.id).exists())
+        self.assertEqual(list(self.user.contacts.all()), [self.contact])
+        # The access rights of the remaining contact are kept.
+        self.assertTrue(AccessRight.objects.filter(user=self.contact).exists())
+        self.assertTrue(
+            AccessRight.objects.filter(
+                user=self.user, document__owner=self.contact
+            ).exists()
+        )
+
+    def count_queries(self, number):
+        contacts = [
+            {"type": "user", "id": self.create_contact(f"Yeti{number}-{i}").id}
+            for i in range(number)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            self.delete_contacts(contacts)
+        self.assertEqual(AccessRight.objects.count(), 2)
+        return len(queries)
+
+    def test_constant_number_of_queries(self):
+        # The access rights of any number of users are deleted at once.
+        self.assertEqual(self.count_queries(2), self.count_queries(10))
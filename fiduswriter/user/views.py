@@ -15,6 +15,7 @@ from django.core.files import File
 from base.decorators import ajax_required
 from .forms import UserForm
 from document.models import AccessRight
+from document.helpers.access_rights import holders_query
 from .models import UserInvite
 from .helpers import Avatars
 from . import emails
@@ -483,21 +484,27 @@ def delete_contacts(request):
     """
     response = {}
     former_contacts = json.loads(request.POST["contacts"])
+    user_ids = [
+        former_contact["id"]
+        for former_contact in former_contacts
+        if former_contact["type"] == "user"
+    ]
+    if user_ids:
+        # Revoke all permissions given to these users
+        AccessRight.objects.filter(
+            holders_query(
+                {"type": "user", "id": user_id} for user_id in user_ids
+            ),
+            document__owner=request.user,
+        ).delete()
+        # Revoke all permissions received from these users
+        AccessRight.objects.filter(
+            user=request.user, document__owner_id__in=user_ids
+        ).delete()
+        # Remove the users from the contacts
+        request.user.contacts.remove(*user_ids)
     for former_contact in former_contacts:
-        if former_contact["type"] == "user":
-            # Revoke all permissions given to this user
-            AccessRight.objects.filter(
-                user__id=former_contact["id"], document__owner=request.user
-            ).delete()
-            # Revoke all permissions received from this user
-            AccessRight.objects.filter(
-                user=request.user, document__owner_id=former_contact["id"]
-            ).delete()
-            # Remove the user from the contacts
-            request.user.contacts.remove(
-                request.user.contacts.filter(id=former_contact["id"]).first()
-            )
-        elif former_contact["type"] == "userinvite":
+        if former_contact["type"] == "userinvite":
             # Delete the userinvite. All connected access rights will be
             # deleted automatically.
             request.user.invites_by.filter(id=former_contact["id"]).delete()